@@ -0,0 +1,58 @@
+"""Compare the native fasta reader/writer against the BioPython SeqIO path.
+
+BioPython is no longer a dependency of genslm, install it to run the comparison.
+Example usage: python examples/benchmarks/fasta_parse_speed.py -f genes.fasta
+"""
+import pickle
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+from Bio import SeqIO  # type: ignore[import]
+from Bio.Seq import Seq  # type: ignore[import]
+from Bio.SeqRecord import SeqRecord  # type: ignore[import]
+
+from genslm.utils import iter_fasta, seqs_to_fasta
+
+
+def timeit(name: str, func) -> None:  # type: ignore[no-untyped-def]
+    start = time.perf_counter()
+    func()
+    print(f"{name:<40}{time.perf_counter() - start:.3f}s")
+
+
+def seqio_write(seqs, fasta_file: Path) -> None:  # type: ignore[no-untyped-def]
+    records = [
+        SeqRecord(Seq(seq), id=f"SyntheticSeq_{i}", description="SyntheticSeq")
+        for i, seq in enumerate(seqs)
+    ]
+    SeqIO.write(records, fasta_file, "fasta")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-f", "--fasta_file", type=Path, required=True)
+    args = parser.parse_args()
+
+    seqio_records = list(SeqIO.parse(args.fasta_file, "fasta"))
+    native_records = list(iter_fasta(args.fasta_file))
+    assert [str(r.seq) for r in seqio_records] == [r.sequence for r in native_records]
+    assert [r.description for r in seqio_records] == [
+        r.description for r in native_records
+    ]
+    print(f"{len(native_records)} records in {args.fasta_file}")
+
+    timeit("parse: SeqIO", lambda: list(SeqIO.parse(args.fasta_file, "fasta")))
+    timeit("parse: iter_fasta", lambda: list(iter_fasta(args.fasta_file)))
+
+    # Records are pickled to the ProcessPoolExecutor workers in parallel_preprocess
+    timeit("pickle: SeqRecord", lambda: pickle.loads(pickle.dumps(seqio_records)))
+    timeit("pickle: Sequence", lambda: pickle.loads(pickle.dumps(native_records)))
+
+    seqs = [r.sequence for r in native_records]
+    with tempfile.TemporaryDirectory() as tmp:
+        timeit("write: SeqIO", lambda: seqio_write(seqs, Path(tmp) / "a.fasta"))
+        timeit(
+            "write: seqs_to_fasta", lambda: seqs_to_fasta(seqs, Path(tmp) / "b.fasta")
+        )
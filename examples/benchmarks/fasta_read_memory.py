@@ -0,0 +1,61 @@
+"""Peak memory of the streaming fasta reader as the input file grows.
+
+Example usage: python examples/benchmarks/fasta_read_memory.py -o /tmp/fasta_bench
+"""
+import resource
+import subprocess
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+
+# Each measurement runs in a fresh interpreter so ru_maxrss is not polluted
+# by earlier, larger runs.
+READER_SNIPPET = """
+import resource, sys
+from genslm.utils import iter_fasta
+n = sum(1 for _ in iter_fasta(sys.argv[1]))
+print(n, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def write_random_fasta(fasta_file: Path, num_seqs: int, seq_length: int) -> None:
+    rng = np.random.default_rng(0)
+    bases = np.frombuffer(b"ACGT", dtype=np.uint8)
+    with open(fasta_file, "w") as f:
+        for i in range(num_seqs):
+            seq = bases[rng.integers(0, 4, seq_length)].tobytes().decode()
+            lines = "\n".join(seq[j : j + 60] for j in range(0, seq_length, 60))
+            f.write(f">seq_{i} random sequence\n{lines}\n")
+
+
+def peak_rss_mb(fasta_file: Path) -> float:
+    out = subprocess.run(
+        [sys.executable, "-c", READER_SNIPPET, str(fasta_file)],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.split()
+    return int(out[1]) / 1024  # ru_maxrss is in KB on Linux
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-o", "--output_dir", type=Path, required=True)
+    parser.add_argument("-l", "--seq_length", type=int, default=3000)
+    parser.add_argument(
+        "-n", "--num_seqs", type=int, nargs="+", default=[1000, 10000, 100000]
+    )
+    args = parser.parse_args()
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Benchmark driver RSS: {baseline:.1f} MB")
+    print("num_seqs\tfile_size_mb\tpeak_rss_mb")
+    for num_seqs in args.num_seqs:
+        fasta_file = args.output_dir / f"random_{num_seqs}.fasta"
+        if not fasta_file.exists():
+            write_random_fasta(fasta_file, num_seqs, args.seq_length)
+        size_mb = fasta_file.stat().st_size / 1024**2
+        print(f"{num_seqs}\t{size_mb:.1f}\t{peak_rss_mb(fasta_file):.1f}")
@@ -0,0 +1,53 @@
+"""Compare the HuggingFace k-mer tokenization against the vectorized KmerTokenizer.
+
+Example usage: python examples/benchmarks/tokenize_speed.py -f genes.fasta
+"""
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+from tokenizers import Tokenizer
+from transformers import PreTrainedTokenizerFast
+
+from genslm import GenSLM, SequenceDataset
+from genslm.tokenizer import KmerTokenizer
+from genslm.utils import read_fasta_only_seq
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-f", "--fasta_file", type=Path, required=True)
+    parser.add_argument("-t", "--tokenizer_file", type=Path)
+    parser.add_argument("-l", "--seq_length", type=int, default=2048)
+    parser.add_argument("-k", "--kmer_size", type=int, default=3)
+    args = parser.parse_args()
+
+    tokenizer_file = args.tokenizer_file or Path(
+        GenSLM.MODELS["genslm_25M_patric"]["tokenizer"]
+    )
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=Tokenizer.from_file(str(tokenizer_file))
+    )
+    tokenizer.add_special_tokens({"pad_token": "[PAD]"})
+    sequences = read_fasta_only_seq(args.fasta_file)
+    print(f"{len(sequences)} sequences in {args.fasta_file}")
+
+    start = time.perf_counter()
+    expected = [
+        tokenizer(
+            SequenceDataset.group_by_kmer(seq, args.kmer_size),
+            max_length=args.seq_length,
+            padding="max_length",
+            truncation=True,
+            return_tensors="np",
+        )["input_ids"]
+        for seq in sequences
+    ]
+    print(f"{'HuggingFace':<20}{time.perf_counter() - start:.3f}s")
+
+    start = time.perf_counter()
+    kmer_tokenizer = KmerTokenizer(tokenizer)
+    encoding = kmer_tokenizer(sequences, args.kmer_size, args.seq_length)
+    print(f"{'KmerTokenizer':<20}{time.perf_counter() - start:.3f}s")
+
+    assert np.array_equal(np.concatenate(expected), encoding["input_ids"])
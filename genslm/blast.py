@@ -9,12 +9,9 @@ from typing import List, Optional, Tuple
 import numpy as np
 import pandas as pd  # type: ignore[import]
 import pytorch_lightning as pl
-from Bio import SeqIO  # type: ignore[import]
-from Bio.Seq import Seq  # type: ignore[import]
-from Bio.SeqRecord import SeqRecord  # type: ignore[import]
 from pytorch_lightning.callbacks import Callback
 
-from genslm.utils import generate_dna, tokens_to_sequences
+from genslm.utils import Sequence, generate_dna, tokens_to_sequences, write_fasta
 
 
 class ParallelBLAST:
@@ -67,7 +64,9 @@ class ParallelBLAST:
         seq_hash = hash(sequence)
         temp_fasta = self.output_dir / f"{prefix}-seq-{seq_hash}.fasta"
         temp_csv = self.output_dir / f"{prefix}-blast-{seq_hash}.csv"
-        SeqIO.write(SeqRecord(Seq(sequence)), temp_fasta, "fasta")
+        write_fasta(
+            Sequence(sequence=sequence, tag=f"{prefix}-seq-{seq_hash}"), temp_fasta
+        )
         # Run local blastn given parameters in init, REQUIRES LOCAL INSTALLATION OF BLAST
         command = "{} -query {} -subject {} -out {} -outfmt 10".format(
             self.blast_exe_path, temp_fasta, self.database_file, temp_csv
@@ -0,0 +1,111 @@
+"""Compare compression codecs and chunk layouts of a training H5 file.
+
+The input file is rewritten with every combination of codec and records per
+chunk into the output directory, which should be on the filesystem used for
+training. Reads go through FileBackedH5Dataset like the training dataloaders.
+Freshly written files are likely in the page cache, use an input larger than
+memory (or drop the caches) to measure the filesystem itself.
+
+Example usage: python -m genslm.cmdline.benchmark_h5 -i train.h5 -o /scratch/bench -c none lzf gzip:1 -r auto 1 16
+"""
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from genslm.dataset import (
+    DEFAULT_CODEC,
+    FileBackedH5Dataset,
+    H5Dataset,
+    h5_filters,
+    hdf5plugin,
+)
+
+
+def read_throughput(h5_file: Path, indices: np.ndarray) -> float:
+    """Samples per second read through a newly opened dataset."""
+    dataset = FileBackedH5Dataset(h5_file)
+    dataset[0]  # Open the file outside of the timing
+    start = time.perf_counter()
+    for idx in indices:
+        dataset[int(idx)]
+    elapsed = time.perf_counter() - start
+    dataset.h5_file.close()
+    return len(indices) / elapsed
+
+
+def parse_chunk_rows(value: str) -> Optional[int]:
+    return None if value == "auto" else int(value)
+
+
+if __name__ == "__main__":
+    default_codecs = ["none", "lzf", "gzip:1", DEFAULT_CODEC]
+    if hdf5plugin is not None:
+        default_codecs += ["zstd:3", "blosc:lz4:5"]
+
+    parser = ArgumentParser()
+    parser.add_argument("-i", "--h5_file", type=Path, required=True)
+    parser.add_argument(
+        "-o", "--output_dir", type=Path, required=True, help="Where to write copies"
+    )
+    parser.add_argument(
+        "-c",
+        "--codecs",
+        nargs="+",
+        default=default_codecs,
+        help="Codecs to compare, see --compression of genslm.cmdline.fasta_to_h5",
+    )
+    parser.add_argument(
+        "-r",
+        "--chunk_rows",
+        nargs="+",
+        type=parse_chunk_rows,
+        default=[None, 1, 16, 128],
+        help="Records per chunk to compare, `auto` for chunks of up to 256KB",
+    )
+    parser.add_argument(
+        "-n", "--num_reads", type=int, default=2000, help="Samples to read per test"
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="Keep the rewritten files after reading"
+    )
+    args = parser.parse_args()
+
+    for codec in args.codecs:
+        h5_filters(codec)
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    num_samples = len(FileBackedH5Dataset(args.h5_file))
+    num_reads = min(args.num_reads, num_samples)
+    rng = np.random.default_rng(0)
+    random_indices = rng.integers(num_samples, size=num_reads)
+    start_idx = int(rng.integers(num_samples - num_reads + 1))
+    sequential_indices = np.arange(start_idx, start_idx + num_reads)
+
+    print(f"{args.h5_file}: {num_samples} samples, {num_reads} reads per test")
+    header = ["codec", "chunk_rows", "write (s)", "size (MB)", "random/s", "seq/s"]
+    print("".join(f"{name:>14}" for name in header))
+    for codec in args.codecs:
+        for chunk_rows in args.chunk_rows:
+            output_file = args.output_dir / f"{codec.replace(':', '_')}_{chunk_rows}.h5"
+            start = time.perf_counter()
+            H5Dataset.rewrite_h5(
+                args.h5_file, output_file, {"default": codec}, chunk_rows
+            )
+            write_time = time.perf_counter() - start
+            size = output_file.stat().st_size / 1e6
+            random_rate = read_throughput(output_file, random_indices)
+            sequential_rate = read_throughput(output_file, sequential_indices)
+            row = [
+                codec,
+                "auto" if chunk_rows is None else str(chunk_rows),
+                f"{write_time:.2f}",
+                f"{size:.1f}",
+                f"{random_rate:.0f}",
+                f"{sequential_rate:.0f}",
+            ]
+            print("".join(f"{value:>14}" for value in row))
+            if not args.keep:
+                output_file.unlink()
@@ -0,0 +1,36 @@
+"""Build a hashed index of known sequences for novelty checks during generation.
+
+Example usage:
+python -m genslm.cmdline.build_known_sequence_index -i known/*.fasta -o known_index -n 8 --verify
+"""
+from argparse import ArgumentParser
+from pathlib import Path
+
+from genslm.utils import KnownSequenceIndex
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "-i",
+        "--input_files",
+        type=Path,
+        nargs="+",
+        required=True,
+        help="Space separated list of known sequence fasta files.",
+    )
+    parser.add_argument(
+        "-o", "--output_dir", type=Path, required=True, help="Index directory."
+    )
+    parser.add_argument("-n", "--num_workers", type=int, default=1)
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Also store the sequences so hash matches are checked exactly.",
+    )
+    args = parser.parse_args()
+
+    index = KnownSequenceIndex.build(
+        args.input_files, verify=args.verify, num_workers=args.num_workers
+    )
+    index.save(args.output_dir)
+    print(f"Indexed {len(index)} unique sequences into {args.output_dir}")
@@ -0,0 +1,34 @@
+"""Convert padded (v1) H5 files to the ragged v2 schema.
+
+Example usage: python -m genslm.cmdline.convert_h5 -i /path/to/h5_dir -o /path/to/v2_dir -w 8
+"""
+import functools
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from genslm.dataset import H5Dataset
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-i", "--h5_dir", type=Path, help="Directory with *.h5 files")
+    parser.add_argument("-o", "--output_dir", type=Path, help="Output directory")
+    parser.add_argument("-w", "--num_workers", type=int, default=1)
+    parser.add_argument(
+        "-c",
+        "--chunk_size",
+        type=int,
+        default=4096,
+        help="Number of rows to convert at a time",
+    )
+    args = parser.parse_args()
+
+    input_files = list(args.h5_dir.glob("*.h5"))
+    output_files = [args.output_dir / f.name for f in input_files]
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    convert = functools.partial(H5Dataset.convert_to_ragged, chunk_size=args.chunk_size)
+    with ProcessPoolExecutor(max_workers=args.num_workers) as pool:
+        for _ in pool.map(convert, input_files, output_files):
+            pass
+    print(f"Converted {len(input_files)} files to {args.output_dir}")
@@ -0,0 +1,118 @@
+"""Find exact duplicate sequences across fasta files before converting them to H5.
+
+Run the stages in order, each one is spread over the nodes given by the
+NODE_RANK and NRANKS environment variables (as in genslm.cmdline.fasta_to_h5):
+```
+python -m genslm.cmdline.dedup_fasta -f $FASTA_DIR -w $DEDUP_DIR --stage hash -n 8
+python -m genslm.cmdline.dedup_fasta -f $FASTA_DIR -w $DEDUP_DIR --stage dedup -s 64 -n 8
+python -m genslm.cmdline.dedup_fasta -f $FASTA_DIR -w $DEDUP_DIR --stage mask
+```
+Then convert with `python -m genslm.cmdline.fasta_to_h5 ... --dedup_dir $DEDUP_DIR`,
+or write the deduplicated fasta files:
+```
+python -m genslm.cmdline.dedup_fasta -f $FASTA_DIR -w $DEDUP_DIR --stage filter -o $OUT_DIR -n 8
+```
+"""
+import functools
+import os
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from genslm.utils import FastaDeduplicator
+
+
+def filter_fasta(
+    fasta_file: Path, deduplicator: FastaDeduplicator, output_dir: Path
+) -> None:
+    deduplicator.filter_fasta(fasta_file, output_dir / fasta_file.name)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-f", "--fasta_dir", type=Path, required=True)
+    parser.add_argument(
+        "-g",
+        "--glob",
+        help="Pattern to glob for in fasta_dir, defaults to `*.ffn`",
+        type=str,
+        default="*.ffn",
+    )
+    parser.add_argument(
+        "-w",
+        "--work_dir",
+        type=Path,
+        required=True,
+        help="Directory of the hashes, hash set shards and keep-masks",
+    )
+    parser.add_argument(
+        "--stage", choices=["hash", "dedup", "mask", "filter"], required=True
+    )
+    parser.add_argument(
+        "-s",
+        "--num_shards",
+        type=int,
+        default=1,
+        help="Number of hash ranges to deduplicate separately (dedup stage)",
+    )
+    parser.add_argument(
+        "-o", "--output_dir", type=Path, help="Deduplicated fasta files (filter stage)"
+    )
+    parser.add_argument(
+        "-k",
+        "--kmer_size",
+        type=int,
+        default=3,
+        help="KMER size used to estimate the tokens saved (mask stage)",
+    )
+    parser.add_argument("-n", "--num_workers", type=int, default=1)
+    args = parser.parse_args()
+
+    node_rank = int(os.environ.get("NODE_RANK", 0))  # zero indexed
+    num_nodes = int(os.environ.get("NRANKS", 1))
+
+    # Every node must see the files in the same order, the first copy is kept
+    files = sorted(args.fasta_dir.glob(args.glob))
+    deduplicator = FastaDeduplicator(files, args.work_dir)
+
+    if args.stage == "hash":
+        deduplicator.hash_files(node_rank, num_nodes, args.num_workers)
+        print(f"Hashed the sequences of {len(files[node_rank::num_nodes])} files")
+
+    elif args.stage == "dedup":
+        shards = list(range(node_rank, args.num_shards, num_nodes))
+        func = functools.partial(deduplicator.dedup_shard, num_shards=args.num_shards)
+        with ProcessPoolExecutor(max_workers=args.num_workers) as pool:
+            for _ in pool.map(func, shards):
+                pass
+        print(f"Deduplicated shards {shards} of {args.num_shards}")
+
+    elif args.stage == "mask":
+        stats = deduplicator.write_masks()
+        records, kept_records = stats["records"], stats["kept_records"]
+        bases, kept_bases = stats["bases"], stats["kept_bases"]
+        print(
+            f"Records: {records} -> {kept_records} "
+            f"({1 - kept_records / max(records, 1):.2%} duplicates)"
+        )
+        print(
+            f"Bases: {bases} -> {kept_bases}, about "
+            f"{(bases - kept_bases) // args.kmer_size} fewer tokens"
+        )
+        print(
+            f"An epoch is {kept_bases / max(bases, 1):.2%} of the tokens "
+            f"({kept_records / max(records, 1):.2%} of the padded rows)"
+        )
+
+    else:
+        if not args.output_dir:
+            raise ValueError("Output dir not present")
+        args.output_dir.mkdir(parents=True, exist_ok=True)
+        func = functools.partial(
+            filter_fasta, deduplicator=deduplicator, output_dir=args.output_dir
+        )
+        node_files = files[node_rank::num_nodes]
+        with ProcessPoolExecutor(max_workers=args.num_workers) as pool:
+            for _ in pool.map(func, node_files):
+                pass
+        print(f"Wrote {len(node_files)} deduplicated files to {args.output_dir}")
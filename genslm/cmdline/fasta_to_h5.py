@@ -1,15 +1,38 @@
 import functools
 import os
-import time
 from argparse import ArgumentParser
-from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Any, Dict, Optional
 
 from tokenizers import Tokenizer
 from transformers import PreTrainedTokenizerFast
 
-from genslm.dataset import H5Dataset
+from genslm.dataset import H5Dataset, parse_compression
+from genslm.utils import FastaDeduplicator, FileTaskQueue
+
+
+def preprocess_file(
+    fasta_file: Path,
+    work_dir: Path,
+    train_val_test_split: Optional[Dict[str, float]],
+    dedup_dir: Optional[Path],
+    **kwargs: Any,
+) -> None:
+    # Outputs are moved from work_dir to the h5_dir by the task queue
+    if train_val_test_split is not None:
+        for split_name in train_val_test_split:
+            (work_dir / split_name).mkdir(exist_ok=True)
+    keep_mask = None
+    if dedup_dir is not None:
+        # Keep-masks written by genslm.cmdline.dedup_fasta
+        keep_mask = FastaDeduplicator([fasta_file], dedup_dir).mask_file(fasta_file)
+    H5Dataset.preprocess(
+        fasta_file,
+        work_dir / f"{fasta_file.stem}.h5",
+        train_val_test_split=train_val_test_split,
+        keep_mask=keep_mask,
+        **kwargs,
+    )
 
 
 def process_dataset(
@@ -21,9 +44,13 @@ def process_dataset(
     tokenizer_blocksize: int,
     kmer_size: int,
     train_val_test_split: Optional[Dict[str, float]],
-    node_rank: int,
-    num_nodes: int,
     subsample: int,
+    pack_sequences: bool = False,
+    ragged: bool = False,
+    compression: Optional[Dict[str, str]] = None,
+    chunk_rows: Optional[int] = None,
+    split_by: str = "sequence",
+    dedup_dir: Optional[Path] = None,
 ) -> None:
 
     if not fasta_dir:
@@ -38,55 +65,31 @@ def process_dataset(
         tokenizer_object=Tokenizer.from_file(str(tokenizer_file))
     )
     tokenizer.add_special_tokens({"pad_token": "[PAD]"})
-    files = list(fasta_dir.glob(glob_pattern))
-    out_files = [h5_dir / f"{f.stem}.h5" for f in files]
-    already_done = set(f.name for f in h5_dir.glob("**/*.h5"))
 
-    if len(already_done) == len(files):
+    # Every node pulls the next unclaimed file from the queue in h5_dir, files
+    # recorded in its manifest are skipped unless their contents changed
+    queue = FileTaskQueue(list(fasta_dir.glob(glob_pattern)), h5_dir)
+    if all(queue.is_done(f) for f in queue.input_files):
         raise ValueError(f"Already processed all files in {fasta_dir}")
 
-    files, out_files = zip(
-        *[
-            (fin, fout)
-            for fin, fout in zip(files, out_files)
-            if fout.name not in already_done
-        ]
-    )
-
-    if train_val_test_split is not None:
-        (h5_dir / "train").mkdir(exist_ok=True)
-        (h5_dir / "test").mkdir(exist_ok=True)
-        (h5_dir / "val").mkdir(exist_ok=True)
-
-    # determine which chunk this instance is supposed to be running
-    if num_nodes > 1:
-        chunk_size = len(files) // num_nodes
-        start_idx = node_rank * chunk_size
-        end_idx = start_idx + chunk_size
-        if node_rank + 1 == num_nodes:
-            end_idx = len(files)
-
-        print(
-            f"Node {node_rank}/{num_nodes} starting at {start_idx}, ending at {end_idx} ({len(files)=}"
-        )
-        files = files[start_idx:end_idx]
-        out_files = out_files[start_idx:end_idx]
-
-    print(f"Processing {len(files)} files from {fasta_dir}...")
+    print(f"Processing {len(queue.input_files)} files from {fasta_dir}...")
     func = functools.partial(
-        H5Dataset.preprocess,
+        preprocess_file,
+        train_val_test_split=train_val_test_split,
+        dedup_dir=dedup_dir,
         tokenizer=tokenizer,
         block_size=tokenizer_blocksize,
-        train_val_test_split=train_val_test_split,
         subsample=subsample,
         kmer_size=kmer_size,
+        pack_sequences=pack_sequences,
+        ragged=ragged,
+        compression=compression,
+        chunk_rows=chunk_rows,
+        split_by=split_by,
     )
+    processed = queue.run(func, num_workers)
 
-    with ProcessPoolExecutor(max_workers=num_workers) as pool:
-        for _ in pool.map(func, files, out_files):
-            pass
-
-    print(f"Completed, saved files to {h5_dir}")
+    print(f"Completed {len(processed)} files, saved files to {h5_dir}")
 
 
 if __name__ == "__main__":
@@ -97,6 +100,9 @@ if __name__ == "__main__":
     ```
     python -m genslm.cmdline.fasta_to_h5 --fasta $FASTA_DIR --h5_dir $H5_OUTDIR --tokenizer_file $TOKENIZER_JSON --num_workers $NUM_WORKERS
     ```
+    The same command can run on several nodes at once, they share the files
+    through a task queue in $H5_OUTDIR/.queue. Rerunning it skips the files
+    recorded in the queue's manifest, unless their contents changed.
 
     Gather the files from the step above into a single virtual or combined h5 file
     ```
@@ -114,6 +120,14 @@ if __name__ == "__main__":
     --h5_outfile $H5_OUTFILE # path to save the combined file to
     --gather
     ```
+    ```
+    # Gather into equal sized shards, read with genslm.dataset.ShardedH5Dataset
+    python -m genslm.cmdline.fasta_to_h5
+    --h5_dir $H5_DIR # same h5dir as above, should have more than 1 h5 file in it. All files in dir will be combined
+    --h5_outfile $OUT_DIR/train.json # manifest, the shards are written next to it
+    --gather
+    --shard_gb 4 # or --shard_records / --num_shards
+    ```
     """
     parser = ArgumentParser()
     parser.add_argument("-f", "--fasta_dir", type=Path)
@@ -164,18 +178,66 @@ if __name__ == "__main__":
         type=Path,
         help="Path to the h5 outfile, only specify when gathering",
     )
+    parser.add_argument(
+        "--pack_sequences",
+        action="store_true",
+        help="Store the raw sequences with 2 bits per base instead of as strings",
+    )
+    parser.add_argument(
+        "--ragged",
+        action="store_true",
+        help="Store the tokens without padding (v2 schema)",
+    )
+    parser.add_argument(
+        "--compression",
+        nargs="+",
+        help="Codec of every field or `field=codec`: none, lzf, gzip[:level], "
+        "zstd[:level] or blosc[:compressor[:level]] (defaults to gzip:6)",
+    )
+    parser.add_argument(
+        "--chunk_rows",
+        type=int,
+        help="Records per chunk of the padded tokens (defaults to 256KB chunks)",
+    )
+    parser.add_argument(
+        "--split_by",
+        choices=["sequence", "id"],
+        default="sequence",
+        help="Assign records to train/val/test by a hash of their sequence or id",
+    )
+    parser.add_argument(
+        "--dedup_dir",
+        type=Path,
+        help="Skip the duplicate sequences found by genslm.cmdline.dedup_fasta",
+    )
+    parser.add_argument(
+        "--skip_invalid",
+        action="store_true",
+        help="Leave unreadable or mismatched h5 files out of the gathered file",
+    )
     parser.add_argument("-c", "--check_length", action="store_true")
     parser.add_argument(
-        "--files_per_write",
+        "--num_shards",
         type=int,
-        default=2048,
-        help="Number of files to get before writing them to disk (only for h5 full concatenation)",
+        help="Gather into this many shards, --h5_outfile is then their JSON manifest",
+    )
+    parser.add_argument(
+        "--shard_records", type=int, help="Gather into shards of at most this many rows"
+    )
+    parser.add_argument(
+        "--shard_gb", type=float, help="Gather into shards of about this size"
+    )
+    parser.add_argument(
+        "--buffer_gb",
+        type=float,
+        default=2.0,
+        help="Memory for the data read ahead of the writes (full concatenation or shards)",
     )
 
     args = parser.parse_args()
+    compression = parse_compression(args.compression)
 
     node_rank = int(os.environ.get("NODE_RANK", 0))  # zero indexed
-    num_nodes = int(os.environ.get("NRANKS", 1))
 
     train_val_test_split = {"train": 0.8, "val": 0.1, "test": 0.1}
 
@@ -189,8 +251,8 @@ if __name__ == "__main__":
 
     if args.gather:
         if node_rank != 0:
-            while True:
-                time.sleep(10)
+            print(f"Gathering only runs on node 0, node {node_rank} is done")
+            exit()
 
         print(f"Running on node: {node_rank}")
         if not args.h5_outfile:
@@ -198,19 +260,40 @@ if __name__ == "__main__":
         if not args.h5_dir:
             raise ValueError("H5 in directory not present")
 
-        h5_files = list(args.h5_dir.glob("*.h5"))
-        if args.concatenate:
+        # Sorted so that an interrupted concatenation resumes in the same order
+        h5_files = sorted(args.h5_dir.glob("*.h5"))
+        if args.num_shards or args.shard_records or args.shard_gb:
+            print("Gathering into shards...")
+            H5Dataset.reshard_h5(
+                h5_files,
+                args.h5_outfile,
+                num_shards=args.num_shards,
+                shard_records=args.shard_records,
+                shard_bytes=int(args.shard_gb * (1 << 30)) if args.shard_gb else None,
+                num_workers=args.num_workers,
+                buffer_bytes=int(args.buffer_gb * (1 << 30)),
+                compression=compression,
+                chunk_rows=args.chunk_rows,
+                skip_invalid=args.skip_invalid,
+            )
+        elif args.concatenate:
             print("Gathering and full concatenating...")
             H5Dataset.concatenate_h5(
                 h5_files,
                 args.h5_outfile,
                 num_workers=args.num_workers,
-                files_per_write=args.files_per_write,
+                buffer_bytes=int(args.buffer_gb * (1 << 30)),
+                compression=compression,
+                chunk_rows=args.chunk_rows,
+                skip_invalid=args.skip_invalid,
             )
         else:
             print("Gathering and virtual concatenating...")
             H5Dataset.concatenate_virtual_h5(
-                h5_files, args.h5_outfile, num_workers=args.num_workers
+                h5_files,
+                args.h5_outfile,
+                num_workers=args.num_workers,
+                skip_invalid=args.skip_invalid,
             )
         print(f"Completed gathering {len(h5_files)} files into {args.h5_outfile}")
         exit()
@@ -224,7 +307,11 @@ if __name__ == "__main__":
         args.block_size,
         args.kmer_size,
         train_val_test_split,
-        node_rank,
-        num_nodes,
         args.subsample,
+        args.pack_sequences,
+        args.ragged,
+        compression,
+        args.chunk_rows,
+        args.split_by,
+        args.dedup_dir,
     )
@@ -1,18 +1,21 @@
 from argparse import ArgumentParser
 from pathlib import Path
 
+import torch
+
 from genslm.config import ModelSettings
 from genslm.model import DNATransformer
 from genslm.utils import (
+    KnownSequenceIndex,
     LoadDeepSpeedStrategy,
     LoadPTCheckpointStrategy,
     non_redundant_generation,
-    seqs_to_fasta,
+    unique_proportion,
 )
 
 
 def main():
-    if torch.cuda.device_count()==0:
+    if torch.cuda.device_count() == 0:
         print("No Cuda Device is detected for inference")
         return
     parser = ArgumentParser()
@@ -34,6 +37,12 @@ def main():
         nargs="+",
         help="Space separated list of known sequence files.",
     )
+    parser.add_argument(
+        "--known_sequence_index",
+        type=Path,
+        help="Index built by genslm.cmdline.build_known_sequence_index, "
+        "used instead of known_sequence_files.",
+    )
     parser.add_argument(
         "-g",
         "--selected_gpu",
@@ -71,12 +80,18 @@ def main():
             print(i)
         print("Using known sequence files: {}".format(args.known_sequence_files))
 
+    known_sequence_index = None
+    if args.known_sequence_index is not None:
+        known_sequence_index = KnownSequenceIndex.load(args.known_sequence_index)
+        print(f"Using known sequence index: {args.known_sequence_index}")
+
     # Generate sequences using the model
     results = non_redundant_generation(
         model.model,
         model.tokenizer,
         num_seqs=args.num_seqs,
         known_sequence_files=args.known_sequence_files,
+        known_sequence_index=known_sequence_index,
         start_sequence=None,
         to_stop_codon=False,
         max_length=config.block_size,
@@ -84,11 +99,10 @@ def main():
         custom_seq_name=args.name_prefix,
         temperature=args.temperature,
     )
-    unique_seqs, all_seqs = results["unique_seqs"], results["all_generated_seqs"]
-    print(f"Proportion of unique seqs: {len(unique_seqs) / len(all_seqs)}")
-
-    # Write fasta with unique sequences to disk
-    seqs_to_fasta(unique_seqs, args.output_fasta, custom_seq_name=args.name_prefix)
+    # Over the sequences generated by this run, not the resumed ones
+    proportion = unique_proportion(results)
+    if proportion is not None:
+        print(f"Proportion of unique seqs: {proportion}")
 
 
 if __name__ == "__main__":
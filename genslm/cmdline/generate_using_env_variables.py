@@ -6,10 +6,11 @@ from pathlib import Path
 from genslm.config import ModelSettings
 from genslm.model import DNATransformer
 from genslm.utils import (
+    KnownSequenceIndex,
     LoadDeepSpeedStrategy,
     LoadPTCheckpointStrategy,
     non_redundant_generation,
-    seqs_to_fasta,
+    unique_proportion,
 )
 
 
@@ -33,6 +34,12 @@ def main():
         nargs="+",
         help="Space separated list of known sequence files.",
     )
+    parser.add_argument(
+        "--known_sequence_index",
+        type=Path,
+        help="Index built by genslm.cmdline.build_known_sequence_index, "
+        "used instead of known_sequence_files.",
+    )
     parser.add_argument("--top_k", default=50, type=int)
     parser.add_argument("--top_p", default=0.95, type=float)
     args = parser.parse_args()
@@ -87,6 +94,11 @@ def main():
             print(i)
         print("Using known sequence files: {}".format(args.known_sequence_files))
 
+    known_sequence_index = None
+    if args.known_sequence_index is not None:
+        known_sequence_index = KnownSequenceIndex.load(args.known_sequence_index)
+        print(f"Using known sequence index: {args.known_sequence_index}")
+
     # Generate sequences using the model
     try:
         results = non_redundant_generation(
@@ -94,6 +106,7 @@ def main():
             model.tokenizer,
             num_seqs=args.num_seqs,
             known_sequence_files=args.known_sequence_files,
+            known_sequence_index=known_sequence_index,
             start_sequence=None,
             to_stop_codon=False,
             max_length=config.block_size,
@@ -103,11 +116,10 @@ def main():
             top_p=args.top_p,
             top_k=args.top_k,
         )
-        unique_seqs, all_seqs = results["unique_seqs"], results["all_generated_seqs"]
-        print(f"Proportion of unique seqs: {len(unique_seqs) / len(all_seqs)}")
-
-        # Write fasta with unique sequences to disk
-        seqs_to_fasta(unique_seqs, args.output_fasta, custom_seq_name=args.name_prefix)
+        # Over the sequences generated by this run, not the resumed ones
+        proportion = unique_proportion(results)
+        if proportion is not None:
+            print(f"Proportion of unique seqs: {proportion}")
     except Exception:
         print(
             "Failure generating on {}, rank {}".format(socket.gethostname(), pmi_rank)
@@ -1,4 +1,4 @@
-"""Example usage: python -m genslm.cmdline.h5_to_fasta -i /path/to/h5_dir -o ouput.fasta -w 32 -s 250"""
+"""Example usage: python -m genslm.cmdline.h5_to_fasta -i /path/to/h5_dir -o ouput.fasta.gz -w 32 -s 250"""
 from argparse import ArgumentParser
 from pathlib import Path
 
@@ -7,12 +7,33 @@ from genslm.dataset import H5Dataset
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("-i", "--h5_dir", type=str, help="Directory with *.h5 files")
-    parser.add_argument("-o", "--output_file", type=Path, help="fasta file.")
+    parser.add_argument(
+        "-o", "--output_file", type=Path, help="fasta file, gzipped if it ends in .gz"
+    )
     parser.add_argument("-w", "--num_workers", type=int, default=1)
     parser.add_argument("-s", "--num_slice", type=int, default=1)
+    parser.add_argument(
+        "-c",
+        "--chunk_rows",
+        type=int,
+        default=8192,
+        help="Records converted by a worker at once",
+    )
+    parser.add_argument(
+        "--skip_invalid",
+        action="store_true",
+        help="Leave out unreadable h5 files instead of failing",
+    )
     args = parser.parse_args()
 
-    input_files = list(Path(args.h5_dir).glob("*.h5"))
-    H5Dataset.h5_to_fasta(
-        input_files, args.output_file, args.num_workers, args.num_slice
+    # Sorted so that the output does not depend on the directory listing
+    input_files = sorted(Path(args.h5_dir).glob("*.h5"))
+    num_records = H5Dataset.h5_to_fasta(
+        input_files,
+        args.output_file,
+        args.num_workers,
+        args.num_slice,
+        chunk_rows=args.chunk_rows,
+        skip_invalid=args.skip_invalid,
     )
+    print(f"Wrote {num_records} records to {args.output_file}")
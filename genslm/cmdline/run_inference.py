@@ -6,7 +6,7 @@ import uuid
 from argparse import ArgumentParser
 from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, List, Tuple
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 import h5py
 import numpy as np
@@ -16,12 +16,20 @@ import torch.multiprocessing as mp
 from natsort import natsorted
 from pytorch_lightning.callbacks import Callback
 from torch.utils.data import DataLoader, Dataset  # Subset
-from tqdm import tqdm
+from torch.utils.data.dataloader import default_collate
 from transformers import PreTrainedTokenizerFast
+from transformers.utils import ModelOutput
 
 from genslm.config import BaseSettings, path_validator
 from genslm.inference import GenSLM
-from genslm.utils import read_fasta_only_seq
+from genslm.tokenizer import KmerTokenizer, TokenCache
+from genslm.utils import (
+    SequenceStore,
+    file_fingerprints,
+    load_fasta_indices,
+    read_fasta_entry,
+    read_fasta_files_only_seq,
+)
 
 
 class InferenceConfig(BaseSettings):
@@ -58,12 +66,49 @@ class InferenceConfig(BaseSettings):
     """Number of batches loaded in advance by each worker."""
     pin_memory: bool = True
     """If True, the data loader will copy Tensors into device/CUDA pinned memory before returning them."""
+    fasta_index: bool = False
+    """If True, index the fasta files and read sequences on demand instead of
+    loading every sequence into memory on each rank."""
+    sequence_cache: Optional[Path] = None
+    """If set, the sequences are parsed once and stored in this directory, which
+    all ranks (and later runs) memory map instead of parsing the fasta files.
+    The store is rebuilt if the fasta files changed since it was written. The
+    first rank of each node builds it, so it may be node-local or shared."""
+    cache_timeout: float = 3600.0
+    """Seconds the other ranks wait for the first rank of their node to build
+    the sequence_cache or populate the token_cache before failing."""
+    num_read_workers: int = 1
+    """Number of processes to use for reading (or indexing) the fasta files."""
+    token_cache: Optional[Path] = None
+    """If set, tokenized sequences are cached in this directory keyed by their
+    MD5 hash and tokenizer, so later runs (or other models with the same
+    tokenizer) read the token ids instead of tokenizing again."""
+    sort_by_length: bool = False
+    """If True, run the sequences from longest to shortest and pad each batch
+    only to its longest sequence instead of the model sequence length."""
+    pad_to_multiple_of: int = 8
+    """With sort_by_length, batches are padded to a multiple of this length."""
+    window_stride: Optional[int] = None
+    """If set, sequences longer than the model are split into overlapping windows
+    starting every window_stride k-mers instead of being truncated. The outputs
+    of the windows are averaged where they overlap into one output per sequence.
+    The batch size then counts sequences, each of which may have several windows,
+    the model still sees at most batch_size windows per forward pass."""
 
     # validators
     _data_file_exists = path_validator("data_file")
     _model_cache_dir_exists = path_validator("model_cache_dir")
 
 
+def wait_until(ready: Callable[[], bool], timeout: float, message: str) -> None:
+    """Poll `ready` every second, raise a TimeoutError after `timeout` seconds."""
+    deadline = time.monotonic() + timeout
+    while not ready():
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"{message} within {timeout} seconds")
+        time.sleep(1)
+
+
 class InferenceSequenceDataset(Dataset):
     """Dataset initialized from fasta files."""
 
@@ -73,47 +118,185 @@ class InferenceSequenceDataset(Dataset):
         seq_length: int,
         tokenizer: PreTrainedTokenizerFast,
         kmer_size: int = 3,
+        use_index: bool = False,
+        sequence_cache: Optional[Path] = None,
+        num_workers: int = 1,
+        token_cache: Optional[Path] = None,
+        sort_by_length: bool = False,
+        window_stride: Optional[int] = None,
+        local_rank: int = 0,
+        cache_timeout: float = 3600.0,
     ):
+        if token_cache is not None and window_stride is not None:
+            raise ValueError("token_cache does not support window_stride")
+
+        self.kmer_size = kmer_size
+        self.window_stride = window_stride
+        self.use_index = use_index
+
+        if use_index:
+            # Only keep the byte offsets of each record in memory and
+            # read the sequences from disk as they are requested
+            self.fasta_files = self.get_fasta_files(fasta_path)
+            self.offsets = load_fasta_indices(self.fasta_files, num_workers)
+            self.file_starts = np.cumsum([0] + [len(o) - 1 for o in self.offsets])
+            self._open_file: Optional[Tuple[int, IO[bytes]]] = None
+        elif sequence_cache is not None:
+            # The first rank of each node parses the fasta files (again if
+            # they changed since the store was written), the other ranks wait
+            # for the store and memory map the packed sequences
+            source = file_fingerprints(self.get_fasta_files(fasta_path))
+            if local_rank == 0 and SequenceStore.read_source(sequence_cache) != source:
+                SequenceStore.write(
+                    self.read_sequences(fasta_path, num_workers),
+                    sequence_cache,
+                    source=source,
+                    overwrite=True,
+                )
+            wait_until(
+                lambda: SequenceStore.read_source(sequence_cache) == source,
+                cache_timeout,
+                f"{sequence_cache} was not written by the first rank of the node",
+            )
+            self.raw_sequences = SequenceStore(sequence_cache)
+        else:
+            # Read all fasta files into memory as strings
+            self.raw_sequences = self.read_sequences(fasta_path, num_workers)
+
+        # Wait to tokenize until a specific batch is requested
+        self.seq_length = seq_length
+        self.tokenizer = KmerTokenizer(tokenizer)
+
+        self.token_cache: Optional[TokenCache] = None
+        if token_cache is not None:
+            # The first rank of each node tokenizes anything not seen before,
+            # the other ranks wait for it. Afterwards only the locations of
+            # the cached tokens are needed
+            cache = TokenCache(token_cache, self.tokenizer, kmer_size, seq_length)
+            self.na_hashes, self.cache_locations = cache.update(
+                self.iter_sequences(), tokenize=local_rank == 0
+            )
+            if local_rank != 0:
 
-        # Read all fasta files into memory as strings
-        self.raw_sequences = self.read_sequences(fasta_path)
-        # Quick transformation to group sequences by kmers
-        self.sequences = [
-            self.group_by_kmer(seq, kmer_size) for seq in self.raw_sequences
-        ]
-
-        # Define tokenizer function, but wait to tokenize
-        # until a specific batch is requested
-        self.tokenizer_fn = functools.partial(
-            tokenizer,
-            max_length=seq_length,
-            padding="max_length",
-            truncation=True,
-            return_tensors="pt",
-        )
+                def cached() -> bool:
+                    cache.reload()
+                    self.cache_locations = cache.lookup(self.na_hashes)
+                    return bool((self.cache_locations[:, 0] >= 0).all())
+
+                wait_until(
+                    cached,
+                    cache_timeout,
+                    f"{token_cache} was not populated by the first rank of the node",
+                )
+            self.token_cache = cache
+            if not use_index:
+                self.raw_sequences = []
+
+        self.order: Optional[np.ndarray] = None
+        if sort_by_length:
+            # Consecutive samples (and the strided samples of each rank
+            # under a DistributedSampler) then have similar lengths
+            self.order = np.argsort(-self.token_lengths(), kind="stable")
 
     @staticmethod
-    def read_sequences(fasta_path: Path) -> List[str]:
-        sequences = []
+    def get_fasta_files(fasta_path: Path) -> List[Path]:
         if fasta_path.is_dir():
-            fasta_files = natsorted(fasta_path.glob("*.fasta"))
-            for fasta_file in tqdm(fasta_files, desc="Reading fasta files..."):
-                sequences.extend(read_fasta_only_seq(fasta_file))
-        else:
-            sequences = read_fasta_only_seq(fasta_path)
-        return sequences
+            return natsorted(fasta_path.glob("*.fasta"))
+        return [fasta_path]
+
+    @staticmethod
+    def read_sequences(fasta_path: Path, num_workers: int = 1) -> List[str]:
+        # Files are parsed in parallel and concatenated in natsort
+        # order so that fasta-indices map back to the same records
+        fasta_files = InferenceSequenceDataset.get_fasta_files(fasta_path)
+        return read_fasta_files_only_seq(fasta_files, num_workers)
 
     @staticmethod
     def group_by_kmer(seq: str, kmer: int) -> str:
         return " ".join(seq[i : i + kmer] for i in range(0, len(seq), kmer)).upper()
 
+    def __getstate__(self) -> Dict[str, Any]:
+        # File handles cannot be sent to data loader workers
+        state = self.__dict__.copy()
+        state["_open_file"] = None
+        return state
+
+    def read_indexed_sequence(self, idx: int) -> str:
+        file_idx = int(np.searchsorted(self.file_starts, idx, side="right")) - 1
+        # Keep the most recently used file open since samplers
+        # tend to walk through the files in order
+        if self._open_file is None or self._open_file[0] != file_idx:
+            if self._open_file is not None:
+                self._open_file[1].close()
+            self._open_file = (file_idx, open(self.fasta_files[file_idx], "rb"))
+
+        offsets = self.offsets[file_idx]
+        record = idx - self.file_starts[file_idx]
+        _, seq = read_fasta_entry(
+            self._open_file[1], offsets[record], offsets[record + 1]
+        )
+        return seq
+
+    def iter_sequences(self) -> Iterator[str]:
+        for idx in range(len(self)):
+            if self.use_index:
+                yield self.read_indexed_sequence(idx)
+            else:
+                yield self.raw_sequences[idx]
+
+    def token_lengths(self) -> np.ndarray:
+        """Number of tokens of each sequence, estimated unless cached."""
+        if self.token_cache is not None:
+            return self.token_cache.token_lengths(self.cache_locations)
+        if self.use_index:
+            # The record size in bytes (including the header) is close enough
+            num_chars = np.concatenate([np.diff(o) for o in self.offsets])
+        elif isinstance(self.raw_sequences, SequenceStore):
+            num_chars = np.diff(self.raw_sequences.offsets)
+        else:
+            num_chars = np.array([len(seq) for seq in self.raw_sequences])
+        num_tokens = -(-num_chars // self.kmer_size) + self.tokenizer.num_special_tokens
+        if self.window_stride is not None:
+            # Longer sequences have more windows instead of being truncated
+            return num_tokens
+        return np.minimum(num_tokens, self.seq_length)
+
     def __len__(self) -> int:
-        return len(self.sequences)
+        if self.token_cache is not None:
+            return len(self.na_hashes)
+        if self.use_index:
+            return int(self.file_starts[-1])
+        return len(self.raw_sequences)
 
     def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
-        raw_seq = self.raw_sequences[idx]
-        seq = self.sequences[idx]
-        batch_encoding = self.tokenizer_fn(seq)
+        if self.order is not None:
+            idx = int(self.order[idx])
+
+        if self.token_cache is not None:
+            segment, row = self.cache_locations[idx]
+            na_hash = self.na_hashes[idx]
+            encoding = self.token_cache.get(segment, row, na_hash)
+            na_hash = na_hash.decode("ascii")
+        else:
+            if self.use_index:
+                raw_seq = self.read_indexed_sequence(idx)
+            else:
+                raw_seq = self.raw_sequences[idx]
+            if self.window_stride is not None:
+                encoding = self.tokenizer.windows(
+                    raw_seq, self.kmer_size, self.seq_length, self.window_stride
+                )
+            else:
+                encoding = self.tokenizer([raw_seq], self.kmer_size, self.seq_length)
+            # Need raw string for hashing
+            na_hash = hashlib.md5(raw_seq.encode("utf-8")).hexdigest()
+
+        if "positions" in encoding:
+            return self.get_windows(encoding, idx, na_hash)
+
+        batch_encoding = {
+            key: torch.from_numpy(value) for key, value in encoding.items()
+        }
         # Squeeze so that batched tensors end up with (batch_size, seq_length)
         # instead of (batch_size, 1, seq_length)
         sample = {
@@ -121,11 +304,118 @@ class InferenceSequenceDataset(Dataset):
             "attention_mask": batch_encoding["attention_mask"],
             "indices": torch.from_numpy(np.array([idx])),
             "seq_lens": batch_encoding["attention_mask"].sum(1),
-            # Need raw string for hashing
-            "na_hash": hashlib.md5(raw_seq.encode("utf-8")).hexdigest(),
+            "na_hash": na_hash,
         }
         return sample
 
+    @staticmethod
+    def get_windows(
+        encoding: Dict[str, np.ndarray], idx: int, na_hash: str
+    ) -> Dict[str, Any]:
+        # All windows of a sequence stay in one sample so that they
+        # end up in the same batch (and rank) to be stitched together
+        positions = encoding["positions"]
+        return {
+            "input_ids": torch.from_numpy(encoding["input_ids"]),
+            "attention_mask": torch.from_numpy(encoding["attention_mask"][:, None]),
+            "positions": torch.from_numpy(positions),
+            "indices": torch.from_numpy(np.array([idx])),
+            "seq_lens": torch.from_numpy(np.array([positions.max() + 1])),
+            "num_windows": torch.from_numpy(np.array([len(positions)])),
+            "na_hash": na_hash,
+        }
+
+
+def _trim_padding(
+    collated: Dict[str, Any], max_seq_len: int, pad_to_multiple_of: int
+) -> Dict[str, Any]:
+    # Samples are right padded so the remaining positions are unchanged
+    max_length = collated["input_ids"].shape[-1]
+    length = -(-max_seq_len // pad_to_multiple_of) * pad_to_multiple_of
+    for key in ["input_ids", "attention_mask", "positions"]:
+        if key in collated:
+            collated[key] = collated[key][..., : min(length, max_length)].contiguous()
+    return collated
+
+
+def pad_to_longest_collate_fn(
+    batch: List[Dict[str, Any]], pad_to_multiple_of: int = 8
+) -> Dict[str, Any]:
+    """Collate samples and drop the padding beyond the longest sequence.
+
+    The length is rounded up to a multiple of `pad_to_multiple_of`. Samples
+    are right padded so the remaining positions are unchanged.
+    """
+    collated = default_collate(batch)
+    max_seq_len = int(collated["seq_lens"].max())
+    return _trim_padding(collated, max_seq_len, pad_to_multiple_of)
+
+
+def window_collate_fn(
+    batch: List[Dict[str, Any]], pad_to_multiple_of: int = 8
+) -> Dict[str, Any]:
+    """Collate the windows of all samples into one batch for the model.
+
+    The windows are concatenated in sample order, `num_windows` tells how
+    many belong to each sample. Padding beyond the longest window is
+    dropped as in :obj:`pad_to_longest_collate_fn`.
+    """
+    windowed = ["input_ids", "attention_mask", "positions"]
+    collated = default_collate(
+        [{k: v for k, v in sample.items() if k not in windowed} for sample in batch]
+    )
+    for key in windowed:
+        collated[key] = torch.cat([sample[key] for sample in batch])
+    max_seq_len = int(collated["attention_mask"].sum(-1).max())
+    return _trim_padding(collated, max_seq_len, pad_to_multiple_of)
+
+
+def stitch_windows(outputs: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """Average the outputs of overlapping windows into one output per token.
+
+    Parameters
+    ----------
+    outputs : np.ndarray
+        The (num_windows, window_length, ...) outputs of a sequence's windows.
+    positions : np.ndarray
+        The (num_windows, window_length) position of each window token in
+        the full sequence, -1 for padding.
+
+    Returns
+    -------
+    np.ndarray
+        The (seq_len, ...) outputs of the full sequence.
+    """
+    seq_len = int(positions.max()) + 1
+    total = np.zeros((seq_len,) + outputs.shape[2:], dtype=np.float64)
+    for output, position in zip(outputs, positions):
+        valid = position >= 0
+        total[position[valid]] += output[valid]
+    counts = np.bincount(positions[positions >= 0], minlength=seq_len)
+    counts = counts.reshape((seq_len,) + (1,) * (outputs.ndim - 2))
+    return (total / counts).astype(outputs.dtype)
+
+
+def iter_sequence_outputs(
+    outputs: np.ndarray, batch: Dict[str, Any]
+) -> Iterator[np.ndarray]:
+    """Yield the unpadded outputs of each sequence in a batch.
+
+    Windowed sequences (see :obj:`window_collate_fn`) are stitched back
+    together with :obj:`stitch_windows`.
+    """
+    seq_lens = batch["seq_lens"].detach().cpu().numpy().reshape(-1)
+    if "positions" not in batch:
+        for output, seq_len in zip(outputs, seq_lens):
+            yield output[:seq_len]
+        return
+
+    positions = batch["positions"].detach().cpu().numpy()
+    num_windows = batch["num_windows"].detach().cpu().numpy().reshape(-1)
+    splits = np.cumsum(num_windows)[:-1]
+    for output, position in zip(np.split(outputs, splits), np.split(positions, splits)):
+        yield stitch_windows(output, position)
+
 
 def _read_average_embedding_process_fn(
     chunk_idxs: Tuple[int, int],
@@ -140,6 +430,10 @@ def _read_average_embedding_process_fn(
         group = f["embeddings"]
         for i, idx in enumerate(map(str, range(*chunk_idxs))):
             seqlen = group[idx].shape[0]
+            if seqlen > model_seq_len:
+                # Stitched windows of a sequence longer than the model
+                embs[i] = group[idx][...].mean(axis=0)
+                continue
             f[f"embeddings/{idx}"].read_direct(emb, dest_sel=np.s_[:seqlen])
             embs[i] = emb[:seqlen].mean(axis=0)
     return embs
@@ -177,7 +471,9 @@ def read_average_embeddings(
     with h5py.File(h5_file_path, "r") as h5_file:
         total_embeddings = len(h5_file["embeddings"])
         if return_md5:
-            out_data["na-hashes"] = h5_file["na-hashes"][...]
+            # Hashes are stored in batch order, embeddings are read by index
+            order = np.argsort(h5_file["fasta-indices"][...], kind="stable")
+            out_data["na-hashes"] = h5_file["na-hashes"][...][order]
 
     chunk_size = max(1, total_embeddings // num_workers)
     chunk_idxs = [
@@ -230,6 +526,10 @@ def read_full_embeddings(
 ) -> Dict[str, np.ndarray]:
     """Read token level embeddings from an HDF5 file.
 
+        The embeddings are zero padded to `seq_len`, or to the longest
+        sequence if sequences longer than the model were stitched from
+        sliding windows.
+
         Parameters
         ----------
         h5_file_path : Path
@@ -251,7 +551,13 @@ def read_full_embeddings(
     with h5py.File(h5_file_path, "r") as h5_file:
         total_embeddings = len(h5_file["embeddings"])
         if return_md5:
-            out_data["na-hashes"] = h5_file["na-hashes"][...]
+            # Hashes are stored in batch order, embeddings are read by index
+            order = np.argsort(h5_file["fasta-indices"][...], kind="stable")
+            out_data["na-hashes"] = h5_file["na-hashes"][...][order]
+        # Stitched windows are longer than the model
+        seq_len = max(
+            [seq_len] + [dset.shape[0] for dset in h5_file["embeddings"].values()]
+        )
 
     chunk_size = max(1, total_embeddings // num_workers)
     chunk_idxs = [
@@ -340,7 +646,6 @@ class OutputsCallback(Callback):
         dataloader_idx: int,
     ) -> None:
         # outputs.hidden_states: (layer, batch_size, sequence_length, hidden_size)
-        seq_lens = batch["seq_lens"].detach().cpu().numpy().reshape(-1)
         fasta_inds = batch["indices"].detach().cpu().numpy().reshape(-1)
 
         if self.output_attentions:
@@ -350,9 +655,11 @@ class OutputsCallback(Callback):
         if self.output_logits:
             start = time.time()
             logits = outputs.logits.detach().cpu().numpy()
-            for logit, seq_len, fasta_ind in zip(logits, seq_lens, fasta_inds):
+            for logit, fasta_ind in zip(
+                iter_sequence_outputs(logits, batch), fasta_inds
+            ):
                 self.h5logit_file["logits"].create_dataset(
-                    f"{fasta_ind}", data=logit[:seq_len], **self.h5_kwargs
+                    f"{fasta_ind}", data=logit, **self.h5_kwargs
                 )
             self.io_time += time.time() - start
 
@@ -373,9 +680,11 @@ class OutputsCallback(Callback):
                     self.h5embeddings_open[layer] = h5_file
 
                 embed = embeddings.detach().cpu().numpy()
-                for emb, seq_len, fasta_ind in zip(embed, seq_lens, fasta_inds):
+                for emb, fasta_ind in zip(
+                    iter_sequence_outputs(embed, batch), fasta_inds
+                ):
                     h5_file["embeddings"].create_dataset(
-                        f"{fasta_ind}", data=emb[:seq_len], **self.h5_kwargs
+                        f"{fasta_ind}", data=emb, **self.h5_kwargs
                     )
 
                 h5_file.flush()
@@ -420,18 +729,50 @@ class OutputsCallback(Callback):
         print("IO time:\t", self.io_time)
 
 
+def concat_outputs(outputs: List[ModelOutput]) -> ModelOutput:
+    """Concatenate the per-sample outputs of several forward passes.
+
+    Only the logits, hidden states and attentions are kept, the loss and
+    the past key values of a micro batch do not apply to the whole batch.
+    """
+    first = outputs[0]
+    concatenated: Dict[str, Any] = {}
+    if first.get("logits") is not None:
+        concatenated["logits"] = torch.cat([o.logits for o in outputs])
+    for key in ["hidden_states", "attentions"]:
+        if first.get(key) is not None:
+            concatenated[key] = tuple(
+                torch.cat(layers) for layers in zip(*(o[key] for o in outputs))
+            )
+    return type(first)(**concatenated)
+
+
 class LightningGenSLM(pl.LightningModule):
     """Lightning wrapper to facilitate distributed prediction."""
 
-    def __init__(self, model: GenSLM) -> None:
+    def __init__(self, model: GenSLM, micro_batch_size: Optional[int] = None) -> None:
         super().__init__()
         self.model = model
+        # Collated windows can hold many more rows than the batch size,
+        # run them through the model in chunks to bound the memory use
+        self.micro_batch_size = micro_batch_size
 
     def forward(self, *args, **kwargs) -> Any:
         return self.model(*args, **kwargs)
 
     def predict_step(self, batch: Dict[str, torch.Tensor], batch_idx: int) -> Any:
-        return self(batch["input_ids"], batch["attention_mask"])
+        input_ids, attention_mask = batch["input_ids"], batch["attention_mask"]
+        if self.micro_batch_size is None or len(input_ids) <= self.micro_batch_size:
+            return self(input_ids, attention_mask)
+        return concat_outputs(
+            [
+                self(ids, mask)
+                for ids, mask in zip(
+                    input_ids.split(self.micro_batch_size),
+                    attention_mask.split(self.micro_batch_size),
+                )
+            ]
+        )
 
 
 def main(config: InferenceConfig) -> None:
@@ -450,12 +791,12 @@ def main(config: InferenceConfig) -> None:
         output_hidden_states=config.output_embeddings,
         output_attentions=config.output_attentions,
     )
-    ptl_model = LightningGenSLM(model)
+    ptl_model = LightningGenSLM(model, micro_batch_size=config.batch_size)
 
     # Create callback to save model outputs to disk
     outputs_callback = OutputsCallback(
         save_dir=config.output_path,
-        layer_bounds=config.layer_bounds,
+        layers=config.layers,
         output_embeddings=config.output_embeddings,
         output_attentions=config.output_attentions,
         output_logits=config.output_logits,
@@ -473,17 +814,38 @@ def main(config: InferenceConfig) -> None:
     )
 
     # This dataset loads each sequence from each fasta file into memory
-    # as strings on each rank and then tokenizes on-the-fly.
+    # as strings on each rank (or reads them on demand with fasta_index)
+    # and then tokenizes on-the-fly.
     dataset = InferenceSequenceDataset(
-        config.data_file, model.seq_length, model.tokenizer
+        config.data_file,
+        model.seq_length,
+        model.tokenizer,
+        use_index=config.fasta_index,
+        sequence_cache=config.sequence_cache,
+        num_workers=config.num_read_workers,
+        token_cache=config.token_cache,
+        sort_by_length=config.sort_by_length,
+        window_stride=config.window_stride,
+        local_rank=trainer.local_rank,
+        cache_timeout=config.cache_timeout,
     )
     # dataset = Subset(dataset, np.arange(512))  # for testing
+    collate_fn = None
+    if config.window_stride is not None:
+        collate_fn = functools.partial(
+            window_collate_fn, pad_to_multiple_of=config.pad_to_multiple_of
+        )
+    elif config.sort_by_length:
+        collate_fn = functools.partial(
+            pad_to_longest_collate_fn, pad_to_multiple_of=config.pad_to_multiple_of
+        )
     dataloader = DataLoader(
         dataset,
         batch_size=config.batch_size,
         num_workers=config.num_data_workers,
         prefetch_factor=config.prefetch_factor,
         pin_memory=config.pin_memory,
+        collate_fn=collate_fn,
     )
 
     if trainer.is_global_zero:
@@ -6,7 +6,7 @@ import torch  # noqa
 from tokenizers import Tokenizer
 from transformers import PreTrainedTokenizerFast
 
-from genslm.dataset import H5PreprocessMixin
+from genslm.dataset import H5PreprocessMixin, parse_compression
 
 if __name__ == "__main__":
     parser = ArgumentParser()
@@ -41,6 +41,38 @@ if __name__ == "__main__":
         help="Whether to not have test, but only validation split with 20%",
         action="store_true",
     )
+    parser.add_argument(
+        "--pack_sequences",
+        help="Store the raw sequences with 2 bits per base instead of as strings",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--ragged",
+        help="Store the tokens without padding (v2 schema)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--compression",
+        nargs="+",
+        help="Codec of every field or `field=codec`: none, lzf, gzip[:level], "
+        "zstd[:level] or blosc[:compressor[:level]] (defaults to gzip:6)",
+    )
+    parser.add_argument(
+        "--chunk_rows",
+        type=int,
+        help="Records per chunk of the padded tokens (defaults to 256KB chunks)",
+    )
+    parser.add_argument(
+        "--split_by",
+        choices=["sequence", "id"],
+        default="sequence",
+        help="Assign records to train/val/test by a hash of their sequence or id",
+    )
+    parser.add_argument(
+        "--keep_mask",
+        type=Path,
+        help="Keep-mask of the fasta records written by genslm.cmdline.dedup_fasta",
+    )
     args = parser.parse_args()
 
     tokenizer = PreTrainedTokenizerFast(
@@ -64,4 +96,10 @@ if __name__ == "__main__":
         args.subsample,
         args.num_workers,
         train_val_test_split=train_test_val_split,
+        pack_sequences=args.pack_sequences,
+        ragged=args.ragged,
+        compression=parse_compression(args.compression),
+        chunk_rows=args.chunk_rows,
+        split_by=args.split_by,
+        keep_mask=args.keep_mask,
     )
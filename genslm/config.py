@@ -202,6 +202,9 @@ class ModelSettings(BaseSettings):
     """Number of sequences to generate per GPU when testing."""
     custom_seq_name: str = "SyntheticSeq"
     """Custum sequence name to write into fasta files for generate sequences."""
+    known_sequence_index: Optional[Path] = None
+    """Index of known sequences (see genslm.cmdline.build_known_sequence_index)
+    that generated sequences are checked against for novelty."""
 
     # training ops (see PyTorch DataLoader for details.)
     num_data_workers: int = 4
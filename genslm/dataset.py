@@ -1,160 +1,1174 @@
+import bisect
 import functools
+import gzip
+import hashlib
+import inspect
+import json
+import os
 import time
 import warnings
-from collections import defaultdict
-from concurrent.futures import ProcessPoolExecutor
+import zlib
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from contextlib import ExitStack
+from itertools import compress, islice, takewhile
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import h5py
 import numpy as np
 import torch
-from Bio import SeqIO  # type: ignore[import]
+import transformers
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
 from tqdm import tqdm
-from transformers import BatchEncoding, PreTrainedTokenizerFast
+from transformers import PreTrainedTokenizerFast
 
 from genslm.config import PathLike
+from genslm.tokenizer import KmerTokenizer
+from genslm.utils import (
+    Sequence,
+    check_keep_mask,
+    count_fasta_records,
+    iter_fasta,
+    load_fasta_index,
+    read_fasta_entry,
+)
+
+try:
+    # Registers the Blosc and Zstd filters, also needed to read files using them
+    import hdf5plugin  # type: ignore[import]
+except ImportError:
+    hdf5plugin = None
 
 
-# TODO: Remove dependecy for BioPython
 # NOTE: Legacy H5 conversion code
-def group_by_kmer(s: SeqIO.SeqRecord, n: int) -> str:
-    seq = str(s.seq).upper()  # need to make sure it's in upper case
+def group_by_kmer(s: Sequence, n: int) -> str:
+    seq = s.sequence.upper()  # need to make sure it's in upper case
     return " ".join(seq[i : i + n] for i in range(0, len(seq), n))
 
 
-class H5PreprocessMixin:
-    @staticmethod
-    def train_val_test_split(
-        seqs: List[str], train_pct: float, val_pct: float
-    ) -> Dict[str, List[str]]:
-        np.random.seed(42)
-        shuffled_inds = np.arange(len(seqs))
-        np.random.shuffle(shuffled_inds)
-        train_ind = round(len(seqs) * train_pct)
-        val_ind = train_ind + round(len(seqs) * val_pct)
-        split = {
-            "train": [seqs[i] for i in shuffled_inds[:train_ind]],
-            "val": [seqs[i] for i in shuffled_inds[train_ind:val_ind]],
-            "test": [seqs[i] for i in shuffled_inds[val_ind:]],
-        }
-        return split
+# 2-bit codes of the unambiguous bases, anything else is stored as an exception
+_BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+_BASE_CODES = np.full(256, 255, dtype=np.uint8)
+_BASE_CODES[_BASES] = np.arange(4, dtype=np.uint8)
+
+PACKED_SEQUENCE_FIELDS = [
+    "sequence_packed",
+    "sequence_lengths",
+    "sequence_exception_counts",
+    "sequence_exception_positions",
+    "sequence_exception_bases",
+]
+
+
+def pack_nucleotides(sequences: List[str]) -> Dict[str, np.ndarray]:
+    """Pack nucleotide sequences into 2 bits per base.
+
+    Each sequence starts on a byte boundary of the flat `sequence_packed`
+    buffer. Bases other than A, C, G and T (e.g. N or lower case) are
+    kept exactly through a per-sequence exception list. All fields are
+    one dimensional so files can be concatenated along the first axis.
+    """
+    encoded = [seq.encode("utf-8") for seq in sequences]
+    lengths = np.array([len(seq) for seq in encoded], dtype=np.int64)
+    starts = np.cumsum(lengths) - lengths
+    raw = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    codes = _BASE_CODES[raw]
+
+    # Record the exceptions relative to the start of their sequence
+    exception_inds = np.flatnonzero(codes == 255)
+    exception_seqs = np.searchsorted(starts, exception_inds, side="right") - 1
+    exception_counts = np.bincount(exception_seqs, minlength=len(lengths))
+    codes[exception_inds] = 0
+
+    # Pad each sequence to a multiple of 4 bases, then pack 4 bases per byte
+    padded_lengths = (lengths + 3) // 4 * 4
+    padded_starts = np.cumsum(padded_lengths) - padded_lengths
+    padded = np.zeros(int(padded_lengths.sum()), dtype=np.uint8)
+    padded[np.arange(len(raw)) + np.repeat(padded_starts - starts, lengths)] = codes
+    quads = padded.reshape(-1, 4)
+    packed = quads[:, 0] << 6 | quads[:, 1] << 4 | quads[:, 2] << 2 | quads[:, 3]
+
+    return {
+        "sequence_packed": packed.astype(np.uint8),
+        "sequence_lengths": lengths,
+        "sequence_exception_counts": exception_counts.astype(np.int32),
+        "sequence_exception_positions": (
+            exception_inds - starts[exception_seqs]
+        ).astype(np.int64),
+        "sequence_exception_bases": raw[exception_inds],
+    }
+
+
+def unpack_nucleotides(
+    sequence_packed: np.ndarray,
+    sequence_lengths: np.ndarray,
+    sequence_exception_counts: np.ndarray,
+    sequence_exception_positions: np.ndarray,
+    sequence_exception_bases: np.ndarray,
+) -> List[str]:
+    """Inverse of :obj:`pack_nucleotides`."""
+    shifts = np.array([6, 4, 2, 0], dtype=np.uint8)
+    codes = (sequence_packed[:, None] >> shifts) & 3
+    letters = _BASES[codes.reshape(-1)]
+
+    padded_lengths = (sequence_lengths + 3) // 4 * 4
+    padded_starts = np.cumsum(padded_lengths) - padded_lengths
+    exception_seqs = np.repeat(
+        np.arange(len(sequence_lengths)), sequence_exception_counts
+    )
+    letters[
+        padded_starts[exception_seqs] + sequence_exception_positions
+    ] = sequence_exception_bases
+
+    buffer = letters.tobytes()
+    return [
+        buffer[start : start + length].decode("utf-8")
+        for start, length in zip(padded_starts, sequence_lengths)
+    ]
+
+
+@functools.lru_cache(maxsize=1)
+def _packed_offsets(h5_file: Path, mtime_ns: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Start of each packed sequence of `h5_file` in `sequence_packed` and of
+    its exceptions, followed by the ends. Cached for the chunks of a file."""
+    with h5py.File(h5_file, "r") as f:
+        padded_lengths = (f["sequence_lengths"][...] + 3) // 4
+        exception_counts = f["sequence_exception_counts"][...]
+    return ragged_offsets(padded_lengths), ragged_offsets(exception_counts)
+
+
+def read_packed_sequences(h5_file: Path, start: int, stop: int) -> List[str]:
+    """Unpack the sequences `start:stop` of a file written with pack_sequences."""
+    offsets, exception_offsets = _packed_offsets(h5_file, h5_file.stat().st_mtime_ns)
+    with h5py.File(h5_file, "r") as f:
+        packed = f["sequence_packed"][offsets[start] : offsets[stop]]
+        lengths = f["sequence_lengths"][start:stop]
+        counts = f["sequence_exception_counts"][start:stop]
+        exceptions = slice(exception_offsets[start], exception_offsets[stop])
+        positions = f["sequence_exception_positions"][exceptions]
+        bases = f["sequence_exception_bases"][exceptions]
+    return unpack_nucleotides(packed, lengths, counts, positions, bases)
+
+
+def pack_records(
+    input_ids: np.ndarray, attention_mask: np.ndarray, pad_token_id: int
+) -> Dict[str, np.ndarray]:
+    """Pack right padded token rows into as few rows of the same width as possible.
+
+    Whole records are placed with best-fit decreasing so they are never
+    split across rows. `segment_ids` numbers the records within each row
+    starting from 1 and is 0 for padding, the position ids, labels and
+    attention mask are derived from it during training.
+    """
+    block_size = input_ids.shape[1]
+    lengths = attention_mask.astype(bool).sum(axis=1)
+
+    # Open rows are bucketed by their remaining space, `spaces` holds the
+    # sorted sizes of the non-empty buckets to find the best fit quickly
+    rows_by_space: Dict[int, List[int]] = defaultdict(list)
+    spaces: List[int] = []
+    row_fill: List[int] = []
+    row_records: List[int] = []
+    record_row = np.empty(len(lengths), dtype=np.int64)
+    record_offset = np.empty(len(lengths), dtype=np.int64)
+    record_segment = np.empty(len(lengths), dtype=np.int16)
+    for i in np.argsort(-lengths, kind="stable"):
+        length = int(lengths[i])
+        j = bisect.bisect_left(spaces, length)
+        if j < len(spaces):
+            space = spaces[j]
+            row = rows_by_space[space].pop()
+            if not rows_by_space[space]:
+                del spaces[j]
+        else:
+            space, row = block_size, len(row_fill)
+            row_fill.append(0)
+            row_records.append(0)
+
+        record_row[i], record_offset[i] = row, row_fill[row]
+        row_fill[row] += length
+        row_records[row] += 1
+        record_segment[i] = row_records[row]
+        space -= length
+        if space > 0:
+            if not rows_by_space[space]:
+                bisect.insort(spaces, space)
+            rows_by_space[space].append(row)
+
+    # Scatter the tokens of each record to its place in the packed rows
+    starts = record_row * block_size + record_offset
+    positions = np.arange(int(lengths.sum())) + np.repeat(
+        starts - (np.cumsum(lengths) - lengths), lengths
+    )
+    packed_ids = np.full((len(row_fill), block_size), pad_token_id, input_ids.dtype)
+    segment_ids = np.zeros((len(row_fill), block_size), dtype=np.int16)
+    packed_ids.reshape(-1)[positions] = input_ids[attention_mask.astype(bool)]
+    segment_ids.reshape(-1)[positions] = np.repeat(record_segment, lengths)
+    return {
+        "input_ids": packed_ids,
+        "attention_mask": (segment_ids > 0).astype(attention_mask.dtype),
+        "segment_ids": segment_ids,
+    }
+
+
+def packed_inputs(input_ids: np.ndarray, segment_ids: np.ndarray) -> Dict[str, Any]:
+    """Position ids and labels of packed rows, restarting at every record.
+
+    The model shifts the labels by one, so the first token of each record
+    (which would be predicted from the previous record) and the padding
+    are ignored with -100. Padding has position 0.
+    """
+    index = np.broadcast_to(np.arange(segment_ids.shape[-1]), segment_ids.shape)
+    starts = np.ones(segment_ids.shape, dtype=bool)
+    starts[..., 1:] = segment_ids[..., 1:] != segment_ids[..., :-1]
+    position_ids = index - np.maximum.accumulate(np.where(starts, index, 0), axis=-1)
+    position_ids[segment_ids == 0] = 0
+    labels = np.where(starts | (segment_ids == 0), -100, input_ids.astype(np.int64))
+    return {
+        "position_ids": torch.from_numpy(position_ids).long(),
+        "labels": torch.from_numpy(labels).long(),
+    }
+
+
+def packed_attention_mask(
+    segment_ids: torch.Tensor, dtype: torch.dtype
+) -> torch.Tensor:
+    """Additive (batch_size, 1, seq_len, seq_len) causal mask within each record.
+
+    Padding tokens only attend to padding, so no row is fully masked.
+    """
+    seq_len = segment_ids.shape[-1]
+    causal = torch.ones(seq_len, seq_len, dtype=torch.bool, device=segment_ids.device)
+    allowed = causal.tril() & (segment_ids[:, :, None] == segment_ids[:, None, :])
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=segment_ids.device)
+    return mask.masked_fill(~allowed, torch.finfo(dtype).min)[:, None]
+
+
+# Models that apply an additive 4D attention mask as given, since the
+# attention masks of transformers were unified (create_causal_mask). The
+# transformers fork pinned in setup.cfg predates this, which is why the
+# preprocessing command lines do not offer pack_records.
+PACKED_MODEL_TYPES = {"gpt2", "gpt_neox"}
+PACKED_MIN_TRANSFORMERS = (4, 53)
+
+
+def _version_tuple(version: str) -> Tuple[int, ...]:
+    # Leading numeric parts of a version string, e.g. "4.53.0.dev0" -> (4, 53, 0)
+    parts = []
+    for part in version.split("."):
+        digits = "".join(takewhile(str.isdigit, part))
+        if not digits:
+            break
+        parts.append(int(digits))
+        if len(digits) < len(part):
+            break
+    return tuple(parts)
+
+
+def check_packed_support(model: torch.nn.Module) -> None:
+    """Raise a ValueError unless `model` can be trained on packed records.
+
+    Packed rows need position ids that restart at every record and the 4D
+    attention mask of :obj:`packed_attention_mask`, which older versions of
+    transformers (and other architectures) silently reshape or reject.
+    """
+    model_type = getattr(getattr(model, "config", None), "model_type", None)
+    if "position_ids" not in inspect.signature(model.forward).parameters:
+        problem = "does not accept position_ids"
+    elif model_type not in PACKED_MODEL_TYPES:
+        problem = "is not known to accept 4D attention masks"
+    elif _version_tuple(transformers.__version__) < PACKED_MIN_TRANSFORMERS:
+        min_version = ".".join(map(str, PACKED_MIN_TRANSFORMERS))
+        problem = (
+            f"needs transformers>={min_version} for 4D attention"
+            f" masks, found {transformers.__version__}"
+        )
+    else:
+        return
+    raise ValueError(
+        f"Packed records (segment_ids) are not supported: {type(model).__name__}"
+        f" ({model_type}) {problem}. Write the h5 files without pack_records."
+    )
+
+
+# Fields of the padded model inputs (v1 schema) and the ragged tokens (v2
+# schema), which stores the tokens of all rows back to back instead
+PADDED_TOKEN_FIELDS = ["input_ids", "attention_mask", "segment_ids"]
+RAGGED_TOKEN_FIELDS = ["tokens", "lengths", "segment_ids"]
+
+
+def to_ragged(data: Dict[str, Any]) -> None:
+    """Replace the padded model inputs of `data` with the fields of the v2 schema.
+
+    `tokens` holds the unpadded tokens of every row back to back and
+    `lengths` the number of tokens of each row. The attention mask is
+    implied by the lengths. `segment_ids` of packed rows is flattened the
+    same way as the tokens.
+    """
+    mask = data.pop("attention_mask").astype(bool)
+    data["tokens"] = data.pop("input_ids")[mask]
+    data["lengths"] = mask.sum(axis=1).astype(np.int32)
+    if "segment_ids" in data:
+        data["segment_ids"] = data["segment_ids"][mask]
+
+
+def ragged_offsets(lengths: np.ndarray) -> np.ndarray:
+    """Start of each row in the flat `tokens` of a v2 file, followed by the end."""
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+# Flat fields and the field of the number of their items in each row
+FLAT_FIELD_COUNTS = {
+    "tokens": "lengths",
+    "segment_ids": "lengths",  # Only flat in v2 files, which have lengths
+    "sequence_packed": "sequence_lengths",
+    "sequence_exception_positions": "sequence_exception_counts",
+    "sequence_exception_bases": "sequence_exception_counts",
+}
+
+
+def slice_rows(data: Dict[str, np.ndarray], start: int, stop: int) -> Dict[str, Any]:
+    """Rows `start:stop` of the fields of a file, flat fields included."""
+    rows = {}
+    for key, value in data.items():
+        count_field = FLAT_FIELD_COUNTS.get(key)
+        if count_field is not None and count_field not in data and value.ndim == 1:
+            raise ValueError(
+                f"{key} is stored flat, its rows are given by {count_field}"
+            )
+        if count_field in data:
+            counts = data[count_field]
+            if key == "sequence_packed":
+                # Each sequence starts on a byte boundary
+                counts = (counts + 3) // 4
+            offsets = ragged_offsets(counts)
+            rows[key] = value[offsets[start] : offsets[stop]]
+        else:
+            rows[key] = value[start:stop]
+    return rows
+
+
+def read_h5_sample(
+    source: Any, idx: int, offsets: Optional[np.ndarray] = None
+) -> Dict[str, np.ndarray]:
+    """Read the model inputs of row `idx` from an open H5 file (or a dict of arrays).
+
+    Rows of v2 files, which are read when `offsets` is given, are not padded.
+    """
+    if offsets is None:
+        keys = [key for key in PADDED_TOKEN_FIELDS if key in source]
+        return {key: source[key][idx] for key in keys}
+
+    start, end = offsets[idx], offsets[idx + 1]
+    sample = {
+        "input_ids": source["tokens"][start:end],
+        "attention_mask": np.ones(end - start, dtype=np.int8),
+    }
+    if "segment_ids" in source:
+        sample["segment_ids"] = source["segment_ids"][start:end]
+    return sample
+
+
+def h5_model_inputs(sample: Dict[str, np.ndarray]) -> Dict[str, torch.Tensor]:
+    """Convert a sample of :obj:`read_h5_sample` to the tensors of the model."""
+    inputs = {key: torch.tensor(value).long() for key, value in sample.items()}
+    if "segment_ids" in sample:
+        inputs.update(packed_inputs(sample["input_ids"], sample["segment_ids"]))
+    return inputs
+
+
+# Value used to pad each field of the samples in pad_collate_fn
+_PAD_VALUES = {"attention_mask": 0, "segment_ids": 0, "position_ids": 0, "labels": -100}
+
+
+def pad_collate_fn(
+    batch: List[Dict[str, torch.Tensor]],
+    pad_token_id: int,
+    max_length: Optional[int] = None,
+) -> Dict[str, torch.Tensor]:
+    """Collate unpadded samples (e.g. of v2 H5 files) into right padded tensors.
+
+    Samples are padded to `max_length`, or the longest sample if not given.
+    Fields other than the token level model inputs are collated as usual.
+    """
+    length = max_length or max(len(sample["input_ids"]) for sample in batch)
+    collated = {}
+    for key in batch[0]:
+        if key != "input_ids" and key not in _PAD_VALUES:
+            collated[key] = default_collate([sample[key] for sample in batch])
+            continue
+        value = pad_token_id if key == "input_ids" else _PAD_VALUES[key]
+        padded = torch.full((len(batch), length), value, dtype=batch[0][key].dtype)
+        for row, sample in zip(padded, batch):
+            row[: len(sample[key])] = sample[key]
+        collated[key] = padded
+    return collated
+
+
+def split_key(record: Sequence, split_by: str = "sequence") -> str:
+    """The part of `record` that decides its split, its "sequence" or "id"."""
+    if split_by == "sequence":
+        return record.sequence.upper()
+    if split_by == "id":
+        return record.id
+    raise ValueError(f"Can not split records by {split_by!r}")
+
+
+def assign_split(key: str, split: Dict[str, float]) -> str:
+    """Name of the split of a record from a hash of its `key`.
+
+    The hash places the record in [0, 1), which `split` divides between
+    the names in order of their fraction. Records with the same key land
+    in the same split on every run, whichever file or shard they are in,
+    and no random state is involved.
+    """
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    position = int.from_bytes(digest, "little") / 2**64
+    cumulative = 0.0
+    for name, fraction in split.items():
+        cumulative += fraction
+        if position < cumulative:
+            return name
+    # The fractions add up to slightly less than 1
+    return name
+
+
+# Processed records of one split, their H5 fields, count and packing statistics
+ProcessedBlock = Tuple[Dict[str, Any], int, np.ndarray]
+
+# Per-process state of the parallel_preprocess workers
+_PREPROCESS_WORKER: Dict[str, Any] = {}
+
+
+def iter_chunks(iterable: Iterable[Any], chunk_size: int) -> Iterator[List[Any]]:
+    """Yield consecutive lists of (at most) `chunk_size` items."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def ordered_map(
+    pool: ProcessPoolExecutor,
+    func: Callable[[Any], Any],
+    iterable: Iterable[Any],
+    max_pending: int,
+    cost: Optional[Callable[[Any], int]] = None,
+) -> Iterator[Any]:
+    """Like `pool.map` but only keeps `max_pending` tasks in flight.
+
+    `pool.map` submits every item up front, which holds all of the inputs
+    and finished results in memory when the consumer is slower. With `cost`,
+    `max_pending` bounds the total cost of the tasks in flight instead (e.g.
+    the bytes they return), a single task may exceed it.
+    """
+    pending: Deque[Tuple[Future, int]] = deque()  # type: ignore[type-arg]
+    pending_cost = 0
+    for item in iterable:
+        item_cost = 1 if cost is None else cost(item)
+        while pending and pending_cost + item_cost > max_pending:
+            future, future_cost = pending.popleft()
+            pending_cost -= future_cost
+            yield future.result()
+        pending.append((pool.submit(func, item), item_cost))
+        pending_cost += item_cost
+    while pending:
+        yield pending.popleft()[0].result()
+
+
+DEFAULT_CODEC = "gzip:6"
+
+
+def h5_filters(codec: str) -> Dict[str, Any]:
+    """Arguments of `create_dataset` that compress with `codec`.
+
+    Codecs are ``none``, ``lzf``, ``gzip[:level]`` and, if the optional
+    hdf5plugin package is installed, ``zstd[:level]`` and
+    ``blosc[:compressor[:level]]`` (byte shuffled, lz4 by default).
+    """
+    name, *args = codec.lower().split(":")
+    if name == "none":
+        return {}
+    if name == "lzf":
+        return {"compression": "lzf"}
+    if name == "gzip":
+        return {"compression": "gzip", "compression_opts": int(args[0]) if args else 6}
+    if name in ("zstd", "blosc"):
+        if hdf5plugin is None:
+            raise ImportError(
+                f"The {name} codec needs hdf5plugin: pip install hdf5plugin"
+            )
+        if name == "zstd":
+            return dict(hdf5plugin.Zstd(clevel=int(args[0]) if args else 3))
+        return dict(
+            hdf5plugin.Blosc(
+                cname=args[0] if args else "lz4",
+                clevel=int(args[1]) if len(args) > 1 else 5,
+                shuffle=hdf5plugin.Blosc.SHUFFLE,
+            )
+        )
+    raise ValueError(f"Unknown compression codec {codec!r}")
+
+
+def field_codec(compression: Optional[Dict[str, str]], name: str) -> str:
+    """Codec of field `name`, `compression` maps fields (or "default") to codecs."""
+    compression = compression or {}
+    return compression.get(name, compression.get("default", DEFAULT_CODEC))
+
+
+def parse_compression(specs: Optional[List[str]]) -> Dict[str, str]:
+    """Parse command line codecs, ``field=codec`` or a ``codec`` for every field."""
+    compression = {}
+    for spec in specs or []:
+        name, _, codec = spec.rpartition("=")
+        h5_filters(codec)  # Fail before doing any work
+        compression[name or "default"] = codec
+    return compression
+
+
+class EncodedRows:
+    """Rows of a field already compressed into the gzip chunks of an H5 dataset.
+
+    Compression is most of the cost of writing, :obj:`H5Writer.encode` lets
+    worker processes do it so that the writer only copies the chunks.
+    """
+
+    def __init__(
+        self,
+        chunks: List[bytes],
+        shape: Tuple[int, ...],
+        dtype: np.dtype,
+        chunk_rows: int,
+        level: int,
+    ) -> None:
+        self.chunks = chunks
+        self.shape = shape
+        self.dtype = dtype
+        self.chunk_rows = chunk_rows
+        self.level = level
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def decode(self) -> np.ndarray:
+        data = b"".join(zlib.decompress(chunk) for chunk in self.chunks)
+        rows = np.frombuffer(data, dtype=self.dtype).reshape((-1,) + self.shape[1:])
+        return rows[: self.shape[0]]
 
     @staticmethod
-    def write_h5(ouput_file: PathLike, data: Dict[str, np.ndarray]) -> None:
-        with h5py.File(ouput_file, "w") as f:
-            str_dtype = h5py.string_dtype(encoding="utf-8")
-            create_dataset = functools.partial(
-                f.create_dataset,
-                chunks=True,
-                compression="gzip",
-                compression_opts=6,
+    def concatenate(
+        parts: List[Union[np.ndarray, "EncodedRows"]]
+    ) -> Union[np.ndarray, "EncodedRows"]:
+        """Join consecutive rows, keeping their chunks when they line up.
+
+        Chunks can only be joined if every part but the last fills its last
+        chunk, otherwise the parts are decoded and concatenated.
+        """
+        if not parts:
+            raise ValueError("No rows to concatenate")
+        first = parts[0]
+        if isinstance(first, EncodedRows) and all(
+            isinstance(part, EncodedRows)
+            and part.shape[1:] == first.shape[1:]
+            and part.dtype == first.dtype
+            and part.chunk_rows == first.chunk_rows
+            and part.level == first.level
+            for part in parts
+        ):
+            encoded: List[EncodedRows] = parts  # type: ignore[assignment]
+            if all(len(part) % first.chunk_rows == 0 for part in encoded[:-1]):
+                return EncodedRows(
+                    [chunk for part in encoded for chunk in part.chunks],
+                    (sum(len(part) for part in encoded),) + first.shape[1:],
+                    first.dtype,
+                    first.chunk_rows,
+                    first.level,
+                )
+        return np.concatenate(
+            [part.decode() if isinstance(part, EncodedRows) else part for part in parts]
+        )
+
+
+class H5Writer:
+    """Append blocks of records to the resizable datasets of an HDF5 file."""
+
+    def __init__(
+        self,
+        output_file: PathLike,
+        dtypes: Optional[Dict[str, Any]] = None,
+        compression: Optional[Dict[str, str]] = None,
+        chunk_rows: Optional[int] = None,
+    ) -> None:
+        """Write `output_file`, resuming it if a previous writer crashed.
+
+        Datasets are created from the first block with an unlimited first
+        axis. After every block the file is flushed and the length of each
+        dataset is stored in the `committed` attribute, so a partial file
+        is truncated back to its last complete block and appended to. The
+        `complete` attribute is set once the writer is closed, complete
+        files are overwritten.
+
+        Parameters
+        ----------
+        output_file : PathLike
+            HDF5 file to write.
+        dtypes : Optional[Dict[str, Any]], optional
+            Storage type of each field, by default the type of the first block
+            (lists of strings are stored as variable length UTF-8).
+        compression : Optional[Dict[str, str]], optional
+            Codec of each field (see :obj:`h5_filters`), fields that are not
+            listed use the "default" entry, by default gzip level 6.
+        chunk_rows : Optional[int], optional
+            Records per chunk of the fields stored in rows, by default chunks
+            of up to 256KB. Small chunks make random reads decompress less.
+        """
+        self.output_file = Path(output_file)
+        self.dtypes = dtypes or {}
+        self.compression = compression
+        self.rows_per_chunk = chunk_rows
+        for codec in (compression or {}).values():
+            h5_filters(codec)
+        self.num_records = 0
+        """Number of records (not rows) written so far, including resumed ones."""
+        self.num_inputs = 0
+        """Number of input records consumed, with those written to other files."""
+        self.chunks_copied = 0
+        """Number of :obj:`EncodedRows` chunks written without recompressing."""
+
+        if self.output_file.exists() and not self.is_complete(self.output_file):
+            self.num_records = self.recover(self.output_file)
+            self.h5_file = h5py.File(self.output_file, "a")
+            self.num_inputs = int(
+                self.h5_file.attrs.get("num_inputs", self.num_records)
             )
-            create_dataset("input_ids", data=data["input_ids"], dtype="i8")
-            create_dataset("attention_mask", data=data["attention_mask"], dtype="i8")
-            create_dataset("id", data=data["id"], dtype=str_dtype)
-            create_dataset("description", data=data["description"], dtype=str_dtype)
-            create_dataset("sequence", data=data["sequence"], dtype=str_dtype)
+        else:
+            self.h5_file = h5py.File(self.output_file, "w")
+            self.h5_file.attrs["complete"] = False
+            self._commit()
 
     @staticmethod
-    def preprocess(
-        fasta_file: PathLike,
-        output_file: PathLike,
-        tokenizer: PreTrainedTokenizerFast,
-        block_size: int = 2048,
-        kmer_size: int = 3,
-        train_val_test_split: Optional[Dict[str, float]] = None,
-        subsample: int = 1,
+    def is_complete(h5_file: PathLike) -> bool:
+        """Whether `h5_file` was closed normally (or not written by a writer)."""
+        try:
+            with h5py.File(h5_file, "r") as f:
+                return bool(f.attrs.get("complete", True))
+        except OSError:
+            # Not even the HDF5 superblock made it to disk
+            return False
+
+    @staticmethod
+    def recover(h5_file: PathLike) -> int:
+        """Truncate a partial file to its last complete block.
+
+        Returns
+        -------
+        int
+            The number of records in the recovered file.
+        """
+        try:
+            with h5py.File(h5_file, "a") as f:
+                committed = json.loads(f.attrs.get("committed", "{}"))
+                for name in list(f):
+                    if name not in committed:
+                        del f[name]
+                    elif f[name].shape[0] != committed[name]:
+                        f[name].resize(committed[name], axis=0)
+                return int(f.attrs.get("num_records", 0))
+        except OSError:
+            warnings.warn(f"Could not recover {h5_file}, starting over")
+            Path(h5_file).unlink()
+            with h5py.File(h5_file, "w") as f:
+                f.attrs["complete"] = False
+            return 0
+
+    @staticmethod
+    def chunk_rows(
+        dtype: Any, row_shape: Tuple[int, ...], rows: Optional[int] = None
+    ) -> int:
+        """Rows per chunk, `rows` or a power of two for chunks of up to 256KB.
+
+        Flat fields (e.g. the ragged tokens) do not store a record per row
+        and ignore `rows`. They are read in short slices, so their chunks
+        are kept to 32KB to decompress less per read.
+        """
+        if rows and row_shape:
+            return rows
+        chunk_bytes = 1 << 18 if row_shape else 1 << 15
+        row_bytes = np.dtype(dtype).itemsize * int(np.prod(row_shape))
+        return 1 << max((chunk_bytes // row_bytes).bit_length() - 1, 0)
+
+    @staticmethod
+    def dataset_options(
+        dtype: Any,
+        row_shape: Tuple[int, ...],
+        codec: str = DEFAULT_CODEC,
+        chunk_rows: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """Chunk shape and filters of a resizable dataset with rows of `row_shape`."""
+        # h5py can not guess from an empty dataset, store whole rows
+        rows = H5Writer.chunk_rows(dtype, row_shape, chunk_rows)
+        return {"chunks": (rows,) + tuple(row_shape), **h5_filters(codec)}
+
+    @staticmethod
+    def encode(
+        value: np.ndarray,
+        dtype: Any,
+        level: int = 6,
+        chunk_rows: Optional[int] = None,
+    ) -> EncodedRows:
+        """Compress rows into the gzip chunks the writer would store them in."""
+        value = np.ascontiguousarray(value, dtype=dtype)
+        rows = H5Writer.chunk_rows(dtype, value.shape[1:], chunk_rows)
+        chunks = []
+        for start in range(0, len(value), rows):
+            chunk = value[start : start + rows]
+            if len(chunk) < rows:
+                # Edge chunks are stored whole
+                padding = np.zeros((rows - len(chunk),) + value.shape[1:], dtype)
+                chunk = np.concatenate([chunk, padding])
+            chunks.append(zlib.compress(chunk.tobytes(), level))
+        return EncodedRows(chunks, value.shape, value.dtype, rows, level)
+
+    @staticmethod
+    def _can_write_direct(dset: h5py.Dataset, value: EncodedRows) -> bool:
+        return (
+            dset.chunks == (value.chunk_rows,) + value.shape[1:]
+            and dset.dtype == value.dtype
+            and dset.compression == "gzip"
+            and dset.compression_opts == value.level
+            and not dset.shuffle
+            and not dset.fletcher32
+            and dset.scaleoffset is None
+            and dset.shape[0] % value.chunk_rows == 0
+        )
+
+    def _commit(self) -> None:
+        # A single attribute so that it is updated atomically
+        lengths = {name: dset.shape[0] for name, dset in self.h5_file.items()}
+        self.h5_file.attrs["committed"] = json.dumps(lengths)
+        self.h5_file.attrs["num_records"] = self.num_records
+        self.h5_file.attrs["num_inputs"] = self.num_inputs
+        self.h5_file.flush()
+
+    def write(
+        self,
+        block: Dict[str, Any],
+        num_records: Optional[int] = None,
+        num_inputs: Optional[int] = None,
     ) -> None:
-        if train_val_test_split is not None:
-            if sum(train_val_test_split.values()) != 1:
+        """Append a block of fields, all of which must be given every time.
+
+        Parameters
+        ----------
+        block : Dict[str, Any]
+            Arrays, lists of strings or :obj:`EncodedRows` to append along
+            the first axis.
+        num_records : Optional[int], optional
+            Number of records in the block, by default the length of the
+            first field.
+        num_inputs : Optional[int], optional
+            Number of input records the block was made from, by default
+            `num_records`. Larger when the inputs are split between files,
+            an empty block then only records the progress.
+        """
+        for name, value in block.items():
+            if isinstance(value, list):
+                value = np.array(value, dtype=object)
+            if name not in self.h5_file:
+                dtype = self.dtypes.get(name, value.dtype)
+                if dtype == object:
+                    dtype = h5py.string_dtype(encoding="utf-8")
+                self.h5_file.create_dataset(
+                    name,
+                    shape=(0,) + value.shape[1:],
+                    maxshape=(None,) + value.shape[1:],
+                    dtype=dtype,
+                    **self.dataset_options(
+                        dtype,
+                        value.shape[1:],
+                        field_codec(self.compression, name),
+                        self.rows_per_chunk,
+                    ),
+                )
+            dset = self.h5_file[name]
+            if dset.shape[1:] != value.shape[1:]:
                 raise ValueError(
-                    f"Train test val split percentages {train_val_test_split} do not add up to 100%"
+                    f"{name} rows of shape {value.shape[1:]} do not match {dset.shape[1:]} in {self.output_file}"
                 )
+            if isinstance(value, EncodedRows):
+                if self._can_write_direct(dset, value):
+                    start = dset.shape[0]
+                    dset.resize(start + len(value), axis=0)
+                    for i, chunk in enumerate(value.chunks):
+                        offset = (start + i * value.chunk_rows,) + (0,) * (
+                            dset.ndim - 1
+                        )
+                        dset.id.write_direct_chunk(offset, chunk)
+                    self.chunks_copied += len(value.chunks)
+                    continue
+                # Not aligned with the chunks of the file (e.g. after a
+                # block with a partial last chunk), recompress
+                value = value.decode()
+            if len(value):
+                start = dset.shape[0]
+                dset.resize(start + len(value), axis=0)
+                dset[start:] = value
+
+        if num_records is None:
+            num_records = len(next(iter(block.values())))
+        self.num_records += num_records
+        self.num_inputs += num_records if num_inputs is None else num_inputs
+        self._commit()
+
+    def copy(self, source: h5py.Dataset, name: Optional[str] = None) -> None:
+        """Copy a whole dataset of another file, keeping its chunks and filters."""
+        name = name or source.name.split("/")[-1]
+        if name in self.h5_file:
+            del self.h5_file[name]
+        self.h5_file.copy(source, self.h5_file, name=name)
+        self._commit()
+
+    def close(self) -> None:
+        if self.h5_file.id.valid:
+            self.h5_file.attrs["complete"] = True
+            self.h5_file.close()
+
+    def __enter__(self) -> "H5Writer":
+        return self
+
+    def __exit__(self, exc_type: Any, *args: Any) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            # Leave the partial file to be resumed
+            self.h5_file.close()
 
-        # Load in sequences and take an even subsample
-        sequences = list(SeqIO.parse(fasta_file, "fasta"))[::subsample]
-        print(f"File: {fasta_file}, num sequences: {len(sequences)}")
 
-        sequence_splits = {}
+class H5PreprocessMixin:
+    @staticmethod
+    def train_val_test_split(
+        seqs: List[Any], train_pct: float, val_pct: float
+    ) -> Dict[str, List[Any]]:
+        """Split sequence strings (or records) by their content, see :obj:`assign_split`."""
+        split = {"train": train_pct, "val": val_pct, "test": 1 - train_pct - val_pct}
+        splits: Dict[str, List[Any]] = {name: [] for name in split}
+        for seq in seqs:
+            key = seq.upper() if isinstance(seq, str) else split_key(seq)
+            splits[assign_split(key, split)].append(seq)
+        return splits
 
-        if train_val_test_split is not None:
-            train_percentage = train_val_test_split["train"]
-            val_percentage = train_val_test_split["val"]
-            sequence_splits = H5PreprocessMixin.train_val_test_split(
-                sequences, train_percentage, val_percentage
+    @staticmethod
+    def check_split(split: Optional[Dict[str, float]]) -> None:
+        if split is not None and not np.isclose(sum(split.values()), 1):
+            raise ValueError(
+                f"Train test val split percentages {split} do not add up to 100%"
             )
 
-            split_length = sum(len(split) for split in sequence_splits.values())
-            assert split_length == len(sequences)
+    # Storage types of the padded model inputs, the ragged tokens keep theirs
+    H5_DTYPES = {"input_ids": "i8", "attention_mask": "i8", "segment_ids": "i2"}
 
+    @staticmethod
+    def h5_fields(data: Dict[str, Any], pack_sequences: bool = False) -> Dict[str, Any]:
+        """Select (and pack) the fields of `data` that are stored in H5 files."""
+        keys = PADDED_TOKEN_FIELDS + RAGGED_TOKEN_FIELDS + ["id", "description"]
+        fields = {key: data[key] for key in keys if key in data}
+        if pack_sequences:
+            fields.update(pack_nucleotides(data["sequence"]))
         else:
-            sequence_splits["all"] = sequences
+            fields["sequence"] = data["sequence"]
+        return fields
 
-        for split_name, split_sequences in sequence_splits.items():
+    @staticmethod
+    def write_h5(
+        ouput_file: PathLike,
+        data: Dict[str, np.ndarray],
+        pack_sequences: bool = False,
+        compression: Optional[Dict[str, str]] = None,
+        chunk_rows: Optional[int] = None,
+    ) -> None:
+        # Replace any partial file instead of resuming it
+        Path(ouput_file).unlink(missing_ok=True)
+        with H5Writer(
+            ouput_file,
+            dtypes=H5PreprocessMixin.H5_DTYPES,
+            compression=compression,
+            chunk_rows=chunk_rows,
+        ) as writer:
+            writer.write(H5PreprocessMixin.h5_fields(data, pack_sequences))
 
-            if not split_sequences:
-                warnings.warn(
-                    f"{fasta_file} {split_name} split led to empty input array"
+    @staticmethod
+    def pack_split(data: Dict[str, Any], pad_token_id: int) -> Tuple[int, int, int]:
+        """Replace the padded model inputs of `data` with packed rows.
+
+        Returns the number of tokens and the number of padded positions
+        before and after packing.
+        """
+        num_tokens = int(data["attention_mask"].astype(bool).sum())
+        padded_size = data["input_ids"].size
+        data.update(
+            pack_records(data["input_ids"], data["attention_mask"], pad_token_id)
+        )
+        return num_tokens, padded_size, data["input_ids"].size
+
+    @staticmethod
+    def _preprocess_block(
+        seq_records: List[Sequence],
+        tokenizer: KmerTokenizer,
+        kmer_size: int,
+        block_size: int,
+        pack_sequences: bool,
+        pack_records: bool,
+        ragged: bool = False,
+        compression: Optional[Dict[str, str]] = None,
+        chunk_rows: Optional[int] = None,
+    ) -> ProcessedBlock:
+        # Everything up to the H5 fields is done here, which runs in the
+        # workers of parallel_preprocess, so the parent only writes
+        data = H5PreprocessMixin._parallel_preprocess_helper(
+            seq_records, tokenizer, kmer_size, block_size
+        )
+        packing = np.zeros(3, dtype=np.int64)
+        if pack_records:
+            packing += H5PreprocessMixin.pack_split(data, tokenizer.pad_token_id)
+        if ragged:
+            to_ragged(data)
+        fields = H5PreprocessMixin.h5_fields(data, pack_sequences)
+        # Flat fields are rarely aligned with the chunks, so only rows are
+        # encoded, and only zlib is available to encode them here
+        for key, dtype in H5PreprocessMixin.H5_DTYPES.items():
+            filters = h5_filters(field_codec(compression, key))
+            if (
+                key in fields
+                and fields[key].ndim > 1
+                and filters.get("compression") == "gzip"
+            ):
+                fields[key] = H5Writer.encode(
+                    fields[key], dtype, filters["compression_opts"], chunk_rows
                 )
-                continue
+        return fields, len(seq_records), packing
+
+    @staticmethod
+    def _preprocess_chunk(
+        seq_records: List[Sequence],
+        split: Optional[Dict[str, float]] = None,
+        split_by: str = "sequence",
+        **process_kwargs: Any,
+    ) -> Tuple[Dict[str, ProcessedBlock], int]:
+        # Route the records of a chunk of the input to their splits, which
+        # are processed separately. Returns the blocks by split name (only
+        # the splits with records) and the number of input records.
+        groups: Dict[str, List[Sequence]] = {"all": seq_records}
+        if split is not None:
+            groups = defaultdict(list)
+            for record in seq_records:
+                groups[assign_split(split_key(record, split_by), split)].append(record)
+        blocks = {
+            name: H5PreprocessMixin._preprocess_block(records, **process_kwargs)
+            for name, records in groups.items()
+            if records
+        }
+        return blocks, len(seq_records)
 
-            fields = defaultdict(list)
-            for seq_record in split_sequences:
-                batch_encoding = tokenizer(
-                    group_by_kmer(seq_record, kmer_size),
-                    max_length=block_size,
-                    padding="max_length",
-                    return_tensors="np",
-                    truncation=True,
+    @staticmethod
+    def _write_splits(
+        output_files: Dict[str, Path],
+        make_chunks: Callable[[int], Iterable[Tuple[Dict[str, ProcessedBlock], int]]],
+        pack_records: bool,
+        compression: Optional[Dict[str, str]] = None,
+        chunk_rows: Optional[int] = None,
+    ) -> None:
+        # `make_chunks` yields the processed chunks of the input after its
+        # first records, so a crashed run continues where it was. Each file
+        # knows how many input records it has seen, files that got further
+        # than the others skip the chunks they already hold.
+        packing = {name: np.zeros(3, dtype=np.int64) for name in output_files}
+        with ExitStack() as stack:
+            writers = {
+                name: stack.enter_context(
+                    H5Writer(
+                        output_file,
+                        dtypes=H5PreprocessMixin.H5_DTYPES,
+                        compression=compression,
+                        chunk_rows=chunk_rows,
+                    )
                 )
-                for field in ["input_ids", "attention_mask"]:
-                    fields[field].append(batch_encoding[field].astype(np.int8))
-                fields["id"].append(seq_record.id)
-                fields["description"].append(seq_record.description)
-                fields["sequence"].append(str(seq_record.seq).upper())
-
-            # Gather model input into numpy arrays
-            for key in ["input_ids", "attention_mask"]:
-                fields[key] = np.concatenate(fields[key])
-
-            # Write to HDF5 file
-            local_output_file = Path(output_file)
-            if split_name != "all":
-                local_output_file = (
-                    local_output_file.parent / split_name / local_output_file.name
+                for name, output_file in output_files.items()
+            }
+            for writer in writers.values():
+                if writer.num_inputs:
+                    print(
+                        f"Resuming {writer.output_file} after {writer.num_records} records"
+                    )
+
+            position = min(writer.num_inputs for writer in writers.values())
+            for blocks, num_inputs in make_chunks(position):
+                for name, writer in writers.items():
+                    if writer.num_inputs >= position + num_inputs:
+                        continue
+                    if writer.num_inputs != position:
+                        raise ValueError(
+                            f"Resume {writer.output_file} with the chunk_size it was started with"
+                        )
+                    fields, num_records, block_packing = blocks.get(
+                        name, ({}, 0, np.zeros(3, dtype=np.int64))
+                    )
+                    writer.write(fields, num_records, num_inputs)
+                    packing[name] += block_packing
+                position += num_inputs
+
+        for name, writer in writers.items():
+            if not writer.num_records:
+                warnings.warn(f"{writer.output_file} split led to empty input array")
+                writer.output_file.unlink()
+                continue
+
+            if pack_records:
+                num_tokens, padded_size, packed_size = packing[name]
+                print(
+                    f"Packed {writer.output_file}, padding fraction "
+                    f"{1 - num_tokens / max(padded_size, 1):.1%} -> "
+                    f"{1 - num_tokens / max(packed_size, 1):.1%}"
                 )
+            print(
+                f"File saved to: {writer.output_file} ({writer.num_records} sequences)"
+            )
 
-            H5PreprocessMixin.write_h5(local_output_file, fields)
+    @staticmethod
+    def preprocess(
+        fasta_file: PathLike,
+        output_file: PathLike,
+        tokenizer: PreTrainedTokenizerFast,
+        block_size: int = 2048,
+        kmer_size: int = 3,
+        train_val_test_split: Optional[Dict[str, float]] = None,
+        subsample: int = 1,
+        pack_sequences: bool = False,
+        pack_records: bool = False,
+        chunk_size: int = 4096,
+        ragged: bool = False,
+        compression: Optional[Dict[str, str]] = None,
+        chunk_rows: Optional[int] = None,
+        split_by: str = "sequence",
+        keep_mask: Optional[PathLike] = None,
+    ) -> None:
+        H5PreprocessMixin.check_split(train_val_test_split)
+
+        records: Iterable[Sequence] = iter_fasta(fasta_file)
+        if keep_mask is not None:
+            # Skip the duplicates found by FastaDeduplicator
+            keep = np.load(keep_mask)
+            check_keep_mask(keep, keep_mask, count_fasta_records(fasta_file))
+            records = compress(records, keep)
+        # Take an even subsample of the sequences
+        records = islice(records, 0, None, subsample)
+        print(f"File: {fasta_file}")
+
+        # Records are streamed to the file of their split
+        output_file = Path(output_file)
+        output_files = {"all": output_file}
+        if train_val_test_split is not None:
+            output_files = {
+                name: output_file.parent / name / output_file.name
+                for name in train_val_test_split
+            }
+
+        process = functools.partial(
+            H5PreprocessMixin._preprocess_chunk,
+            split=train_val_test_split,
+            split_by=split_by,
+            tokenizer=KmerTokenizer(tokenizer),
+            kmer_size=kmer_size,
+            block_size=block_size,
+            pack_sequences=pack_sequences,
+            pack_records=pack_records,
+            ragged=ragged,
+            compression=compression,
+            chunk_rows=chunk_rows,
+        )
+
+        def make_chunks(
+            num_done: int,
+        ) -> Iterator[Tuple[Dict[str, ProcessedBlock], int]]:
+            remaining = islice(records, num_done, None)
+            return map(process, iter_chunks(remaining, chunk_size))
 
-            print(f"File saved to: {local_output_file}")
+        H5PreprocessMixin._write_splits(
+            output_files, make_chunks, pack_records, compression, chunk_rows
+        )
 
     @staticmethod
     def _parallel_preprocess_helper(
-        seq_record: SeqIO.SeqRecord,
-        tokenizer: PreTrainedTokenizerFast,
+        seq_records: List[Sequence],
+        tokenizer: KmerTokenizer,
         kmer_size: int,
         block_size: int,
-    ) -> Dict[str, List[Any]]:
+    ) -> Dict[str, Any]:
 
         batch_encoding = tokenizer(
-            group_by_kmer(seq_record, kmer_size),
-            max_length=block_size,
-            padding="max_length",
-            return_tensors="np",
-            truncation=True,
+            [seq_record.sequence for seq_record in seq_records], kmer_size, block_size
         )
 
-        data = {}
-        for field in ["input_ids", "attention_mask"]:
-            data[field] = batch_encoding[field].astype(np.int8)
-        data["id"] = seq_record.id
-        data["description"] = seq_record.description
-        data["sequence"] = str(seq_record.seq).upper()
+        data: Dict[str, Any] = {
+            "input_ids": batch_encoding["input_ids"].astype(
+                np.min_scalar_type(len(tokenizer.tokenizer))
+            ),
+            "attention_mask": batch_encoding["attention_mask"].astype(np.int8),
+        }
+        data["id"] = [seq_record.id for seq_record in seq_records]
+        data["description"] = [seq_record.description for seq_record in seq_records]
+        data["sequence"] = [seq_record.sequence.upper() for seq_record in seq_records]
         return data
 
+    @staticmethod
+    def _init_preprocess_worker(
+        fasta_file: Optional[PathLike],
+        offsets: Optional[np.ndarray],
+        tokenizer: PreTrainedTokenizerFast,
+        **process_kwargs: Any,
+    ) -> None:
+        # Runs once in each worker, the tasks then only carry record indices
+        _PREPROCESS_WORKER.clear()
+        _PREPROCESS_WORKER["process"] = functools.partial(
+            H5PreprocessMixin._preprocess_chunk,
+            tokenizer=KmerTokenizer(tokenizer),
+            **process_kwargs,
+        )
+        if fasta_file is not None:
+            _PREPROCESS_WORKER["fasta"] = open(fasta_file, "rb")
+            _PREPROCESS_WORKER["offsets"] = offsets
+
+    @staticmethod
+    def _preprocess_worker_task(
+        chunk: Union[np.ndarray, List[Sequence]]
+    ) -> Tuple[Dict[str, ProcessedBlock], int]:
+        if isinstance(chunk, np.ndarray):
+            # Read the records of the chunk straight from the fasta file
+            f, offsets = _PREPROCESS_WORKER["fasta"], _PREPROCESS_WORKER["offsets"]
+            chunk = [
+                Sequence.construct(sequence=seq, tag=tag)
+                for tag, seq in (
+                    read_fasta_entry(f, offsets[i], offsets[i + 1]) for i in chunk
+                )
+            ]
+        return _PREPROCESS_WORKER["process"](chunk)  # type: ignore[no-any-return]
+
     @staticmethod
     def parallel_preprocess(
         fasta_file: PathLike,
@@ -165,59 +1179,159 @@ class H5PreprocessMixin:
         subsample: int = 1,
         num_workers: int = 1,
         train_val_test_split: Optional[Dict[str, float]] = None,
+        pack_sequences: bool = False,
+        pack_records: bool = False,
+        chunk_size: int = 4096,
+        ragged: bool = False,
+        compression: Optional[Dict[str, str]] = None,
+        chunk_rows: Optional[int] = None,
+        split_by: str = "sequence",
+        keep_mask: Optional[PathLike] = None,
     ) -> None:
+        H5PreprocessMixin.check_split(train_val_test_split)
 
-        # Load in sequences and take an even subsample
-        sequences = list(SeqIO.parse(fasta_file, "fasta"))[::subsample]
-        print(f"File: {fasta_file}, num sequences: {len(sequences)}")
+        # Workers read their records by byte offset, compressed
+        # files are parsed here and the records sent to the workers
+        offsets: Optional[np.ndarray] = None
+        try:
+            offsets = load_fasta_index(fasta_file)
+        except ValueError:
+            pass
 
-        if train_val_test_split is not None:
-            train_percentage = train_val_test_split["train"]
-            val_percentage = train_val_test_split["val"]
-            sequence_splits = H5PreprocessMixin.train_val_test_split(
-                sequences, train_percentage, val_percentage
+        # Skip the duplicates found by FastaDeduplicator, then take an
+        # even subsample of the sequences
+        keep = None if keep_mask is None else np.load(keep_mask)
+        if keep is not None:
+            num_records = (
+                count_fasta_records(fasta_file) if offsets is None else len(offsets) - 1
             )
-
-            split_length = sum(len(split) for split in sequence_splits.values())
-            assert split_length == len(sequences)
-
+            check_keep_mask(keep, keep_mask, num_records)
+        records: Union[np.ndarray, Iterable[Sequence]]
+        if offsets is not None:
+            records = np.arange(len(offsets) - 1)
+            if keep is not None:
+                records = records[keep]
+            records = records[::subsample]
+            print(f"File: {fasta_file}, num sequences: {len(records)}")
         else:
-            sequence_splits = {"all": sequences}
+            records = iter_fasta(fasta_file)
+            if keep is not None:
+                records = compress(records, keep)
+            records = islice(records, 0, None, subsample)
+            print(f"File: {fasta_file}")
+
+        # The workers route the records of each chunk to their split
+        output_file = Path(output_file)
+        output_files = {"all": output_file}
+        if train_val_test_split is not None:
+            output_files = {
+                name: output_file.parent
+                / f"{output_file.stem}_{name}{output_file.suffix}"
+                for name in train_val_test_split
+            }
 
-        func = functools.partial(
-            H5PreprocessMixin._parallel_preprocess_helper,
-            tokenizer=tokenizer,
+        def make_chunks(
+            num_done: int,
+        ) -> Iterator[Tuple[Dict[str, ProcessedBlock], int]]:
+            chunks: Iterable[Any]
+            if isinstance(records, np.ndarray):
+                chunks = (
+                    records[i : i + chunk_size]
+                    for i in range(num_done, len(records), chunk_size)
+                )
+            else:
+                chunks = iter_chunks(islice(records, num_done, None), chunk_size)
+            return ordered_map(
+                pool, H5PreprocessMixin._preprocess_worker_task, chunks, 2 * num_workers
+            )
+
+        initargs = (
+            None if offsets is None else fasta_file,
+            offsets,
+            tokenizer,
+        )
+        initializer = functools.partial(
+            H5PreprocessMixin._init_preprocess_worker,
+            split=train_val_test_split,
+            split_by=split_by,
             kmer_size=kmer_size,
             block_size=block_size,
+            pack_sequences=pack_sequences,
+            pack_records=pack_records,
+            ragged=ragged,
+            compression=compression,
+            chunk_rows=chunk_rows,
         )
+        with ProcessPoolExecutor(
+            max_workers=num_workers, initializer=initializer, initargs=initargs
+        ) as pool:
+            H5PreprocessMixin._write_splits(
+                output_files, make_chunks, pack_records, compression, chunk_rows
+            )
 
-        for split_name, split_sequences in sequence_splits.items():
-            if not split_sequences:
-                warnings.warn(
-                    f"{fasta_file}: {split_name} split led to empty input array"
-                )
-                continue
+    @staticmethod
+    def convert_to_ragged(
+        input_file: PathLike, output_file: PathLike, chunk_size: int = 4096
+    ) -> None:
+        """Convert a padded (v1) H5 file to the ragged v2 schema.
 
-            data = defaultdict(list)
-            chunksize = max(1, len(split_sequences) // num_workers)
-            with ProcessPoolExecutor(max_workers=num_workers) as pool:
-                for datum in pool.map(func, split_sequences, chunksize=chunksize):
-                    for key in datum:
-                        data[key].append(datum[key])
-
-            # Gather model input into numpy arrays
-            for key in ["input_ids", "attention_mask"]:
-                data[key] = np.concatenate(data[key])
-
-            local_output_file = Path(output_file)
-            if split_name != "all":
-                local_output_file = (
-                    local_output_file.parent
-                    / f"{local_output_file.stem}_{split_name}{local_output_file.suffix}"
-                )
-            H5PreprocessMixin.write_h5(local_output_file, data)
+        The padded model inputs are converted `chunk_size` rows at a time,
+        every other field is copied as it is stored.
+        """
+        Path(output_file).unlink(missing_ok=True)
+        with h5py.File(input_file, "r") as f, H5Writer(
+            output_file, dtypes=H5PreprocessMixin.H5_DTYPES
+        ) as writer:
+            num_rows = f["input_ids"].shape[0]
+            # v1 files store int64 tokens, keep the smallest type that fits them
+            max_token = max(
+                (
+                    int(f["input_ids"][i : i + chunk_size].max())
+                    for i in range(0, num_rows, chunk_size)
+                ),
+                default=0,
+            )
+            token_dtype = np.min_scalar_type(max_token)
+
+            for i in range(0, num_rows, chunk_size):
+                block = {
+                    key: f[key][i : i + chunk_size]
+                    for key in PADDED_TOKEN_FIELDS
+                    if key in f
+                }
+                block["input_ids"] = block["input_ids"].astype(token_dtype)
+                to_ragged(block)
+                writer.write(block, num_records=len(block["lengths"]))
 
-            print(f"File saved to: {local_output_file}")
+            for key in f:
+                if key not in PADDED_TOKEN_FIELDS:
+                    writer.copy(f[key])
+
+    @staticmethod
+    def rewrite_h5(
+        input_file: PathLike,
+        output_file: PathLike,
+        compression: Optional[Dict[str, str]] = None,
+        chunk_rows: Optional[int] = None,
+        block_bytes: int = 1 << 26,
+    ) -> None:
+        """Copy an H5 file with another compression and chunk layout.
+
+        Each field is copied in blocks of about `block_bytes` uncompressed.
+        """
+        Path(output_file).unlink(missing_ok=True)
+        with h5py.File(input_file, "r") as f, H5Writer(
+            output_file, compression=compression, chunk_rows=chunk_rows
+        ) as writer:
+            for key in f:
+                dset = f[key]
+                row_bytes = dset.dtype.itemsize * int(np.prod(dset.shape[1:]))
+                block_rows = max(block_bytes // row_bytes, 1)
+                # Empty fields are still created
+                for i in range(0, max(dset.shape[0], 1), block_rows):
+                    writer.write({key: dset[i : i + block_rows]}, num_records=0)
+            num_records = f.attrs.get("num_records", len(f.get("description", [])))
+            writer.write({}, num_records=int(num_records))
 
     @staticmethod
     def get_num_samples_in_file(file: Path, field: str) -> int:
@@ -236,13 +1350,133 @@ class H5PreprocessMixin:
                 lengths.append(length)
         return lengths
 
+    @staticmethod
+    def read_h5_schema(
+        file: Path,
+    ) -> Union[Dict[str, Tuple[Tuple[int, ...], np.dtype]], str]:
+        """Shape and dtype of every field of `file`, or why it can not be used."""
+        # The low level API opens files several times faster than h5py.File
+        try:
+            fid = h5py.h5f.open(str(file).encode("utf-8"), h5py.h5f.ACC_RDONLY)
+        except Exception as exc:
+            return f"{type(exc).__name__}: {exc}"
+        try:
+            root = h5py.h5g.open(fid, b"/")
+            if h5py.h5a.exists(root, b"complete"):
+                attr = h5py.h5a.open(root, b"complete")
+                complete = np.zeros(attr.shape, dtype=attr.dtype)
+                attr.read(complete)
+                if not complete.all():
+                    return "partial file, its writer did not finish"
+            schema = {}
+            for name in root:
+                dset = h5py.h5d.open(fid, name)
+                schema[name.decode("utf-8")] = (dset.shape, dset.dtype)
+            return schema
+        except Exception as exc:
+            return f"{type(exc).__name__}: {exc}"
+        finally:
+            fid.close()
+
+    @staticmethod
+    def read_h5_schemas(
+        input_files: List[Path], num_workers: int = 1
+    ) -> List[Union[Dict[str, Tuple[Tuple[int, ...], np.dtype]], str]]:
+        """:obj:`read_h5_schema` of many files, in parallel."""
+        chunksize = max(1, len(input_files) // (16 * num_workers))
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            return list(
+                pool.map(
+                    H5PreprocessMixin.read_h5_schema, input_files, chunksize=chunksize
+                )
+            )
+
+    @staticmethod
+    def validate_h5_schemas(
+        input_files: List[Path],
+        schemas: List[Union[Dict[str, Tuple[Tuple[int, ...], np.dtype]], str]],
+        fields: Optional[List[str]] = None,
+    ) -> Tuple[Dict[str, Tuple[Tuple[int, ...], np.dtype]], Dict[Path, str]]:
+        """Find the files whose fields do not match those of the other files.
+
+        The expected row shape and dtype of each field are the most common
+        ones among the readable files, not those of the first file.
+
+        Returns
+        -------
+        Tuple[Dict[str, Tuple[Tuple[int, ...], np.dtype]], Dict[Path, str]]
+            The row shape and dtype of each field, and why each invalid file
+            is invalid.
+        """
+        readable = [schema for schema in schemas if isinstance(schema, dict)]
+        if fields is None:
+            # Fields in the order they are first seen
+            fields = list(dict.fromkeys(key for schema in readable for key in schema))
+        expected = {}
+        for field in fields:
+            counts = Counter(
+                (schema[field][0][1:], schema[field][1])
+                for schema in readable
+                if field in schema
+            )
+            if counts:
+                expected[field] = counts.most_common(1)[0][0]
+
+        for field, (row_shape, _) in expected.items():
+            # Flat fields can not be split into rows without their counts
+            count_field = FLAT_FIELD_COUNTS.get(field)
+            if count_field is None or count_field in fields or row_shape:
+                continue
+            if any(count_field in schema for schema in readable):
+                raise ValueError(
+                    f"{field} is stored flat, select {count_field} as well"
+                    " to tell its rows apart"
+                )
+
+        invalid: Dict[Path, str] = {}
+        for file, schema in zip(input_files, schemas):
+            if isinstance(schema, str):
+                invalid[file] = schema
+                continue
+            for field in fields:
+                if field not in schema:
+                    invalid[file] = f"no {field} field"
+                    break
+                row_shape, dtype = schema[field][0][1:], schema[field][1]
+                if (row_shape, dtype) != expected[field]:
+                    invalid[file] = (
+                        f"{field} rows are {row_shape} {dtype}, "
+                        f"expected {expected[field][0]} {expected[field][1]}"
+                    )
+                    break
+        return expected, invalid
+
+    @staticmethod
+    def report_invalid(
+        invalid: Dict[Path, str],
+        num_files: int,
+        output_file: Path,
+        skip_invalid: bool = False,
+    ) -> None:
+        """Raise a ValueError listing the `invalid` files, or warn if skipped."""
+        if not invalid:
+            return
+        report = "\n".join(
+            f"  {file}: {reason}" for file, reason in islice(invalid.items(), 20)
+        )
+        message = f"{len(invalid)} of {num_files} files are invalid:\n{report}"
+        if not skip_invalid:
+            raise ValueError(message)
+        warnings.warn(f"{message}\nThey are left out of {output_file}")
+
     @staticmethod
     def concatenate_virtual_h5(
         input_files: List[Path],
         output_file: Path,
         fields: Optional[List[str]] = None,
         num_workers: int = 1,
-    ) -> None:
+        skip_invalid: bool = False,
+    ) -> Dict[Path, str]:
         """Concatenate HDF5 files into a virtual HDF5 file.
         Concatenates a list :obj:`input_files` of HDF5 files containing
         the same format into a single virtual dataset.
@@ -255,176 +1489,548 @@ class H5PreprocessMixin:
         fields : Optional[List[str]], default=None
             Which dataset fields to concatenate. Will concatenate all fields by default.
         num_workers : int, default=1
-            Number of process to use for reading the data lengths from each file.
+            Number of process to use for reading the shape of each file.
+        skip_invalid : bool, default=False
+            Leave out the files that can not be read or whose fields do not
+            match the other files, instead of raising a ValueError.
+
+        Returns
+        -------
+        Dict[Path, str]
+            The files that were left out and why.
         """
+        schemas = H5PreprocessMixin.read_h5_schemas(input_files, num_workers)
+        expected, invalid = H5PreprocessMixin.validate_h5_schemas(
+            input_files, schemas, fields
+        )
+        H5PreprocessMixin.report_invalid(
+            invalid, len(input_files), output_file, skip_invalid
+        )
 
-        # Open first file to get dataset shape and dtype
-        # Assumes uniform number of data points per file
-        h5_file = h5py.File(input_files[0], "r")
-
-        if not fields:
-            fields = list(h5_file.keys())
-
-        if not fields:
+        sources = [
+            (file, schema)
+            for file, schema in zip(input_files, schemas)
+            if file not in invalid
+        ]
+        if not expected or not sources:
             raise ValueError("No fields found in HDF5 file.")
 
-        lengths = H5PreprocessMixin.get_num_samples(input_files, fields[0], num_workers)
-
-        total_length = sum(lengths)
-        print(f"Total sequences: {total_length}")
-
-        # Helper function to output concatenated shape
-        def concat_shape(shape: Tuple[int]) -> Tuple[int]:
-            return (total_length, *shape[1:])
-
-        # Create a virtual layout for each input field
-        layouts = {
-            field: h5py.VirtualLayout(
-                shape=concat_shape(h5_file[field].shape),
-                dtype=h5_file[field].dtype,
-            )
-            for field in fields
-        }
-
         with h5py.File(output_file, "w") as f:
-            for field in fields:
-                for i, filename in enumerate(input_files):
-                    shape = h5_file[field].shape
-                    vsource = h5py.VirtualSource(
-                        filename, field, shape=(lengths[i], *shape[1:])
+            for field, (row_shape, dtype) in expected.items():
+                # Fields may differ in length (e.g. packed sequences are flat arrays)
+                lengths = [int(schema[field][0][0]) for _, schema in sources]
+                ends = np.cumsum(lengths, dtype=np.int64).tolist()
+                if field == next(iter(expected)):
+                    print(f"Total sequences: {ends[-1]}")
+
+                # The low level API avoids h5py's per source selection
+                # objects, which dominate the time with many files
+                dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+                dcpl.set_layout(h5py.h5d.VIRTUAL)
+                space = h5py.h5s.create_simple((ends[-1], *row_shape))
+                name = field.encode("utf-8")
+                for (file, _), length, end in zip(sources, lengths, ends):
+                    if not length:
+                        continue
+                    space.select_hyperslab(
+                        (end - length,) + (0,) * len(row_shape), (length, *row_shape)
                     )
-                    start_idx = sum(lengths[:i])
-                    end_idx = sum(lengths[: i + 1])
-                    layouts[field][start_idx:end_idx, ...] = vsource
-
-                f.create_virtual_dataset(field, layouts[field])
+                    source_space = h5py.h5s.create_simple((length, *row_shape))
+                    dcpl.set_virtual(
+                        space, str(file).encode("utf-8"), name, source_space
+                    )
+                space.select_all()
+                h5py.h5d.create(
+                    f.id,
+                    name,
+                    h5py.h5t.py_create(dtype, logical=True),
+                    space,
+                    dcpl=dcpl,
+                )
 
-        h5_file.close()
+        return invalid
 
     @staticmethod
     def read_h5_fields(input_file: Path) -> Dict[str, np.ndarray]:
         with h5py.File(input_file, "r") as f:
             return {key: f[key][...] for key in f.keys()}
 
+    @staticmethod
+    def read_raw_chunks(
+        dset: h5py.Dataset, chunk_rows: int, level: int
+    ) -> Optional[EncodedRows]:
+        """The compressed chunks of `dset` if they are stored as :obj:`H5Writer`
+        would store them with `chunk_rows` and gzip `level`, otherwise None.
+
+        Datasets that do not fill their last chunk are not returned either,
+        the chunks of the rows after them could not be copied.
+        """
+        if (
+            dset.shape[0] % chunk_rows
+            or dset.chunks != (chunk_rows,) + dset.shape[1:]
+            or dset.dtype.kind not in "biuf"
+            or dset.compression != "gzip"
+            or dset.compression_opts != level
+            # Gzip alone, e.g. no shuffle or checksum
+            or dset.id.get_create_plist().get_nfilters() != 1
+        ):
+            return None
+        chunks = []
+        for start in range(0, dset.shape[0], chunk_rows):
+            offset = (start,) + (0,) * (dset.ndim - 1)
+            filter_mask, chunk = dset.id.read_direct_chunk(offset)
+            if filter_mask:
+                # Stored uncompressed, HDF5 skips filters that do not help
+                return None
+            chunks.append(chunk)
+        return EncodedRows(chunks, dset.shape, dset.dtype, chunk_rows, level)
+
+    @staticmethod
+    def _read_h5_shard(
+        input_file: Path,
+        fields: List[str],
+        raw_layouts: Optional[Dict[str, Tuple[int, int]]] = None,
+    ) -> Tuple[Union[Dict[str, Any], str], float]:
+        """`fields` of `input_file` (or why they can not be read) and the read time.
+
+        The fields in `raw_layouts`, which maps them to the chunk rows and
+        gzip level of the output, are read as :obj:`EncodedRows` when the
+        file stores them the same way.
+        """
+        start = time.perf_counter()
+        raw_layouts = raw_layouts or {}
+        try:
+            with h5py.File(input_file, "r") as f:
+                data: Union[Dict[str, Any], str] = {}
+                for key in fields:
+                    value = None
+                    if key in raw_layouts:
+                        value = H5PreprocessMixin.read_raw_chunks(
+                            f[key], *raw_layouts[key]
+                        )
+                    data[key] = f[key][...] if value is None else value
+        except Exception as exc:
+            data = f"{type(exc).__name__}: {exc}"
+        return data, time.perf_counter() - start
+
+    @staticmethod
+    def decoded_bytes(
+        file: Path, schema: Dict[str, Tuple[Tuple[int, ...], np.dtype]]
+    ) -> int:
+        """Estimate of the memory taken by the fields of `file` once read."""
+        nbytes = 0
+        for shape, dtype in schema.values():
+            if dtype.kind == "O":
+                # Variable length strings, their bytes are counted in the
+                # size of the file and the objects take about 64 bytes each
+                nbytes += 64 * int(np.prod(shape)) + file.stat().st_size
+            else:
+                nbytes += dtype.itemsize * int(np.prod(shape))
+        return nbytes
+
     @staticmethod
     def concatenate_h5(
         input_files: List[Path],
         output_file: Path,
         num_workers: int = 1,
-        files_per_write: int = 1,
-    ) -> None:
+        buffer_bytes: int = 1 << 31,
+        compression: Optional[Dict[str, str]] = None,
+        chunk_rows: Optional[int] = None,
+        skip_invalid: bool = False,
+    ) -> Dict[Path, str]:
         """Concatenate many HDF5 files into a single large HDF5 file.
-        .
+
+        A pool of `num_workers` processes reads the files ahead while the
+        data already read is written, in the order of `input_files`. Half
+        of `buffer_bytes` bounds the (estimated) size of the files being
+        read and the other half the data gathered for the next write. The
+        output is written with :obj:`H5Writer`, an interrupted concatenation
+        resumes after the files it already holds.
+
+        Gzip fields that the files store with the chunk shape and level of
+        the output are copied chunk by chunk, without decompressing and
+        compressing them again. Chunks only line up if the files fill their
+        last chunk: a file whose length is not a multiple of the chunk rows
+        is decompressed by the readers, and the files written after it are
+        recompressed until the output ends on a chunk boundary again. Files
+        written with `chunk_rows=1`, or lengths that are multiples of it, are
+        all copied.
+
         Parameters
         ----------
         input_files : List[Path]
             List of HDF5 file names to concatenate.
         output_file : Path
-            Name of output virtual HDF5 file.
+            Name of output HDF5 file.
         num_workers : int, default=1
-            Number of process to use for reading the data lengths from each file.
-        files_per_write: int, default=1
-            To speed things up, set this to the maximum amount of files that can
-            be stored in memory before performing a write operation. Files will
-            be read in parallel with num_workers processes.
+            Number of processes reading the files.
+        buffer_bytes : int, default=2GB
+            Memory to use for the data read and not yet written.
+        compression : Optional[Dict[str, str]], default=None
+            Codec of each field, see :obj:`H5Writer`. Gzip level 6 by default.
+        chunk_rows : Optional[int], default=None
+            Records per chunk of the fields stored in rows, see :obj:`H5Writer`.
+        skip_invalid : bool, default=False
+            Leave out the files that can not be read or whose fields do not
+            match the other files, instead of raising a ValueError.
+
+        Returns
+        -------
+        Dict[Path, str]
+            The files that were left out and why.
         """
-        with ExitStack() as stack:
-            # Open all HDF5 files
-            # h5_files = [stack.enter_context(h5py.File(f, "r")) for f in input_files]
-
-            in_h5 = stack.enter_context(h5py.File(input_files[0], "r"))
-            # Open HDF5 file to write to
-            out_h5 = stack.enter_context(h5py.File(output_file, "w"))
-
-            # Compute max shapes with the first file
-            fields = list(in_h5.keys())
-            # Set max shape given the inner dimension of each field
-            maxshapes = {key: (None, *in_h5[key].shape[1:]) for key in fields}
-
-            h5_datasets = {
-                key: out_h5.create_dataset(
-                    key,
-                    in_h5[key].shape,
-                    dtype=in_h5[key].dtype,
-                    maxshape=maxshapes[key],
-                    chunks=True,
-                    compression="gzip",
-                    compression_opts=6,
-                )
-                for key in fields
-            }
-
-            pool = ProcessPoolExecutor(max_workers=num_workers)
-
-            prev_shape_counter = 0
-            for i in tqdm(range(0, len(input_files), files_per_write)):
-
-                start = time.time()
+        schemas = H5PreprocessMixin.read_h5_schemas(input_files, num_workers)
+        expected, invalid = H5PreprocessMixin.validate_h5_schemas(
+            input_files, schemas, None
+        )
+        H5PreprocessMixin.report_invalid(
+            invalid, len(input_files), output_file, skip_invalid
+        )
+        if not expected:
+            raise ValueError("No fields found in HDF5 file.")
+        fields = list(expected)
+        costs = {
+            file: H5PreprocessMixin.decoded_bytes(file, schema)
+            for file, schema in zip(input_files, schemas)
+            if file not in invalid
+        }
 
-                # Read many smaller h5 files in parallel
-                all_dsets = []
-                for dsets in pool.map(
-                    H5PreprocessMixin.read_h5_fields,
-                    input_files[i : i + files_per_write],
-                ):
-                    all_dsets.append(dsets)
-
-                print("Read time:", time.time() - start)
-
-                start = time.time()
-
-                bad_dsets_inds = []
-                for i, dset in enumerate(all_dsets):
-                    for key in fields:
-                        if key not in dset:
-                            bad_dsets_inds.append(i)
-                # Gather each dataset into a single array to make a single write
-                all_dsets = {
-                    key: np.concatenate(
-                        [
-                            dsets[key]
-                            for i, dsets in enumerate(all_dsets)
-                            if i not in bad_dsets_inds
-                        ]
+        writer = H5Writer(
+            output_file,
+            dtypes={key: dtype for key, (_, dtype) in expected.items()},
+            compression=compression,
+            chunk_rows=chunk_rows,
+        )
+        # Fields whose chunks may be copied as they are
+        raw_layouts = {}
+        for key, (row_shape, dtype) in expected.items():
+            codec, _, level = field_codec(compression, key).partition(":")
+            if codec == "gzip" and dtype.kind in "biuf":
+                rows = H5Writer.chunk_rows(dtype, row_shape, chunk_rows)
+                raw_layouts[key] = (rows, int(level or 6))
+
+        # Files already written by an interrupted run, including left out ones
+        files = input_files[writer.num_inputs :]
+        if writer.num_inputs:
+            print(f"Resuming after {writer.num_inputs} files")
+
+        read_time, write_time = 0.0, 0.0
+        buffer: Dict[str, List[Any]] = defaultdict(list)
+        buffered_bytes, buffered_files = 0, 0
+
+        def flush() -> None:
+            nonlocal write_time, buffered_bytes, buffered_files
+            start = time.perf_counter()
+            if buffer:
+                block = {key: EncodedRows.concatenate(buffer[key]) for key in fields}
+                writer.write(
+                    block, num_records=len(block[fields[0]]), num_inputs=buffered_files
+                )
+            else:
+                # Only left out files since the last write, record the progress
+                writer.write({}, num_records=0, num_inputs=buffered_files)
+            write_time += time.perf_counter() - start
+            buffer.clear()
+            buffered_bytes, buffered_files = 0, 0
+
+        start = time.perf_counter()
+        read = functools.partial(
+            H5PreprocessMixin._read_h5_shard, fields=fields, raw_layouts=raw_layouts
+        )
+        with writer, ProcessPoolExecutor(max_workers=num_workers) as pool:
+            results = ordered_map(
+                pool,
+                read,
+                (file for file in files if file not in invalid),
+                buffer_bytes // 2,
+                cost=costs.__getitem__,
+            )
+            for file in tqdm(files):
+                buffered_files += 1
+                if file in invalid:
+                    continue
+                data, seconds = next(results)
+                read_time += seconds
+                if isinstance(data, str):
+                    # Passed the schema check but its data is corrupt
+                    invalid[file] = data
+                    H5PreprocessMixin.report_invalid(
+                        {file: data}, len(input_files), output_file, skip_invalid
                     )
-                    for key in fields
-                }
+                    continue
+                for key in fields:
+                    buffer[key].append(data[key])
+                buffered_bytes += costs[file]
+                if buffered_bytes >= buffer_bytes // 2:
+                    flush()
+            if buffered_files:
+                flush()
+            num_records, chunks_copied = writer.num_records, writer.chunks_copied
+        wall_time = time.perf_counter() - start
+
+        # Reads are spread over the workers, the rest of the wall time is
+        # what was not overlapped
+        overlap = max(0.0, read_time / num_workers + write_time - wall_time)
+        print(f"Total sequences: {num_records}")
+        print(
+            f"Read time: {read_time:.1f}s over {num_workers} workers, "
+            f"write time: {write_time:.1f}s, wall time: {wall_time:.1f}s, "
+            f"overlapped: {overlap:.1f}s"
+        )
+        print(f"Chunks copied without recompressing: {chunks_copied}")
+        return invalid
 
-                print("Gather time:", time.time() - start)
-                start = time.time()
-                resize_total_time = 0
-                write_total_time = 0
+    @staticmethod
+    def num_rows(
+        schema: Dict[str, Tuple[Tuple[int, ...], np.dtype]], file: Path
+    ) -> int:
+        """Number of rows (samples) in a file, which all the other fields
+        but the flat ones must have."""
+        rows = {
+            key: shape[0]
+            for key, (shape, _) in schema.items()
+            if FLAT_FIELD_COUNTS.get(key) not in schema
+        }
+        lengths = set(rows.values())
+        if len(lengths) > 1:
+            raise ValueError(
+                f"Fields of {file} differ in length ({rows}), select the fields "
+                "of the rows (e.g. files with packed records store the ids per record)"
+            )
+        return lengths.pop() if lengths else 0
 
-                # Concatenated length dimension of the incomming datasets
-                inshape = all_dsets[fields[0]].shape[0]
-                start = time.time()
-                for key, dset in h5_datasets.items():
-                    t_resize = time.time()
-                    dset.resize(prev_shape_counter + inshape, axis=0)
-                    resize_total_time += time.time() - t_resize
+    @staticmethod
+    def shard_bounds(
+        num_rows: int,
+        num_bytes: int,
+        num_shards: Optional[int] = None,
+        shard_records: Optional[int] = None,
+        shard_bytes: Optional[int] = None,
+    ) -> np.ndarray:
+        """First row of each of the equal length shards, followed by `num_rows`.
+
+        The number of shards is `num_shards`, or enough shards for at most
+        `shard_records` rows or about `shard_bytes` of the `num_bytes`.
+        """
+        if [num_shards, shard_records, shard_bytes].count(None) != 2:
+            raise ValueError("Give one of num_shards, shard_records or shard_bytes")
+        if shard_records is not None:
+            num_shards = -(-num_rows // shard_records)
+        elif shard_bytes is not None:
+            num_shards = -(-num_bytes // shard_bytes)
+        num_shards = max(1, min(num_shards, num_rows))  # type: ignore[type-var]
+        # Shard lengths differ by at most one row
+        return np.arange(num_shards + 1) * num_rows // num_shards
 
-                    t_write = time.time()
-                    dset[-inshape:] = all_dsets[key]  # Single write of many in-h5 files
-                    write_total_time += time.time() - t_write
+    @staticmethod
+    def reshard_h5(
+        input_files: List[Path],
+        manifest_file: Path,
+        num_shards: Optional[int] = None,
+        shard_records: Optional[int] = None,
+        shard_bytes: Optional[int] = None,
+        fields: Optional[List[str]] = None,
+        num_workers: int = 1,
+        buffer_bytes: int = 1 << 31,
+        compression: Optional[Dict[str, str]] = None,
+        chunk_rows: Optional[int] = None,
+        skip_invalid: bool = False,
+    ) -> Dict[Path, str]:
+        """Rebalance the rows of HDF5 files into shards of equal length.
+
+        The shards are written next to `manifest_file` as
+        `{stem}_{shard:05d}.h5`, the JSON manifest lists them with the
+        cumulative number of rows before each shard (see
+        :obj:`ShardedH5Dataset`). Rows keep the order of `input_files`,
+        which are read ahead as in :obj:`concatenate_h5`. Give one of
+        `num_shards`, `shard_records` or `shard_bytes`.
 
-                print("Write time: ", time.time() - start)
-                print("Write only time: ", write_total_time)
-                print("Resize only time: ", resize_total_time)
-                prev_shape_counter += inshape
+        Parameters
+        ----------
+        input_files : List[Path]
+            List of HDF5 file names to reshard.
+        manifest_file : Path
+            JSON manifest to write, existing shards of the same name are replaced.
+        num_shards : Optional[int], default=None
+            Number of shards.
+        shard_records : Optional[int], default=None
+            Maximum rows per shard.
+        shard_bytes : Optional[int], default=None
+            Target size of each shard, estimated from the size of the input
+            files (whose compression should then be the same).
+        fields : Optional[List[str]], default=None
+            Fields to write, all of them by default. Fields other than the
+            flat ones (e.g. the ragged tokens) must have a value per row,
+            flat fields must be selected with their count field (lengths).
+        num_workers : int, default=1
+            Number of processes reading the files.
+        buffer_bytes : int, default=2GB
+            Memory to use for the data read and not yet written.
+        compression : Optional[Dict[str, str]], default=None
+            Codec of each field, see :obj:`H5Writer`. Gzip level 6 by default.
+        chunk_rows : Optional[int], default=None
+            Records per chunk of the fields stored in rows, see :obj:`H5Writer`.
+        skip_invalid : bool, default=False
+            Leave out the files that can not be read or whose fields do not
+            match the other files, instead of raising a ValueError.
+
+        Returns
+        -------
+        Dict[Path, str]
+            The files that were left out and why.
+        """
+        # Check the arguments before reading the files
+        H5PreprocessMixin.shard_bounds(1, 1, num_shards, shard_records, shard_bytes)
+        schemas = H5PreprocessMixin.read_h5_schemas(input_files, num_workers)
+        expected, invalid = H5PreprocessMixin.validate_h5_schemas(
+            input_files, schemas, fields
+        )
+        H5PreprocessMixin.report_invalid(
+            invalid, len(input_files), manifest_file, skip_invalid
+        )
+        fields = list(expected)
+        files, lengths, costs = [], [], {}
+        for file, schema in zip(input_files, schemas):
+            if file in invalid:
+                continue
+            schema = {key: schema[key] for key in fields}  # type: ignore[index]
+            files.append(file)
+            lengths.append(H5PreprocessMixin.num_rows(schema, file))
+            costs[file] = H5PreprocessMixin.decoded_bytes(file, schema)
+        total = sum(lengths)
+        if not total:
+            raise ValueError("No rows found in the HDF5 files.")
+
+        bounds = H5PreprocessMixin.shard_bounds(
+            total,
+            sum(file.stat().st_size for file in files),
+            num_shards,
+            shard_records,
+            shard_bytes,
+        )
+        num_shards = len(bounds) - 1
+        manifest_file = Path(manifest_file)
+        shard_files = [
+            manifest_file.parent / f"{manifest_file.stem}_{shard:05d}.h5"
+            for shard in range(num_shards)
+        ]
+        manifest_file.parent.mkdir(parents=True, exist_ok=True)
+
+        def open_shard(shard: int) -> H5Writer:
+            # Replace any partial file instead of resuming it
+            shard_files[shard].unlink(missing_ok=True)
+            return H5Writer(
+                shard_files[shard],
+                dtypes={key: dtype for key, (_, dtype) in expected.items()},
+                compression=compression,
+                chunk_rows=chunk_rows,
+            )
+
+        read_time, write_time = 0.0, 0.0
+        buffer: List[Dict[str, Any]] = []
+        buffered_bytes, buffered_rows = 0, 0
+        shard, row = 0, 0  # Shard being written and the next global row
+        writer = open_shard(shard)
+
+        def flush() -> None:
+            nonlocal write_time, buffered_bytes, buffered_rows
+            start = time.perf_counter()
+            block = {
+                key: np.concatenate([part[key] for part in buffer]) for key in fields
+            }
+            writer.write(block, num_records=buffered_rows)
+            write_time += time.perf_counter() - start
+            buffer.clear()
+            buffered_bytes, buffered_rows = 0, 0
 
-            pool.shutdown()
+        start = time.perf_counter()
+        read = functools.partial(H5PreprocessMixin._read_h5_shard, fields=fields)
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            results = ordered_map(
+                pool, read, files, buffer_bytes // 2, cost=costs.__getitem__
+            )
+            for file, length, (data, seconds) in zip(tqdm(files), lengths, results):
+                read_time += seconds
+                if isinstance(data, str):
+                    raise ValueError(f"Could not read {file}: {data}")
+                pos = 0
+                while pos < length:
+                    take = min(length - pos, int(bounds[shard + 1]) - row)
+                    buffer.append(slice_rows(data, pos, pos + take))
+                    buffered_bytes += costs[file] * take // length
+                    buffered_rows += take
+                    pos += take
+                    row += take
+                    if row == bounds[shard + 1]:
+                        flush()
+                        writer.close()
+                        shard += 1
+                        if shard < num_shards:
+                            writer = open_shard(shard)
+                    elif buffered_bytes >= buffer_bytes // 2:
+                        flush()
+        wall_time = time.perf_counter() - start
+
+        manifest = {
+            "shards": [shard_file.name for shard_file in shard_files],
+            "offsets": bounds.tolist(),
+            "fields": fields,
+        }
+        # Readers never see a partial manifest
+        tmp_file = manifest_file.with_suffix(".tmp")
+        tmp_file.write_text(json.dumps(manifest, indent=2))
+        os.replace(tmp_file, manifest_file)
+
+        print(f"Total sequences: {total} in {num_shards} shards")
+        print(
+            f"Read time: {read_time:.1f}s over {num_workers} workers, "
+            f"write time: {write_time:.1f}s, wall time: {wall_time:.1f}s"
+        )
+        return invalid
 
     @staticmethod
     def read_h5_to_fasta_entries(input_file: Path, num_slice: int = 1) -> List[str]:
         """Returns a list of fasta entries >description\nsequence"""
         with h5py.File(input_file, "r") as f:
-            descriptions = f["description"][0:-1:num_slice]
-            sequences = f["sequence"][0:-1:num_slice]
+            descriptions = f["description"][::num_slice]
+            if "sequence" in f:
+                sequences = [s.decode("utf-8") for s in f["sequence"][::num_slice]]
+            else:
+                packed = {key: f[key][...] for key in PACKED_SEQUENCE_FIELDS}
+                sequences = unpack_nucleotides(**packed)[::num_slice]
 
-        return [
-            f'>{d.decode("utf-8")}\n{s.decode("utf-8")}\n'
-            for d, s in zip(descriptions, sequences)
-        ]
+        return [f'>{d.decode("utf-8")}\n{s}\n' for d, s in zip(descriptions, sequences)]
+
+    @staticmethod
+    def read_h5_fasta_chunk(
+        input_file: Path, start: int, stop: int, num_slice: int = 1
+    ) -> bytes:
+        """Fasta entries of the records `start:stop:num_slice` of `input_file`."""
+        with h5py.File(input_file, "r") as f:
+            descriptions = f["description"][start:stop:num_slice]
+            if "sequence" in f:
+                sequences = list(f["sequence"][start:stop:num_slice])
+            else:
+                sequences = [
+                    seq.encode("utf-8")
+                    for seq in read_packed_sequences(input_file, start, stop)[
+                        ::num_slice
+                    ]
+                ]
+        lines = []
+        for description, sequence in zip(descriptions, sequences):
+            lines += [b">", description, b"\n", sequence, b"\n"]
+        return b"".join(lines)
+
+    @staticmethod
+    def _h5_fasta_task(
+        task: Tuple[Path, int, int], num_slice: int, compresslevel: Optional[int]
+    ) -> bytes:
+        data = H5PreprocessMixin.read_h5_fasta_chunk(*task, num_slice=num_slice)
+        if compresslevel is None:
+            return data
+        # Concatenated gzip members are a valid gzip file
+        return gzip.compress(data, compresslevel, mtime=0)
 
     @staticmethod
     def h5_to_fasta(
@@ -432,16 +2038,77 @@ class H5PreprocessMixin:
         output_fasta: Path,
         num_workers: int = 1,
         num_slice: int = 1,
-    ) -> None:
+        chunk_rows: int = 8192,
+        compresslevel: int = 6,
+        skip_invalid: bool = False,
+    ) -> int:
+        """Write the records of HDF5 files to a fasta file, in the order of the files.
 
-        read_h5_seq_desc = functools.partial(
-            H5PreprocessMixin.read_h5_to_fasta_entries, num_slice=num_slice
+        Workers convert chunks of `chunk_rows` records (so their memory does
+        not grow with the files) and a single writer appends them in order,
+        with at most two chunks per worker waiting. An `output_fasta` ending
+        in `.gz` is written as gzip, each chunk being compressed by a worker.
+
+        Parameters
+        ----------
+        input_files : List[Path]
+            HDF5 files with a `description` field and the sequences, as
+            strings or packed with pack_sequences.
+        output_fasta : Path
+            Fasta file to write.
+        num_workers : int, default=1
+            Number of processes converting the chunks.
+        num_slice : int, default=1
+            Keep every `num_slice` record of each file, starting at the first.
+        chunk_rows : int, default=8192
+            Records read by a worker at once.
+        compresslevel : int, default=6
+            Gzip level of a `.gz` output.
+        skip_invalid : bool, default=False
+            Leave out the files that can not be read or have no descriptions,
+            instead of raising a ValueError.
+
+        Returns
+        -------
+        int
+            Number of records written.
+        """
+        schemas = H5PreprocessMixin.read_h5_schemas(input_files, num_workers)
+        invalid = {
+            file: schema if isinstance(schema, str) else "no description field"
+            for file, schema in zip(input_files, schemas)
+            if isinstance(schema, str) or "description" not in schema
+        }
+        H5PreprocessMixin.report_invalid(
+            invalid, len(input_files), output_fasta, skip_invalid
         )
 
-        with open(output_fasta, "w") as f:
+        # Chunks start on a multiple of num_slice to keep the records of a
+        # whole file slice
+        stride = -(-chunk_rows // num_slice) * num_slice
+        tasks = []
+        num_records = 0
+        for file, schema in zip(input_files, schemas):
+            if file in invalid:
+                continue
+            length = schema["description"][0][0]  # type: ignore[index]
+            num_records += -(-length // num_slice)
+            for start in range(0, length, stride):
+                tasks.append((file, start, min(start + stride, length)))
+
+        convert = functools.partial(
+            H5PreprocessMixin._h5_fasta_task,
+            num_slice=num_slice,
+            compresslevel=compresslevel if output_fasta.suffix == ".gz" else None,
+        )
+        with open(output_fasta, "wb") as f:
             with ProcessPoolExecutor(max_workers=num_workers) as pool:
-                for fasta_lines in pool.map(read_h5_seq_desc, input_files):
-                    f.writelines(fasta_lines)
+                for data in tqdm(
+                    ordered_map(pool, convert, tasks, 2 * num_workers),
+                    total=len(tasks),
+                ):
+                    f.write(data)
+        return num_records
 
 
 class H5Dataset(Dataset, H5PreprocessMixin):
@@ -459,22 +2126,29 @@ class H5Dataset(Dataset, H5PreprocessMixin):
         self.tokenizer = tokenizer
 
         with h5py.File(file_path, "r") as f:
+            # Files written with ragged=True (v2 schema) are not padded
+            self.ragged = "tokens" in f
+            # Files written with pack_records hold several records per row
+            self.packed = "segment_ids" in f
             # fetch all samples from the dataset
-            self.input_ids = f["input_ids"][...]
-            self.attn_masks = f["attention_mask"][...]
+            keys = RAGGED_TOKEN_FIELDS if self.ragged else PADDED_TOKEN_FIELDS
+            self.data = {key: f[key][...] for key in keys if key in f}
+
+        self.offsets: Optional[np.ndarray] = None
+        if self.ragged:
+            self.offsets = ragged_offsets(self.data["lengths"])
+            self._len = len(self.data["lengths"])
+        else:
+            self._len = len(self.data["input_ids"])
 
         if small_subset:
-            self.input_ids = self.input_ids[:small_subset]
-            self.attn_masks = self.attn_masks[:small_subset]
+            self._len = min(small_subset, self._len)
 
     def __len__(self) -> int:
-        return len(self.input_ids)
+        return self._len
 
     def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
-        return {
-            "input_ids": torch.tensor(self.input_ids[idx]).long(),
-            "attention_mask": torch.tensor(self.attn_masks[idx]).long(),
-        }
+        return h5_model_inputs(read_h5_sample(self.data, idx, self.offsets))
 
 
 class CachingH5Dataset(Dataset, H5PreprocessMixin):
@@ -483,8 +2157,17 @@ class CachingH5Dataset(Dataset, H5PreprocessMixin):
         self.file_path = file_path
 
         # Peek into file to get dataset length
+        self.offsets: Optional[np.ndarray] = None
         with h5py.File(file_path, "r") as f:
-            self._len = f["input_ids"].shape[0]
+            # Files written with ragged=True (v2 schema) are not padded
+            self.ragged = "tokens" in f
+            # Files written with pack_records hold several records per row
+            self.packed = "segment_ids" in f
+            if self.ragged:
+                self.offsets = ragged_offsets(f["lengths"][...])
+                self._len = len(self.offsets) - 1
+            else:
+                self._len = f["input_ids"].shape[0]
 
         if small_subset:
             self._len = min(small_subset, self._len)
@@ -496,17 +2179,11 @@ class CachingH5Dataset(Dataset, H5PreprocessMixin):
         return self._len
 
     def get_sample(self, idx: int) -> Dict[str, torch.Tensor]:
-        sample = self.samples[idx]
-        return {
-            "input_ids": torch.tensor(sample["input_ids"]).long(),
-            "attention_mask": torch.tensor(sample["attention_mask"]).long(),
-        }
+        return h5_model_inputs(self.samples[idx])
 
     def cache_sample_from_h5(self, idx: int) -> None:
-        # Accessing self.h5_file may raise AttributeError
-        self.samples[idx] = {
-            key: self.h5_file[key][idx][...] for key in ["input_ids", "attention_mask"]
-        }
+        # Accessing self.h5_datasets may raise AttributeError
+        self.samples[idx] = read_h5_sample(self.h5_datasets, idx, self.offsets)
 
     def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
         try:
@@ -519,6 +2196,8 @@ class CachingH5Dataset(Dataset, H5PreprocessMixin):
         except AttributeError:
             # Need to open the H5 file in the getitem worker process
             self.h5_file = h5py.File(self.file_path, "r")
+            # Reopening a dataset on every read would drop its chunk cache
+            self.h5_datasets = {key: self.h5_file[key] for key in self.h5_file}
             self.cache_sample_from_h5(idx)
 
         return self.get_sample(idx)
@@ -530,18 +2209,24 @@ class FileBackedH5Dataset(Dataset, H5PreprocessMixin):
         self.file_path = file_path
 
         # Peek into file to get dataset length
+        self.offsets: Optional[np.ndarray] = None
         with h5py.File(file_path, "r") as f:
-            self._len = f["input_ids"].shape[0]
+            # Files written with ragged=True (v2 schema) are not padded
+            self.ragged = "tokens" in f
+            # Files written with pack_records hold several records per row
+            self.packed = "segment_ids" in f
+            if self.ragged:
+                self.offsets = ragged_offsets(f["lengths"][...])
+                self._len = len(self.offsets) - 1
+            else:
+                self._len = f["input_ids"].shape[0]
 
     def __len__(self) -> int:
         return self._len
 
     def read_from_h5(self, idx: int) -> Dict[str, torch.Tensor]:
-        # Accessing self.h5_file may raise AttributeError
-        sample = {
-            key: torch.tensor(self.h5_file[key][idx][...]).long()
-            for key in ["input_ids", "attention_mask"]
-        }
+        # Accessing self.h5_datasets may raise AttributeError
+        sample = h5_model_inputs(read_h5_sample(self.h5_datasets, idx, self.offsets))
         sample["indices"] = torch.from_numpy(np.array([idx]))
         return sample
 
@@ -551,12 +2236,109 @@ class FileBackedH5Dataset(Dataset, H5PreprocessMixin):
         except AttributeError:
             # Need to open the H5 file in the getitem worker process
             self.h5_file = h5py.File(self.file_path, "r")
+            # Reopening a dataset on every read would drop its chunk cache
+            self.h5_datasets = {key: self.h5_file[key] for key in self.h5_file}
 
         return self.read_from_h5(idx)
 
 
+class ShardedH5Dataset(Dataset, H5PreprocessMixin):
+    def __init__(
+        self,
+        manifest_file: PathLike,
+        max_open_files: int = 8,
+        small_subset: int = 0,
+        **extra: Any,
+    ) -> None:
+        """Samples of the shards listed in a manifest written by `reshard_h5`.
+
+        Each process (e.g. each dataloader worker) keeps at most
+        `max_open_files` shards open, closing the least recently used one.
+        """
+        # Data is preprocessed and does not require tokenizer, etc
+        self.manifest_file = Path(manifest_file)
+        manifest = json.loads(self.manifest_file.read_text())
+        self.shard_files = [
+            self.manifest_file.parent / name for name in manifest["shards"]
+        ]
+        self.shard_offsets = np.array(manifest["offsets"], dtype=np.int64)
+        self.max_open_files = max_open_files
+
+        with h5py.File(self.shard_files[0], "r") as f:
+            # Files written with ragged=True (v2 schema) are not padded
+            self.ragged = "tokens" in f
+            # Files written with pack_records hold several records per row
+            self.packed = "segment_ids" in f
+
+        self._len = int(self.shard_offsets[-1])
+        if small_subset:
+            self._len = min(small_subset, self._len)
+
+        # Open shards of this process: the file, its datasets and row offsets
+        self._shards: "OrderedDict[int, Tuple[h5py.File, Dict[str, h5py.Dataset], Optional[np.ndarray]]]" = (
+            OrderedDict()
+        )
+        self._pid = os.getpid()
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Open files can not be pickled, e.g. to spawn the dataloader workers
+        state = self.__dict__.copy()
+        state["_shards"] = OrderedDict()
+        return state
+
+    def locate(self, idx: int) -> Tuple[int, int]:
+        """The shard of sample `idx` and its row in the shard.
+
+        The shards are (nearly) equal in length, so the first guess is at
+        most a shard away.
+        """
+        num_shards = len(self.shard_files)
+        shard = min(idx * num_shards // int(self.shard_offsets[-1]), num_shards - 1)
+        while idx < self.shard_offsets[shard]:
+            shard -= 1
+        while idx >= self.shard_offsets[shard + 1]:
+            shard += 1
+        return shard, idx - int(self.shard_offsets[shard])
+
+    def open_shard(
+        self, shard: int
+    ) -> Tuple[h5py.File, Dict[str, h5py.Dataset], Optional[np.ndarray]]:
+        if self._pid != os.getpid():
+            # Files opened before forking the dataloader workers can not be shared
+            self._shards = OrderedDict()
+            self._pid = os.getpid()
+        if shard in self._shards:
+            self._shards.move_to_end(shard)
+            return self._shards[shard]
+
+        if len(self._shards) >= self.max_open_files:
+            h5_file = self._shards.popitem(last=False)[1][0]
+            h5_file.close()
+        h5_file = h5py.File(self.shard_files[shard], "r")
+        # Reopening a dataset on every read would drop its chunk cache
+        h5_datasets = {key: h5_file[key] for key in h5_file}
+        offsets = ragged_offsets(h5_datasets["lengths"][...]) if self.ragged else None
+        self._shards[shard] = (h5_file, h5_datasets, offsets)
+        return self._shards[shard]
+
+    def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
+        shard, row = self.locate(idx)
+        _, h5_datasets, offsets = self.open_shard(shard)
+        sample = h5_model_inputs(read_h5_sample(h5_datasets, row, offsets))
+        sample["indices"] = torch.from_numpy(np.array([idx]))
+        return sample
+
+
 class SequenceDataset(Dataset):  # type: ignore[type-arg]
-    """Dataset initialized from a list of sequence strings."""
+    """Dataset initialized from a list of sequence strings.
+
+    The sequences are tokenized in batches into one contiguous array using
+    the smallest integer type that fits the vocabulary. With `lazy=True`
+    only the strings are kept and each sample is tokenized when accessed.
+    """
 
     def __init__(
         self,
@@ -565,10 +2347,28 @@ class SequenceDataset(Dataset):  # type: ignore[type-arg]
         tokenizer: PreTrainedTokenizerFast,
         kmer_size: int = 3,
         verbose: bool = True,
+        lazy: bool = False,
+        batch_size: int = 4096,
+        num_workers: int = 1,
     ):
-        self.batch_encodings = self.tokenize_sequences(
-            sequences, tokenizer, seq_length, kmer_size, verbose
-        )
+        self.seq_length = seq_length
+        self.kmer_size = kmer_size
+        self.lazy = lazy
+        self.tokenizer = KmerTokenizer(tokenizer)
+        if lazy:
+            self.sequences = sequences
+        else:
+            encoding = self.tokenize_sequences(
+                sequences,
+                tokenizer,
+                seq_length,
+                kmer_size,
+                verbose,
+                batch_size,
+                num_workers,
+            )
+            self.input_ids = encoding["input_ids"]
+            self.attention_mask = encoding["attention_mask"]
 
     @staticmethod
     def tokenize_sequences(
@@ -577,35 +2377,72 @@ class SequenceDataset(Dataset):  # type: ignore[type-arg]
         seq_length: int,
         kmer_size: int = 3,
         verbose: bool = True,
-    ) -> List[BatchEncoding]:
+        batch_size: int = 4096,
+        num_workers: int = 1,
+    ) -> Dict[str, np.ndarray]:
+        """Tokenize sequences into (len(sequences), seq_length) arrays.
+
+        `input_ids` uses the smallest unsigned integer type that holds
+        every token id and `attention_mask` is boolean.
+        """
+        dtype = np.min_scalar_type(len(tokenizer))
+        input_ids = np.empty((len(sequences), seq_length), dtype=dtype)
+        attention_mask = np.empty((len(sequences), seq_length), dtype=bool)
 
         tokenizer_fn = functools.partial(
-            tokenizer,
+            KmerTokenizer(tokenizer),
+            kmer_size=kmer_size,
             max_length=seq_length,
-            padding="max_length",
-            truncation=True,
-            return_tensors="pt",
+            dtype=dtype,
         )
-
-        batch_encodings = [
-            tokenizer_fn(SequenceDataset.group_by_kmer(seq, kmer_size))
-            for seq in tqdm(sequences, desc="Tokenizing...", disable=not verbose)
+        batches = [
+            sequences[i : i + batch_size] for i in range(0, len(sequences), batch_size)
         ]
-        return batch_encodings
+        with ExitStack() as stack:
+            if num_workers > 1:
+                pool = stack.enter_context(ProcessPoolExecutor(num_workers))
+                encodings = pool.map(tokenizer_fn, batches)
+            else:
+                encodings = map(tokenizer_fn, batches)
+
+            for i, encoding in enumerate(
+                tqdm(
+                    encodings,
+                    desc="Tokenizing...",
+                    total=len(batches),
+                    disable=not verbose,
+                )
+            ):
+                batch = slice(i * batch_size, (i + 1) * batch_size)
+                input_ids[batch] = encoding["input_ids"]
+                attention_mask[batch] = encoding["attention_mask"]
+
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
 
     @staticmethod
     def group_by_kmer(seq: str, kmer: int) -> str:
         return " ".join(seq[i : i + kmer] for i in range(0, len(seq), kmer)).upper()
 
     def __len__(self) -> int:
-        return len(self.batch_encodings)
+        return len(self.sequences) if self.lazy else len(self.input_ids)
 
     def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
-        batch_encoding = self.batch_encodings[idx]
+        if self.lazy:
+            encoding = self.tokenizer(
+                [self.sequences[idx]], self.kmer_size, self.seq_length
+            )
+            input_ids, attention_mask = (
+                encoding["input_ids"],
+                encoding["attention_mask"],
+            )
+        else:
+            input_ids = self.input_ids[idx : idx + 1]
+            attention_mask = self.attention_mask[idx : idx + 1]
+
         # Squeeze so that batched tensors end up with (batch_size, seq_length)
         # instead of (batch_size, 1, seq_length)
         sample = {
-            "input_ids": batch_encoding["input_ids"].squeeze(),
-            "attention_mask": batch_encoding["attention_mask"],
+            "input_ids": torch.from_numpy(input_ids.astype(np.int64)).squeeze(),
+            "attention_mask": torch.from_numpy(attention_mask.astype(np.int64)),
         }
         return sample
@@ -1,8 +1,10 @@
+import functools
 import json
 import os
 import warnings
 from argparse import ArgumentParser
-from typing import Any, Dict, List
+from pathlib import Path
+from typing import Any, Dict, List, Union
 
 import pytorch_lightning as pl
 import torch
@@ -30,7 +32,13 @@ from transformers.utils import ModelOutput
 
 from genslm.blast import BLASTCallback
 from genslm.config import ModelSettings, PathLike, throughput_config
-from genslm.dataset import CachingH5Dataset
+from genslm.dataset import (
+    CachingH5Dataset,
+    ShardedH5Dataset,
+    check_packed_support,
+    packed_attention_mask,
+    pad_collate_fn,
+)
 from genslm.utils import (
     LoadDeepSpeedStrategy,
     LoadPTCheckpointStrategy,
@@ -43,9 +51,9 @@ from genslm.utils import (
 class DNATransformer(pl.LightningModule):
 
     cfg: ModelSettings
-    train_dataset: CachingH5Dataset
-    val_dataset: CachingH5Dataset
-    test_dataset: CachingH5Dataset
+    train_dataset: Union[CachingH5Dataset, ShardedH5Dataset]
+    val_dataset: Union[CachingH5Dataset, ShardedH5Dataset]
+    test_dataset: Union[CachingH5Dataset, ShardedH5Dataset]
 
     def __init__(self, cfg: ModelSettings, generation_flag: bool = False) -> None:
         super().__init__()
@@ -108,22 +116,45 @@ class DNATransformer(pl.LightningModule):
         if self.cfg.deepspeed_flops_profile:
             self.flops_profiler = FlopsProfiler(self.model)
 
-    def get_dataset(self, data_path: PathLike) -> CachingH5Dataset:
+    def get_dataset(
+        self, data_path: PathLike
+    ) -> Union[CachingH5Dataset, ShardedH5Dataset]:
         """Helper function to generate dataset."""
-        return CachingH5Dataset(
-            data_path,
-            block_size=self.cfg.block_size,
-            tokenizer=self.tokenizer,
-            kmer_size=self.cfg.kmer_size,
-            small_subset=self.cfg.small_subset,
-        )
+        dataset: Union[CachingH5Dataset, ShardedH5Dataset]
+        if Path(data_path).suffix == ".json":
+            # Manifest of the shards written by fasta_to_h5 --gather --shard_*
+            dataset = ShardedH5Dataset(data_path, small_subset=self.cfg.small_subset)
+        else:
+            dataset = CachingH5Dataset(
+                data_path,
+                block_size=self.cfg.block_size,
+                tokenizer=self.tokenizer,
+                kmer_size=self.cfg.kmer_size,
+                small_subset=self.cfg.small_subset,
+            )
+        if dataset.packed:
+            # Fail before training rather than in the first forward pass
+            check_packed_support(self.model)
+        return dataset
 
     def get_dataloader(
-        self, dataset: CachingH5Dataset, shuffle: bool, drop_last: bool = True
+        self,
+        dataset: Union[CachingH5Dataset, ShardedH5Dataset],
+        shuffle: bool,
+        drop_last: bool = True,
     ) -> DataLoader:
         """Helper function to generate dataloader."""
+        collate_fn = None
+        if dataset.ragged:
+            # Pad the rows of v2 files exactly like the padded (v1) files
+            collate_fn = functools.partial(
+                pad_collate_fn,
+                pad_token_id=self.tokenizer.pad_token_id,
+                max_length=self.cfg.block_size,
+            )
         return DataLoader(
             dataset,
+            collate_fn=collate_fn,
             shuffle=shuffle,
             drop_last=drop_last,
             batch_size=self.cfg.batch_size,
@@ -146,6 +177,18 @@ class DNATransformer(pl.LightningModule):
         return self.get_dataloader(self.test_dataset, shuffle=False)
 
     def forward(self, batch: Dict[str, torch.Tensor], **kwargs: Dict[str, Any]) -> ModelOutput:  # type: ignore[override]
+        if "segment_ids" in batch:
+            # Packed rows hold several records which must not attend to each other,
+            # get_dataset checked that the model supports this (check_packed_support)
+            return self.model(
+                batch["input_ids"],
+                labels=batch["labels"],
+                attention_mask=packed_attention_mask(
+                    batch["segment_ids"], self.model.dtype
+                ),
+                position_ids=batch["position_ids"],
+                **kwargs,
+            )
         out = self.model(
             batch["input_ids"],
             labels=batch["input_ids"],
@@ -339,6 +382,7 @@ def train(cfg: ModelSettings) -> None:  # noqa
                 num_test_seqs_per_gpu=cfg.num_test_seqs_per_gpu,
                 output_dir=cfg.checkpoint_dir / "generated",
                 custom_seq_name=cfg.custom_seq_name,
+                known_sequence_index=cfg.known_sequence_index,
             )
         )
 
@@ -0,0 +1,692 @@
+"""Vectorized tokenization of sequences into fixed-length k-mer words."""
+import copy
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import numpy as np
+import numpy.typing as npt
+from transformers import PreTrainedTokenizerFast
+
+from genslm.config import PathLike
+
+# Larger k-mer lookup tables fall back to the wrapped tokenizer
+_MAX_LUT_SIZE = 1 << 24
+
+# Bytes that form a single word under the Whitespace pre-tokenizer (\w+)
+_WORD_BYTES = np.zeros(256, dtype=bool)
+for _c in b"0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz":
+    _WORD_BYTES[_c] = True
+
+# With k=1 every printable character is its own word, punctuation included
+_PRINTABLE_BYTES = np.zeros(256, dtype=bool)
+_PRINTABLE_BYTES[0x21:0x7F] = True
+
+
+class KmerTokenizer:
+    """Tokenize sequences with a word-level vocabulary without building strings.
+
+    The HuggingFace path joins each sequence into space separated k-mers
+    (e.g. "ATG AAA TAA") which the tokenizer then splits again. Instead, the
+    upper cased bytes are viewed as a (num_kmers, k) array and mapped to
+    token ids through a lookup table built from the tokenizer's vocabulary.
+    Padding, truncation and the special tokens of a TemplateProcessing
+    post-processor are applied exactly as the wrapped tokenizer would, so
+    the output is identical. Sequences the lookup table can not represent
+    (e.g. whitespace or non-ASCII characters) and unsupported tokenizer
+    configurations are passed through the wrapped tokenizer.
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizerFast) -> None:
+        """Wrap a HuggingFace fast tokenizer.
+
+        Parameters
+        ----------
+        tokenizer : PreTrainedTokenizerFast
+            The tokenizer to replicate, must have a pad token for padding.
+        """
+        self.tokenizer = tokenizer
+        self.pad_token_id = tokenizer.pad_token_id
+        self.prefix: List[int] = []
+        self.suffix: List[int] = []
+        self._luts: Dict[int, Optional[np.ndarray]] = {}
+
+        config = json.loads(tokenizer.backend_tokenizer.to_str())
+        # The backend keeps the padding and truncation of the last call
+        config.pop("padding", None)
+        config.pop("truncation", None)
+        state = [config, self.pad_token_id, tokenizer.padding_side]
+        state.append(tokenizer.truncation_side)
+        self.fingerprint = hashlib.sha256(
+            json.dumps(state, sort_keys=True).encode("utf-8")
+        ).hexdigest()[:16]
+        """Identifies every setting that affects the token ids."""
+
+        self.vectorized = self._parse_config(config) and (
+            tokenizer.padding_side == "right" and tokenizer.truncation_side == "right"
+        )
+
+    def _parse_config(self, config: Dict) -> bool:  # type: ignore[type-arg]
+        model, pre_tokenizer = config["model"], config["pre_tokenizer"]
+        if model["type"] != "WordLevel" or config["normalizer"] is not None:
+            return False
+        if pre_tokenizer is None or pre_tokenizer["type"] != "Whitespace":
+            return False
+
+        post_processor = config["post_processor"]
+        if post_processor is not None:
+            if post_processor["type"] != "TemplateProcessing":
+                return False
+            special_tokens = post_processor["special_tokens"]
+            pieces = [next(iter(piece.items())) for piece in post_processor["single"]]
+            kinds = [kind for kind, _ in pieces]
+            if kinds.count("Sequence") != 1:
+                return False
+            split = kinds.index("Sequence")
+            for i, (kind, piece) in enumerate(pieces):
+                if kind == "SpecialToken":
+                    ids = special_tokens[piece["id"]]["ids"]
+                    (self.prefix if i < split else self.suffix).extend(ids)
+
+        self.vocab: Dict[str, int] = model["vocab"]
+        self.unk_token_id = self.vocab[model["unk_token"]]
+        # Words are upper cased before lookup, lower case entries are unreachable
+        words = [word for word in self.vocab if word.isascii() and word == word.upper()]
+        self._words = set(words)
+        alphabet = sorted({c for word in words for c in word.encode("ascii")})
+        # Byte -> alphabet digit, 0 is reserved for bytes outside of the alphabet
+        self._digits = np.zeros(256, dtype=np.uint8)
+        for i, c in enumerate(alphabet, start=1):
+            self._digits[c] = i
+            self._digits[ord(chr(c).lower())] = i
+        self._base = len(alphabet) + 1
+        return True
+
+    @property
+    def num_special_tokens(self) -> int:
+        return len(self.prefix) + len(self.suffix)
+
+    def _get_lut(self, kmer_size: int) -> Optional[np.ndarray]:
+        # Map the base-(A + 1) code of each k-mer to its token id
+        if kmer_size not in self._luts:
+            table: Optional[np.ndarray] = None
+            if self._base**kmer_size <= _MAX_LUT_SIZE:
+                powers = self._base ** np.arange(kmer_size - 1, -1, -1, dtype=np.int64)
+                table = np.full(self._base**kmer_size, self.unk_token_id, np.int64)
+                for word, token_id in self.vocab.items():
+                    if len(word) == kmer_size and word in self._words:
+                        digits = self._digits[np.frombuffer(word.encode(), np.uint8)]
+                        if digits.all():
+                            table[digits @ powers] = token_id
+            self._luts[kmer_size] = table
+        return self._luts[kmer_size]
+
+    def _encode(
+        self, sequences: Sequence[str], kmer_size: int, max_tokens: int
+    ) -> Tuple[np.ndarray, np.ndarray, List[int]]:
+        """Token ids of the first `max_tokens` k-mers of each sequence.
+
+        Returns the flat token ids (without special tokens), the number of
+        tokens of each sequence and the indices of the sequences which need
+        the wrapped tokenizer.
+        """
+        table = self._get_lut(kmer_size) if self.vectorized else None
+        if table is None:
+            return (
+                np.empty(0, np.int64),
+                np.zeros(len(sequences), np.int64),
+                list(range(len(sequences))),
+            )
+
+        # Only the k-mers that survive truncation need to be looked at
+        heads = [seq[: max_tokens * kmer_size] for seq in sequences]
+        fallback = [i for i, head in enumerate(heads) if not head.isascii()]
+        for i in fallback:
+            heads[i] = ""
+        raw = np.frombuffer("".join(heads).encode("ascii"), dtype=np.uint8)
+        lengths = np.array([len(head) for head in heads], dtype=np.int64)
+        starts = np.cumsum(lengths) - lengths
+        valid_bytes = _PRINTABLE_BYTES if kmer_size == 1 else _WORD_BYTES
+        invalid = np.flatnonzero(~valid_bytes[raw])
+        if len(invalid):
+            fallback += np.unique(
+                np.searchsorted(starts, invalid, side="right") - 1
+            ).tolist()
+
+        # Rolling code of the k characters starting at every byte of the
+        # joined sequences, the k-mers are then picked out at their starts.
+        # A trailing partial k-mer reads into the next sequence (or the zero
+        # padding) and is replaced below
+        digits = np.append(self._digits[raw], np.zeros(kmer_size - 1, np.uint8))
+        codes = digits[: len(raw)].astype(np.int32)
+        for i in range(1, kmer_size):
+            codes = codes * self._base + digits[i : len(raw) + i]
+        num_tokens = -(-lengths // kmer_size)
+        token_starts = np.cumsum(num_tokens) - num_tokens
+        kmer_starts = np.arange(0, int(num_tokens.sum()) * kmer_size, kmer_size)
+        kmer_starts += np.repeat(starts - token_starts * kmer_size, num_tokens)
+        ids = table[codes[kmer_starts]]
+
+        # The trailing partial k-mers are looked up in the vocab directly
+        for i in np.flatnonzero(lengths % kmer_size):
+            tail = heads[i][-(lengths[i] % kmer_size) :].upper()
+            ids[token_starts[i] + num_tokens[i] - 1] = self.vocab.get(
+                tail, self.unk_token_id
+            )
+        return ids, num_tokens, fallback
+
+    def _fallback(
+        self, seq: str, kmer_size: int, max_length: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        text = " ".join(seq[i : i + kmer_size] for i in range(0, len(seq), kmer_size))
+        batch_encoding = self.tokenizer(
+            text.upper(),
+            max_length=max_length,
+            padding="max_length",
+            truncation=True,
+            return_tensors="np",
+        )
+        return batch_encoding["input_ids"][0], batch_encoding["attention_mask"][0]
+
+    def __call__(
+        self,
+        sequences: Sequence[str],
+        kmer_size: int,
+        max_length: int,
+        dtype: npt.DTypeLike = np.int64,
+    ) -> Dict[str, np.ndarray]:
+        """Tokenize a batch of sequences, padded and truncated to `max_length`.
+
+        Parameters
+        ----------
+        sequences : Sequence[str]
+            The raw sequences, upper cased and split into k-mers here.
+        kmer_size : int
+            Number of characters per word (e.g. 3 for codons).
+        max_length : int
+            Length of each row, including the special tokens.
+        dtype : npt.DTypeLike, optional
+            Data type of the returned arrays, by default np.int64.
+
+        Returns
+        -------
+        Dict[str, np.ndarray]
+            The `input_ids` and `attention_mask` arrays of shape
+            (len(sequences), max_length).
+
+        Raises
+        ------
+        ValueError
+            If `max_length` is too short to fit the special tokens.
+        """
+        if max_length < self.num_special_tokens:
+            raise ValueError(
+                f"max_length {max_length} can not fit the special tokens {self.prefix + self.suffix}"
+            )
+        max_tokens = max_length - self.num_special_tokens
+        ids, num_tokens, fallback = self._encode(sequences, kmer_size, max_tokens)
+
+        num_seqs, prefix_len = len(sequences), len(self.prefix)
+        input_ids = np.full((num_seqs, max_length), self.pad_token_id, dtype=dtype)
+        input_ids[:, :prefix_len] = self.prefix
+        # Flat positions of the tokens in the (num_seqs, max_length) output
+        token_starts = np.cumsum(num_tokens) - num_tokens
+        row_starts = np.arange(num_seqs) * max_length + prefix_len - token_starts
+        positions = np.arange(len(ids)) + np.repeat(row_starts, num_tokens)
+        input_ids.reshape(-1)[positions] = ids
+        for i, token_id in enumerate(self.suffix, start=prefix_len):
+            input_ids[np.arange(num_seqs), num_tokens + i] = token_id
+        attention_mask = (
+            np.arange(max_length) < (num_tokens + self.num_special_tokens)[:, None]
+        ).astype(dtype)
+
+        for i in fallback:
+            input_ids[i], attention_mask[i] = self._fallback(
+                sequences[i], kmer_size, max_length
+            )
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+    def windows(
+        self, sequence: str, kmer_size: int, max_length: int, stride: int
+    ) -> Dict[str, np.ndarray]:
+        """Tokenize a sequence into overlapping windows instead of truncating it.
+
+        Window i holds the tokens starting at k-mer i * stride and the last
+        window is aligned with the end of the sequence. Every window gets
+        the special tokens, so sequences that fit yield a single window
+        identical to the regular tokenization.
+
+        Parameters
+        ----------
+        sequence : str
+            The raw sequence.
+        kmer_size : int
+            Number of characters per word (e.g. 3 for codons).
+        max_length : int
+            Length of each window, including the special tokens.
+        stride : int
+            Number of k-mers between the starts of consecutive windows.
+
+        Returns
+        -------
+        Dict[str, np.ndarray]
+            The `input_ids`, `attention_mask` and `positions` arrays of shape
+            (num_windows, max_length). `positions` maps each token to its
+            position in the untruncated tokenization and is -1 for padding.
+
+        Raises
+        ------
+        ValueError
+            If `stride` is not positive or leaves k-mers between windows.
+        """
+        width = max_length - self.num_special_tokens
+        if not 0 < stride <= width:
+            raise ValueError(
+                f"stride {stride} must be between 1 and {width} (the k-mers per window)"
+            )
+        num_kmers = -(-len(sequence) // kmer_size)
+        full = self([sequence], kmer_size, num_kmers + self.num_special_tokens)
+        tokens = full["input_ids"][0][full["attention_mask"][0].astype(bool)]
+        num_tokens = len(tokens) - self.num_special_tokens
+
+        prefix_len, suffix_len = len(self.prefix), len(self.suffix)
+        last_start = max(num_tokens - width, 0)
+        starts = np.r_[np.arange(0, last_start, stride), last_start]
+        body_len = min(width, num_tokens)
+        positions = np.full((len(starts), max_length), -1, dtype=np.int64)
+        positions[:, :prefix_len] = np.arange(prefix_len)
+        positions[:, prefix_len : prefix_len + body_len] = (
+            prefix_len + starts[:, None] + np.arange(body_len)
+        )
+        positions[:, prefix_len + body_len : prefix_len + body_len + suffix_len] = (
+            prefix_len + num_tokens + np.arange(suffix_len)
+        )
+
+        valid = positions >= 0
+        input_ids = np.full(positions.shape, self.pad_token_id, dtype=np.int64)
+        input_ids[valid] = tokens[positions[valid]]
+        attention_mask = valid.astype(np.int64)
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "positions": positions,
+        }
+
+
+class TokenCache:
+    """Tokenized sequences stored on disk and keyed by the MD5 of the sequence.
+
+    Tokens are kept in a subdirectory of `cache_dir` named after the
+    tokenizer fingerprint, k-mer size and block size, so models that share
+    a tokenizer also share the cache. Every update writes an immutable
+    segment (hashes.npy, offsets.npy, tokens.npy) that appears atomically
+    and whose tokens are memory mapped, so data loader workers read them
+    through the OS page cache. Once `max_segments` accumulate they are
+    merged into one.
+
+    The segments in use are listed in manifest.json, which is only replaced
+    atomically while holding a lock on the cache. Merged segments are
+    retired from the manifest but stay on disk for `retire_seconds`, so
+    that other processes (and pickled copies) can still open them. The
+    lock is an flock, or a lock directory on file systems without flock
+    (e.g. Lustre mounted without -o flock).
+    """
+
+    max_segments = 8
+    retire_seconds = 3600.0
+    stale_lock_seconds = 600.0
+
+    def __init__(
+        self,
+        cache_dir: PathLike,
+        tokenizer: KmerTokenizer,
+        kmer_size: int,
+        block_size: int,
+    ) -> None:
+        if tokenizer.tokenizer.padding_side != "right":
+            raise ValueError("TokenCache only supports right padded tokenizers")
+        self.tokenizer = tokenizer
+        self.kmer_size = kmer_size
+        self.block_size = block_size
+        self.dtype = np.min_scalar_type(len(tokenizer.tokenizer))
+        self.path = Path(cache_dir) / (
+            f"{tokenizer.fingerprint}-k{kmer_size}-b{block_size}"
+        )
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._load_segments()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Pickling the memory maps would copy the tokens, reopen them instead
+        state = self.__dict__.copy()
+        state["segments"] = None
+        state["_fallback"] = None
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        # Locations refer to these exact segments, any that were garbage
+        # collected since are looked up by hash in the current manifest
+        self._load_segments(self.segment_dirs)
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        with open(self.path / ".lock", "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            except OSError as e:
+                if e.errno not in _NO_FLOCK_ERRNOS:
+                    raise
+                flocked = False
+            else:
+                flocked = True
+            if not flocked:
+                with self._dir_locked():
+                    yield
+                return
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @contextmanager
+    def _dir_locked(self) -> Iterator[None]:
+        # Creating a directory is atomic on every file system
+        lock_dir = self.path / ".lock.d"
+        while True:
+            try:
+                lock_dir.mkdir()
+                break
+            except FileExistsError:
+                pass
+            try:
+                # Left behind by a process that died holding the lock
+                if time.time() - lock_dir.stat().st_mtime > self.stale_lock_seconds:
+                    lock_dir.rmdir()
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(0.1)
+        try:
+            yield
+        finally:
+            lock_dir.rmdir()
+
+    def _read_manifest(self) -> Dict[str, Any]:
+        try:
+            with open(self.path / "manifest.json") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            # Caches written before the manifest list every segment
+            names = sorted(p.name for p in self.path.glob("segment-*"))
+            return {"segments": names, "retired": {}}
+
+    def _write_manifest(self, manifest: Dict[str, Any]) -> None:
+        # Only called while holding the lock, readers see either manifest
+        tmp_file = self.path / f".manifest-{uuid.uuid4().hex[:8]}.json"
+        with open(tmp_file, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_file, self.path / "manifest.json")
+
+    @staticmethod
+    def _open_segment(
+        segment_dir: Path,
+    ) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        try:
+            return (
+                np.load(segment_dir / "hashes.npy", mmap_mode="r"),
+                np.load(segment_dir / "offsets.npy"),
+                np.load(segment_dir / "tokens.npy", mmap_mode="r"),
+            )
+        except FileNotFoundError:
+            return None
+
+    def _load_segments(self, segment_dirs: Optional[List[Path]] = None) -> None:
+        # Pickled copies keep the position of segments that are gone
+        keep_missing = segment_dirs is not None
+        if segment_dirs is None:
+            names = self._read_manifest()["segments"]
+            segment_dirs = [self.path / name for name in names]
+        self.segment_dirs: List[Path] = []
+        self.segments: List[Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]]
+        self.segments = []
+        self._fallback: Optional[TokenCache] = None
+        for segment_dir in segment_dirs:
+            segment = self._open_segment(segment_dir)
+            if segment is None and not keep_missing:
+                continue
+            self.segment_dirs.append(segment_dir)
+            self.segments.append(segment)
+
+    def __len__(self) -> int:
+        return sum(len(segment[0]) for segment in self.segments if segment)
+
+    @staticmethod
+    def hash_sequence(seq: str) -> bytes:
+        return hashlib.md5(seq.encode("utf-8")).hexdigest().encode("ascii")
+
+    def lookup(self, hashes: np.ndarray) -> np.ndarray:
+        """Return the (segment, row) of each hash, or (-1, -1) if not cached."""
+        locations = np.full((len(hashes), 2), -1, dtype=np.int64)
+        for i, segment in enumerate(self.segments):
+            missing = np.flatnonzero(locations[:, 0] < 0)
+            if segment is None or not len(missing) or not len(segment[0]):
+                continue
+            segment_hashes = segment[0]
+            rows = np.searchsorted(segment_hashes, hashes[missing])
+            rows = np.minimum(rows, len(segment_hashes) - 1)
+            found = segment_hashes[rows] == hashes[missing]
+            locations[missing[found]] = np.stack(
+                [np.full(found.sum(), i), rows[found]], axis=1
+            )
+        return locations
+
+    def token_lengths(self, locations: np.ndarray) -> np.ndarray:
+        """Return the number of tokens stored at each (segment, row)."""
+        lengths = np.zeros(len(locations), dtype=np.int64)
+        for i, segment in enumerate(self.segments):
+            if segment is None:
+                continue
+            offsets = segment[1]
+            rows = locations[locations[:, 0] == i, 1]
+            lengths[locations[:, 0] == i] = offsets[rows + 1] - offsets[rows]
+        return lengths
+
+    def get(
+        self, segment: int, row: int, na_hash: Optional[bytes] = None
+    ) -> Dict[str, np.ndarray]:
+        """Return the padded `input_ids` and `attention_mask` of a cached row.
+
+        If the segment was garbage collected after being merged by another
+        process, the row is found by `na_hash` in the current manifest.
+        """
+        if self.segments[segment] is None:
+            if na_hash is None:
+                raise FileNotFoundError(
+                    f"{self.segment_dirs[segment]} was removed, pass na_hash"
+                    " to look the sequence up in the current cache"
+                )
+            if self._fallback is None:
+                self._fallback = copy.copy(self)
+                self._fallback._load_segments()
+            (segment, row), *_ = self._fallback.lookup(np.array([na_hash], "S32"))
+            if segment < 0:
+                raise KeyError(f"{na_hash!r} is no longer in {self.path}")
+            return self._fallback.get(segment, row)
+
+        _, offsets, tokens = self.segments[segment]
+        ids = tokens[offsets[row] : offsets[row + 1]]
+        input_ids = np.full((1, self.block_size), self.tokenizer.pad_token_id)
+        attention_mask = np.zeros((1, self.block_size), dtype=np.int64)
+        input_ids[0, : len(ids)] = ids
+        attention_mask[0, : len(ids)] = 1
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+    def _tokenize(
+        self, sequences: List[str], batch_size: int = 4096
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # Only the unpadded tokens are stored, right padding makes the
+        # attention mask a prefix of each row
+        lengths, tokens = [], []
+        for i in range(0, len(sequences), batch_size):
+            encoding = self.tokenizer(
+                sequences[i : i + batch_size],
+                self.kmer_size,
+                self.block_size,
+                dtype=self.dtype,
+            )
+            mask = encoding["attention_mask"].astype(bool)
+            lengths.append(mask.sum(axis=1))
+            tokens.append(encoding["input_ids"][mask])
+        return (
+            np.concatenate([np.zeros(0, np.int64)] + lengths),
+            np.concatenate([np.zeros(0, self.dtype)] + tokens),
+        )
+
+    def _write_segment(
+        self,
+        hashes: np.ndarray,
+        lengths: np.ndarray,
+        tokens: np.ndarray,
+        publish: bool = True,
+    ) -> str:
+        # Rows are sorted by hash (dropping duplicates) for lookups
+        offsets = np.cumsum(np.append(0, lengths))
+        hashes, unique = np.unique(hashes, return_index=True)
+        lengths, tokens = _take_rows(offsets, tokens, unique)
+
+        name = f"segment-{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+        tmp_dir = self.path / f".tmp-{name}"
+        tmp_dir.mkdir()
+        np.save(tmp_dir / "hashes.npy", hashes)
+        np.save(tmp_dir / "offsets.npy", np.cumsum(np.append(0, lengths)))
+        np.save(tmp_dir / "tokens.npy", tokens)
+        os.rename(tmp_dir, self.path / name)
+        if publish:
+            with self._locked():
+                manifest = self._read_manifest()
+                # Without a manifest yet, the listing already includes it
+                if name not in manifest["segments"]:
+                    manifest["segments"].append(name)
+                self._write_manifest(manifest)
+        return name
+
+    def _collect_garbage(self, manifest: Dict[str, Any], now: float) -> None:
+        # Only called while holding the lock
+        retired = manifest.setdefault("retired", {})
+        for name, retired_at in list(retired.items()):
+            if now - retired_at >= self.retire_seconds:
+                shutil.rmtree(self.path / name, ignore_errors=True)
+                del retired[name]
+
+    def merge(self) -> None:
+        """Merge every segment into a single one.
+
+        The merged segment replaces the others in the manifest. They are
+        removed once retired for `retire_seconds` by a later merge.
+        """
+        merged = [
+            (segment_dir.name, segment)
+            for segment_dir, segment in zip(self.segment_dirs, self.segments)
+            if segment is not None
+        ]
+        hashes = np.concatenate([segment[0] for _, segment in merged])
+        lengths = np.concatenate([np.diff(segment[1]) for _, segment in merged])
+        tokens = np.concatenate([segment[2] for _, segment in merged])
+        name = self._write_segment(hashes, lengths, tokens, publish=False)
+
+        with self._locked():
+            # Keep segments that other processes published in the meantime
+            manifest = self._read_manifest()
+            merged_names = {merged_name for merged_name, _ in merged}
+            manifest["segments"] = [name] + [
+                n for n in manifest["segments"] if n not in merged_names
+            ]
+            now = time.time()
+            self._collect_garbage(manifest, now)
+            manifest["retired"].update({n: now for n in merged_names})
+            self._write_manifest(manifest)
+        self._load_segments()
+
+    def reload(self) -> None:
+        """Open the segments currently listed in the manifest."""
+        self._load_segments()
+
+    def update(
+        self, sequences: Iterable[str], chunk_size: int = 65536, tokenize: bool = True
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Cache any new sequences and locate every sequence in the cache.
+
+        Parameters
+        ----------
+        sequences : Iterable[str]
+            The raw sequences, read in chunks of `chunk_size`.
+        chunk_size : int, optional
+            Number of sequences held in memory at a time, by default 65536.
+        tokenize : bool, optional
+            Tokenize the sequences that are not cached yet, otherwise they
+            are only located (at (-1, -1)) while another process caches
+            them, by default True.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            The MD5 hex digest of each sequence (as S32) and its
+            (segment, row) location to pass to `get`.
+        """
+        hashes: List[np.ndarray] = [np.zeros(0, dtype="S32")]
+        new_hashes, new_lengths, new_tokens = [], [], []
+        sequences = iter(sequences)
+        while True:
+            chunk = [seq for _, seq in zip(range(chunk_size), sequences)]
+            if not chunk:
+                break
+            hashes.append(np.array([self.hash_sequence(s) for s in chunk], "S32"))
+            missing = np.flatnonzero(self.lookup(hashes[-1])[:, 0] < 0)
+            if tokenize and len(missing):
+                lengths, tokens = self._tokenize([chunk[i] for i in missing])
+                new_hashes.append(hashes[-1][missing])
+                new_lengths.append(lengths)
+                new_tokens.append(tokens)
+
+        if new_hashes:
+            self._write_segment(
+                np.concatenate(new_hashes),
+                np.concatenate(new_lengths),
+                np.concatenate(new_tokens),
+            )
+            self._load_segments()
+            if len(self.segments) > self.max_segments:
+                self.merge()
+
+        all_hashes = np.concatenate(hashes)
+        return all_hashes, self.lookup(all_hashes)
+
+
+# flock errors of file systems that do not support it
+_NO_FLOCK_ERRNOS = {errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOLCK, errno.EINVAL}
+
+
+def _take_rows(
+    offsets: np.ndarray, values: np.ndarray, rows: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the lengths and concatenated values of `rows` of a ragged array."""
+    lengths = offsets[rows + 1] - offsets[rows]
+    starts = np.repeat(offsets[rows] - (np.cumsum(lengths) - lengths), lengths)
+    return lengths, values[np.arange(int(lengths.sum())) + starts]
@@ -1,16 +1,38 @@
-import re
+import functools
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import socket
+import threading
 import time
+import uuid
 from abc import ABC, abstractmethod
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from contextlib import ExitStack
+from itertools import compress, islice
 from pathlib import Path
 from statistics import mean
-from typing import Any, Dict, List, Optional, Set, Type, Union
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Container,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
 
 import numpy as np
 import pytorch_lightning as pl
 import torch
-from Bio import SeqIO  # type: ignore[import]
-from Bio.Seq import Seq  # type: ignore[import]
-from Bio.SeqRecord import SeqRecord  # type: ignore[import]
 from pydantic import BaseModel
 from pytorch_lightning.callbacks import Callback
 from pytorch_lightning.utilities.deepspeed import (
@@ -25,6 +47,42 @@ PathLike = Union[str, Path]
 
 STOP_CODONS = {"TAA", "TAG", "TGA"}
 
+# Standard genetic code (NCBI translation table 1)
+_CODON_BASES = "TCAG"
+_AMINO_ACIDS = "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG"
+CODON_TABLE = {
+    a + b + c: _AMINO_ACIDS[16 * i + 4 * j + k]
+    for i, a in enumerate(_CODON_BASES)
+    for j, b in enumerate(_CODON_BASES)
+    for k, c in enumerate(_CODON_BASES)
+}
+
+# IUPAC nucleotide ambiguity codes, and the amino acid codes for the
+# ambiguities a codon can resolve to (as BioPython translates them)
+_IUPAC_BASES = {
+    "A": "A",
+    "C": "C",
+    "G": "G",
+    "T": "T",
+    "U": "T",
+    "R": "AG",
+    "Y": "CT",
+    "S": "CG",
+    "W": "AT",
+    "K": "GT",
+    "M": "AC",
+    "B": "CGT",
+    "D": "AGT",
+    "H": "ACT",
+    "V": "ACG",
+    "N": "ACGT",
+}
+_AMBIGUOUS_AMINO_ACIDS = {
+    frozenset("DN"): "B",
+    frozenset("EQ"): "Z",
+    frozenset("IL"): "J",
+}
+
 
 class Sequence(BaseModel):
     sequence: str
@@ -32,31 +90,151 @@ class Sequence(BaseModel):
     tag: str
     """Sequence description tag."""
 
+    @property
+    def id(self) -> str:
+        """Record identifier, the first word of the description tag."""
+        return self.tag.split(maxsplit=1)[0] if self.tag else ""
+
+    @property
+    def description(self) -> str:
+        """Full description line (same semantics as BioPython)."""
+        return self.tag
+
+
+def _open_fasta(fasta_file: PathLike, buffer_size: int = 1 << 20) -> IO[bytes]:
+    """Open a plain text or gzip/bgzip compressed fasta file for binary reading."""
+    with open(fasta_file, "rb") as f:
+        is_gzip = f.read(2) == b"\x1f\x8b"
+    if is_gzip:
+        return gzip.open(fasta_file, "rb")  # type: ignore[return-value]
+    return open(fasta_file, "rb", buffering=buffer_size)
+
+
+def _iter_fasta_entries(
+    fasta_file: PathLike, offset: int = 0
+) -> Iterator[Tuple[str, str]]:
+    """Yield (tag, sequence) pairs from a fasta file, one record at a time.
+
+    Only the lines of the current record are held in memory. If `offset`
+    does not point at the start of a record, lines are skipped until the
+    next header. For compressed files `offset` is in uncompressed bytes.
+    """
+    with _open_fasta(fasta_file) as f:
+        if offset:
+            f.seek(offset)
+        tag: Optional[bytes] = None
+        lines: List[bytes] = []
+        for line in f:
+            if line.startswith(b">"):
+                if tag is not None:
+                    yield tag.decode("utf-8"), b"".join(lines).decode("utf-8")
+                tag, lines = line[1:].rstrip(), []
+            elif tag is not None:
+                lines.append(line.rstrip())
+        if tag is not None:
+            yield tag.decode("utf-8"), b"".join(lines).decode("utf-8")
+
+
+def iter_fasta(fasta_file: PathLike, offset: int = 0) -> Iterator[Sequence]:
+    """Stream fasta file sequences and description tags with constant memory."""
+    for tag, seq in _iter_fasta_entries(fasta_file, offset):
+        # The parser already produces str fields, skip pydantic validation
+        yield Sequence.construct(sequence=seq, tag=tag)
+
+
+def iter_fasta_only_seq(fasta_file: PathLike, offset: int = 0) -> Iterator[str]:
+    """Stream fasta file sequences without description tag."""
+    for _, seq in _iter_fasta_entries(fasta_file, offset):
+        yield seq
+
+
+def count_fasta_records(fasta_file: PathLike) -> int:
+    """Count the records of a fasta file without parsing their sequences."""
+    with _open_fasta(fasta_file) as f:
+        return sum(line.startswith(b">") for line in f)
+
 
 def read_fasta(fasta_file: PathLike) -> List[Sequence]:
     """Reads fasta file sequences and description tags into dataclass."""
-    text = Path(fasta_file).read_text()
-    pattern = re.compile("^>", re.MULTILINE)
-    non_parsed_seqs = re.split(pattern, text)[1:]
-    lines = [
-        line.replace("\n", "") for seq in non_parsed_seqs for line in seq.split("\n", 1)
-    ]
-
-    return [
-        Sequence(sequence=seq, tag=tag) for seq, tag in zip(lines[1::2], lines[::2])
-    ]
+    return list(iter_fasta(fasta_file))
 
 
 def read_fasta_only_seq(fasta_file: PathLike) -> List[str]:
     """Reads fasta file sequences without description tag."""
-    text = Path(fasta_file).read_text()
-    pattern = re.compile("^>", re.MULTILINE)
-    non_parsed_seqs = re.split(pattern, text)[1:]
-    lines = [
-        line.replace("\n", "") for seq in non_parsed_seqs for line in seq.split("\n", 1)
-    ]
+    return list(iter_fasta_only_seq(fasta_file))
+
+
+def fasta_index_path(fasta_file: PathLike) -> Path:
+    """Path of the cached record offset index for `fasta_file`."""
+    fasta_file = Path(fasta_file)
+    return fasta_file.with_name(f"{fasta_file.name}.fidx.npy")
+
 
-    return lines[1::2]
+def build_fasta_index(fasta_file: PathLike, chunk_size: int = 1 << 24) -> np.ndarray:
+    """Return the byte offset of every record header followed by the file size.
+
+    Record i spans bytes ``offsets[i]:offsets[i + 1]`` of the file.
+    """
+    with open(fasta_file, "rb") as f:
+        if f.read(2) == b"\x1f\x8b":
+            raise ValueError(
+                f"Random access requires an uncompressed fasta file: {fasta_file}"
+            )
+        f.seek(0)
+        offsets = []
+        position, prev_byte = 0, ord("\n")
+        while True:
+            chunk = np.frombuffer(f.read(chunk_size), dtype=np.uint8)
+            if not len(chunk):
+                break
+            # A header starts at every '>' that begins a line
+            prev = np.empty_like(chunk)
+            prev[0], prev[1:] = prev_byte, chunk[:-1]
+            starts = np.flatnonzero((chunk == ord(">")) & (prev == ord("\n")))
+            offsets.append(starts + position)
+            position += len(chunk)
+            prev_byte = chunk[-1]
+    offsets.append(np.array([position]))
+    return np.concatenate(offsets).astype(np.int64)
+
+
+def load_fasta_index(fasta_file: PathLike) -> np.ndarray:
+    """Load the offset index of `fasta_file`, building and caching it if stale."""
+    index_file = fasta_index_path(fasta_file)
+    if (
+        index_file.exists()
+        and index_file.stat().st_mtime >= Path(fasta_file).stat().st_mtime
+    ):
+        return np.load(index_file)  # type: ignore[no-any-return]
+
+    offsets = build_fasta_index(fasta_file)
+    # Write to a temporary file first so concurrent ranks never read a partial index
+    tmp_file = index_file.with_name(f"{index_file.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_file, "wb") as f:
+            np.save(f, offsets)
+        os.replace(tmp_file, index_file)
+    except OSError:
+        # Read-only data directory, the index is simply not cached
+        tmp_file.unlink(missing_ok=True)
+    return offsets
+
+
+def load_fasta_indices(
+    fasta_files: List[Path], num_workers: int = 1
+) -> List[np.ndarray]:
+    """Load (or build) the offset indices of many fasta files in parallel."""
+    chunksize = max(1, len(fasta_files) // num_workers)
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        return list(pool.map(load_fasta_index, fasta_files, chunksize=chunksize))
+
+
+def read_fasta_entry(f: IO[bytes], start: int, end: int) -> Tuple[str, str]:
+    """Read the (tag, sequence) pair stored between two byte offsets of a fasta file."""
+    f.seek(start)
+    header, _, body = f.read(end - start).partition(b"\n")
+    seq = b"".join(line.rstrip() for line in body.splitlines())
+    return header[1:].rstrip().decode("utf-8"), seq.decode("utf-8")
 
 
 def write_fasta(
@@ -69,6 +247,766 @@ def write_fasta(
             f.write(f">{seq.tag}\n{seq.sequence}\n")
 
 
+def read_fasta_files_only_seq(
+    fasta_files: List[Path], num_workers: int = 1
+) -> List[str]:
+    """Read the sequences of many fasta files in parallel, preserving file order."""
+    sequences: List[str] = []
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        for seqs in tqdm(
+            pool.map(read_fasta_only_seq, fasta_files),
+            total=len(fasta_files),
+            desc="Reading fasta files...",
+        ):
+            sequences.extend(seqs)
+    return sequences
+
+
+class SequenceStore:
+    """Read-only list of sequences packed into one memory-mapped byte buffer.
+
+    Every process that opens the same store shares its pages through the
+    OS page cache instead of holding a private copy of each string.
+    """
+
+    def __init__(self, store_dir: PathLike) -> None:
+        self.store_dir = Path(store_dir)
+        self.data = np.load(self.store_dir / "data.npy", mmap_mode="r")
+        self.offsets = np.load(self.store_dir / "offsets.npy")
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> str:
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return self.data[start:end].tobytes().decode("utf-8")
+
+    @staticmethod
+    def read_source(store_dir: PathLike) -> Optional[Any]:
+        """Return the `source` a store was written with, None if there is none."""
+        try:
+            with open(Path(store_dir) / "source.json") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def write(
+        sequences: Iterable[str],
+        store_dir: PathLike,
+        source: Optional[Any] = None,
+        overwrite: bool = False,
+    ) -> None:
+        """Pack `sequences` into `store_dir`, which appears atomically.
+
+        Parameters
+        ----------
+        sequences : Iterable[str]
+            The sequences to store.
+        store_dir : PathLike
+            Directory of the store.
+        source : Optional[Any], optional
+            JSON serializable description of where the sequences come from
+            (see `file_fingerprints`), returned by `read_source`.
+        overwrite : bool, optional
+            Replace an existing store, otherwise an existing store (e.g.
+            written by another process first) is kept, by default False.
+        """
+        store_dir = Path(store_dir)
+        encoded = [seq.encode("utf-8") for seq in sequences]
+        offsets = np.cumsum([0] + [len(seq) for seq in encoded], dtype=np.int64)
+        data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+        # Unique, processes on several nodes may write the same store
+        tmp_dir = store_dir.with_name(f"{store_dir.name}.{uuid.uuid4().hex}.tmp")
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        np.save(tmp_dir / "data.npy", data)
+        np.save(tmp_dir / "offsets.npy", offsets)
+        if source is not None:
+            with open(tmp_dir / "source.json", "w") as f:
+                json.dump(source, f)
+
+        if overwrite and store_dir.exists():
+            if source is not None and SequenceStore.read_source(store_dir) == source:
+                # Another process (e.g. on another node) wrote it meanwhile
+                shutil.rmtree(tmp_dir)
+                return
+            # Processes that already opened the old store keep their maps
+            stale_dir = store_dir.with_name(f"{store_dir.name}.{uuid.uuid4().hex}")
+            try:
+                os.rename(store_dir, stale_dir)
+            except FileNotFoundError:
+                pass  # Moved aside by another process
+            else:
+                shutil.rmtree(stale_dir)
+        try:
+            os.rename(tmp_dir, store_dir)
+        except OSError:
+            # Another process finished writing the same store first
+            shutil.rmtree(tmp_dir)
+
+
+def file_fingerprints(files: Iterable[PathLike]) -> List[Dict[str, Any]]:
+    """Return the path, size and modification time of each file.
+
+    Outputs derived from the files are stale once their fingerprints differ.
+    """
+    fingerprints = []
+    for file in files:
+        stat = os.stat(file)
+        fingerprints.append(
+            {
+                "path": str(Path(file).resolve()),
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+            }
+        )
+    return fingerprints
+
+
+def hash_sequences(sequences: Iterable[str]) -> np.ndarray:
+    """Return a 64-bit BLAKE2 hash of each sequence."""
+    digests = b"".join(
+        hashlib.blake2b(seq.encode("utf-8"), digest_size=8).digest()
+        for seq in sequences
+    )
+    return np.frombuffer(digests, dtype="<u8")
+
+
+def _hash_fasta_file(
+    fasta_file: PathLike, verify: bool
+) -> Tuple[np.ndarray, int, Optional[List[str]]]:
+    sequences = read_fasta_only_seq(fasta_file)
+    min_length = min((len(seq) for seq in sequences), default=0)
+    return hash_sequences(sequences), min_length, sequences if verify else None
+
+
+class KnownSequenceIndex:
+    """Sorted sequence hashes for fast novelty checks against known sequences."""
+
+    def __init__(
+        self,
+        hashes: np.ndarray,
+        min_length: int,
+        sequences: Optional[Union[List[str], SequenceStore]] = None,
+    ) -> None:
+        """Membership index of known sequences.
+
+        Parameters
+        ----------
+        hashes : np.ndarray
+            Sorted 64-bit hashes of the known sequences.
+        min_length : int
+            Length of the shortest known sequence.
+        sequences : Optional[Union[List[str], SequenceStore]], optional
+            Known sequences in the same order as `hashes`. If given, hash
+            matches are verified against the exact sequence, by default None
+        """
+        self.hashes = hashes
+        self.min_length = min_length
+        self.sequences = sequences
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def __contains__(self, sequence: object) -> bool:
+        return isinstance(sequence, str) and bool(self.contains([sequence])[0])
+
+    def contains(self, sequences: List[str]) -> np.ndarray:
+        """Return a boolean mask of which `sequences` are known."""
+        hashes = hash_sequences(sequences)
+        if not len(self.hashes):
+            return np.zeros(len(hashes), dtype=bool)
+        inds = np.searchsorted(self.hashes, hashes)
+        found = self.hashes[np.minimum(inds, len(self.hashes) - 1)] == hashes
+        if self.sequences is not None:
+            for i in np.flatnonzero(found):
+                # Compare against every known sequence sharing this hash
+                j, match = inds[i], False
+                while j < len(self.hashes) and self.hashes[j] == hashes[i]:
+                    match = match or self.sequences[j] == sequences[i]
+                    j += 1
+                found[i] = match
+        return found
+
+    @classmethod
+    def build(
+        cls, fasta_files: List[PathLike], verify: bool = False, num_workers: int = 1
+    ) -> "KnownSequenceIndex":
+        """Hash the sequences of `fasta_files` in parallel."""
+        hashes, min_lengths, sequences = [], [], []
+        func = functools.partial(_hash_fasta_file, verify=verify)
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            for file_hashes, min_length, seqs in pool.map(func, fasta_files):
+                hashes.append(file_hashes)
+                if len(file_hashes):
+                    min_lengths.append(min_length)
+                if seqs is not None:
+                    sequences.extend(seqs)
+
+        all_hashes = np.concatenate(hashes) if hashes else np.empty(0, dtype="<u8")
+        min_length = min(min_lengths, default=0)
+        if not verify:
+            return cls(np.unique(all_hashes), min_length)
+
+        # Keep every distinct sequence (even on a hash collision) in hash order
+        unique_inds = np.array(
+            list({seq: i for i, seq in enumerate(sequences)}.values()), dtype=np.int64
+        )
+        order = unique_inds[np.argsort(all_hashes[unique_inds], kind="stable")]
+        return cls(all_hashes[order], min_length, [sequences[i] for i in order])
+
+    def save(self, index_dir: PathLike) -> None:
+        """Write the index to `index_dir`, replacing any index saved there.
+
+        The hashes and sequences are written under new names, then
+        metadata.json, which names them, is replaced atomically. Readers
+        load either the old or the new index, never a mix of both.
+        """
+        index_dir = Path(index_dir)
+        index_dir.mkdir(parents=True, exist_ok=True)
+        generation = uuid.uuid4().hex[:12]
+        hashes_name = f"hashes-{generation}.npy"
+        _save_npy(index_dir / hashes_name, np.asarray(self.hashes))
+        sequences_name = None
+        if self.sequences is not None:
+            sequences_name = f"sequences-{generation}"
+            SequenceStore.write(self.sequences, index_dir / sequences_name)
+
+        metadata = {
+            "num_sequences": len(self),
+            "min_length": self.min_length,
+            "hashes": hashes_name,
+            "sequences": sequences_name,
+        }
+        tmp_file = index_dir / f"metadata.json.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(metadata, f)
+        os.replace(tmp_file, index_dir / "metadata.json")
+
+        # Indexes already loaded keep their memory maps of the removed files
+        for path in index_dir.iterdir():
+            stale = path.name in ("hashes.npy", "sequences") or (
+                path.name.startswith(("hashes-", "sequences-"))
+                and path.name not in (hashes_name, sequences_name)
+            )
+            if stale and path.is_dir():
+                shutil.rmtree(path)
+            elif stale:
+                path.unlink()
+
+    @classmethod
+    def load(cls, index_dir: PathLike) -> "KnownSequenceIndex":
+        """Memory map an index written by :obj:`save`."""
+        index_dir = Path(index_dir)
+        with open(index_dir / "metadata.json") as f:
+            metadata = json.load(f)
+        # Indexes saved before the files were named in the metadata
+        hashes_name = metadata.get("hashes", "hashes.npy")
+        sequences_name = metadata.get("sequences", "sequences")
+        sequences = None
+        if sequences_name and (index_dir / sequences_name).exists():
+            sequences = SequenceStore(index_dir / sequences_name)
+        hashes = np.load(index_dir / hashes_name, mmap_mode="r")
+        return cls(hashes, metadata["min_length"], sequences)
+
+
+def hash_shards(hashes: np.ndarray, num_shards: int) -> np.ndarray:
+    """Shard of each hash, an equal range of hash values (i.e. a hash prefix)."""
+    return (hashes >> np.uint64(32)) * np.uint64(num_shards) >> np.uint64(32)
+
+
+def _save_npy(npy_file: Path, array: np.ndarray) -> None:
+    # Readers on other nodes only ever see complete files
+    npy_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = npy_file.with_name(f"{npy_file.name}.{os.getpid()}.tmp")
+    with open(tmp_file, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_file, npy_file)
+
+
+def _hash_fasta_records(
+    fasta_file: PathLike, chunk_size: int = 4096
+) -> Tuple[np.ndarray, np.ndarray]:
+    hashes, lengths = [], []
+    sequences = iter_fasta_only_seq(fasta_file)
+    while True:
+        chunk = [seq.upper() for seq in islice(sequences, chunk_size)]
+        if not chunk:
+            break
+        hashes.append(hash_sequences(chunk))
+        lengths.append(np.array([len(seq) for seq in chunk], dtype=np.int64))
+    if not hashes:
+        return np.empty(0, dtype="<u8"), np.empty(0, dtype=np.int64)
+    return np.concatenate(hashes), np.concatenate(lengths)
+
+
+def check_keep_mask(keep: np.ndarray, mask_file: PathLike, num_records: int) -> None:
+    """Raise a ValueError unless the keep-mask has one entry per record."""
+    if len(keep) != num_records:
+        raise ValueError(
+            f"{mask_file} has {len(keep)} entries for {num_records} records, "
+            "deduplicate the fasta file again since it changed"
+        )
+
+
+class FastaDeduplicator:
+    """Exact deduplication of the sequences of many fasta files.
+
+    Sequences are compared by a 64-bit hash of their upper case bases, the
+    first occurrence (in the order of the files, then of their records)
+    is kept. The work is split into stages that run on several nodes:
+
+    1. :obj:`hash_files` hashes the records of each file.
+    2. :obj:`dedup_shard` finds the first occurrences of one range of hash
+       values and stores its unique hashes, the on-disk hash set.
+    3. :obj:`write_masks` combines the shards into a boolean keep-mask per
+       file, which :obj:`filter_fasta` or the preprocessing then applies.
+    """
+
+    def __init__(self, fasta_files: List[PathLike], work_dir: PathLike) -> None:
+        self.fasta_files = [Path(f) for f in fasta_files]
+        self.work_dir = Path(work_dir)
+        names = [f.name for f in self.fasta_files]
+        if len(set(names)) != len(names):
+            raise ValueError("Fasta files to deduplicate must have unique names")
+
+    def _path(self, kind: str, fasta_file: Path) -> Path:
+        return self.work_dir / kind / f"{fasta_file.name}.npy"
+
+    def mask_file(self, fasta_file: PathLike) -> Path:
+        """Keep-mask of the records of `fasta_file` written by :obj:`write_masks`."""
+        return self._path("masks", Path(fasta_file))
+
+    def _hashed(self, fasta_file: Path, stamp: np.ndarray) -> bool:
+        stamp_file = self._path("stamps", fasta_file)
+        return stamp_file.exists() and np.array_equal(np.load(stamp_file), stamp)
+
+    def hash_files(
+        self, node_rank: int = 0, num_nodes: int = 1, num_workers: int = 1
+    ) -> None:
+        """Hash the files of this node, skipping those hashed by a previous run.
+
+        Files whose size or modification time changed since they were
+        hashed are hashed again.
+        """
+        stamps = {}
+        for fasta_file in self.fasta_files[node_rank::num_nodes]:
+            stat = fasta_file.stat()
+            stamp = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+            if not self._hashed(fasta_file, stamp):
+                stamps[fasta_file] = stamp
+        files = list(stamps)
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            for fasta_file, (hashes, lengths) in zip(
+                files, pool.map(_hash_fasta_records, files)
+            ):
+                _save_npy(self._path("hashes", fasta_file), hashes)
+                _save_npy(self._path("lengths", fasta_file), lengths)
+                # Written last, marks the file as done
+                _save_npy(self._path("stamps", fasta_file), stamps[fasta_file])
+
+    def dedup_shard(self, shard: int, num_shards: int) -> None:
+        """Keep the first occurrence of each hash of one shard of the hash values.
+
+        Only this shard's hashes (and their record numbers) are held in
+        memory, so the memory use shrinks with the number of shards.
+        """
+        hashes, records = [], []
+        start = 0
+        for fasta_file in self.fasta_files:
+            file_hashes = np.load(self._path("hashes", fasta_file), mmap_mode="r")
+            inds = np.flatnonzero(hash_shards(file_hashes, num_shards) == shard)
+            hashes.append(file_hashes[inds])
+            records.append(inds + start)
+            start += len(file_hashes)
+
+        unique_hashes, first = np.unique(np.concatenate(hashes), return_index=True)
+        keep = np.sort(np.concatenate(records)[first])
+        name = f"shard_{shard}_of_{num_shards}.npy"
+        _save_npy(self.work_dir / "hash_set" / name, unique_hashes)
+        _save_npy(self.work_dir / "keep" / name, keep)
+
+    def write_masks(self) -> Dict[str, int]:
+        """Write the keep-mask of every file once all the shards are done.
+
+        Returns
+        -------
+        Dict[str, int]
+            The number of records and bases before and after deduplication.
+        """
+        shard_files = list((self.work_dir / "keep").glob("shard_*_of_*.npy"))
+        num_shards = {int(f.stem.rsplit("_", 1)[1]) for f in shard_files}
+        if len(num_shards) != 1 or len(shard_files) != num_shards.pop():
+            raise FileNotFoundError(
+                f"Shards are missing or come from different runs in {self.work_dir}"
+            )
+
+        lengths = [np.load(self._path("lengths", f)) for f in self.fasta_files]
+        keep = np.zeros(sum(len(x) for x in lengths), dtype=bool)
+        for shard_file in shard_files:
+            keep[np.load(shard_file)] = True
+
+        stats = {"records": 0, "kept_records": 0, "bases": 0, "kept_bases": 0}
+        start = 0
+        for fasta_file, file_lengths in zip(self.fasta_files, lengths):
+            mask = keep[start : start + len(file_lengths)]
+            start += len(file_lengths)
+            _save_npy(self.mask_file(fasta_file), mask)
+            stats["records"] += len(mask)
+            stats["kept_records"] += int(mask.sum())
+            stats["bases"] += int(file_lengths.sum())
+            stats["kept_bases"] += int(file_lengths[mask].sum())
+        return stats
+
+    def filter_fasta(self, fasta_file: PathLike, output_file: PathLike) -> None:
+        """Write the records of `fasta_file` that are kept to `output_file`."""
+        mask_file = self.mask_file(fasta_file)
+        mask = np.load(mask_file)
+        check_keep_mask(mask, mask_file, count_fasta_records(fasta_file))
+        with open(output_file, "w") as f:
+            for tag, seq in compress(_iter_fasta_entries(fasta_file), mask):
+                f.write(format_fasta_entry(tag, seq))
+
+
+def file_hash(path: PathLike, buffer_size: int = 1 << 20) -> str:
+    """BLAKE2 hash of the contents of a file, read in blocks."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(buffer_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class FileTaskQueue:
+    """Process input files on several nodes through a shared directory.
+
+    Every node walks the inputs from the largest to the smallest and takes
+    the next one nobody has claimed, so the nodes stay busy until the end
+    instead of waiting on the one with the largest files. A claim is a
+    lock file created exclusively in `queue_dir/claims`, kept alive by its
+    owner while the task runs. Claims of crashed nodes expire after
+    `lease` seconds and are taken over.
+
+    Tasks write into their own directory in `queue_dir/work`, whose files
+    are moved into `output_dir` once the task succeeds. The input's size,
+    modification time and hash and the hashes of the outputs are then
+    recorded in the `queue_dir/manifest`, which reruns use to skip the
+    inputs that did not change.
+    """
+
+    def __init__(
+        self,
+        input_files: List[PathLike],
+        output_dir: PathLike,
+        queue_dir: Optional[PathLike] = None,
+        lease: float = 600.0,
+    ) -> None:
+        self.input_files = sorted(
+            (Path(f) for f in input_files), key=lambda f: f.stat().st_size, reverse=True
+        )
+        self.output_dir = Path(output_dir)
+        self.queue_dir = Path(queue_dir or self.output_dir / ".queue")
+        self.lease = lease
+        names = [f.name for f in self.input_files]
+        if len(set(names)) != len(names):
+            raise ValueError("Input files of a task queue must have unique names")
+        for name in ["claims", "work", "manifest"]:
+            (self.queue_dir / name).mkdir(parents=True, exist_ok=True)
+        # Claims held by this process, renewed by the heartbeat thread
+        self._held: Set[Path] = set()
+
+    def _claim_file(self, input_file: Path) -> Path:
+        return self.queue_dir / "claims" / f"{input_file.name}.claim"
+
+    def _manifest_file(self, input_file: Path) -> Path:
+        return self.queue_dir / "manifest" / f"{input_file.name}.json"
+
+    def work_dir(self, input_file: Path) -> Path:
+        """Directory the outputs of `input_file` are written to."""
+        return self.queue_dir / "work" / input_file.name
+
+    def manifest(self) -> Dict[str, Dict[str, Any]]:
+        """Completion records of the finished inputs, by input file name."""
+        records = {}
+        for record_file in (self.queue_dir / "manifest").glob("*.json"):
+            with open(record_file) as f:
+                record = json.load(f)
+            records[record["input"]] = record
+        return records
+
+    def is_done(self, input_file: Path) -> bool:
+        """Whether the input is unchanged since its outputs were recorded."""
+        try:
+            with open(self._manifest_file(input_file)) as f:
+                record = json.load(f)
+        except FileNotFoundError:
+            return False
+        for output in record["outputs"]:
+            path = self.output_dir / output["path"]
+            if not path.exists() or path.stat().st_size != output["size"]:
+                return False
+        stat = input_file.stat()
+        if stat.st_size != record["size"]:
+            return False
+        # Only hash the inputs that were touched
+        return stat.st_mtime_ns == record["mtime_ns"] or (
+            file_hash(input_file) == record["hash"]
+        )
+
+    def claim(self, input_file: Path) -> bool:
+        """Try to take the task of `input_file`, True if this process got it."""
+        claim_file = self._claim_file(input_file)
+        try:
+            fd = os.open(claim_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                age = time.time() - claim_file.stat().st_mtime
+            except FileNotFoundError:
+                return self.claim(input_file)
+            if age < self.lease:
+                return False
+            # The owner stopped renewing its claim, only one node can move it
+            stale_file = claim_file.with_name(f"{claim_file.name}.{uuid.uuid4()}")
+            try:
+                os.rename(claim_file, stale_file)
+            except FileNotFoundError:
+                return False
+            if time.time() - stale_file.stat().st_mtime < self.lease:
+                # Another node replaced the stale claim in the meantime
+                os.rename(stale_file, claim_file)
+                return False
+            stale_file.unlink()
+            print(f"Taking over the expired claim of {input_file}")
+            return self.claim(input_file)
+
+        with os.fdopen(fd, "w") as f:
+            json.dump({"host": socket.gethostname(), "pid": os.getpid()}, f)
+        self._held.add(claim_file)
+        return True
+
+    def release(self, input_file: Path) -> None:
+        claim_file = self._claim_file(input_file)
+        self._held.discard(claim_file)
+        claim_file.unlink(missing_ok=True)
+
+    def complete(self, input_file: Path) -> None:
+        """Move the outputs of a finished task into place and record them."""
+        work_dir = self.work_dir(input_file)
+        outputs = []
+        for path in sorted(p for p in work_dir.rglob("*") if p.is_file()):
+            output_file = self.output_dir / path.relative_to(work_dir)
+            output_file.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(path, output_file)
+            outputs.append(
+                {
+                    "path": str(path.relative_to(work_dir)),
+                    "size": output_file.stat().st_size,
+                    "hash": file_hash(output_file),
+                }
+            )
+
+        stat = input_file.stat()
+        record = {
+            "input": input_file.name,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "hash": file_hash(input_file),
+            "outputs": outputs,
+            "host": socket.gethostname(),
+            "finished": time.time(),
+        }
+        manifest_file = self._manifest_file(input_file)
+        tmp_file = manifest_file.with_name(f"{manifest_file.name}.{os.getpid()}.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(record, f)
+        os.replace(tmp_file, manifest_file)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        self.release(input_file)
+
+    def _heartbeat(self, stop: threading.Event) -> None:
+        while not stop.wait(self.lease / 4):
+            for claim_file in list(self._held):
+                try:
+                    os.utime(claim_file)
+                except FileNotFoundError:
+                    pass
+
+    def run(
+        self, process: Callable[[Path, Path], Any], num_workers: int = 1
+    ) -> List[Path]:
+        """Run `process(input_file, work_dir)` on the tasks this node claims.
+
+        Returns
+        -------
+        List[Path]
+            The input files processed by this node.
+        """
+        processed = []
+        pending: Dict[Future, Path] = {}  # type: ignore[type-arg]
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(stop,), daemon=True)
+        heartbeat.start()
+        try:
+            with ProcessPoolExecutor(max_workers=num_workers) as pool:
+
+                def finish(futures: Iterable[Future]) -> None:  # type: ignore[type-arg]
+                    for future in futures:
+                        input_file = pending.pop(future)
+                        try:
+                            future.result()
+                        except BaseException:
+                            # Leave the partial outputs to whoever retries
+                            self.release(input_file)
+                            raise
+                        self.complete(input_file)
+                        processed.append(input_file)
+
+                for input_file in self.input_files:
+                    # Only claim a task once a worker is free to start it
+                    while len(pending) >= num_workers:
+                        finish(wait(pending, return_when=FIRST_COMPLETED)[0])
+                    if self.is_done(input_file) or not self.claim(input_file):
+                        continue
+                    if self.is_done(input_file):
+                        # Finished by another node since the first check
+                        self.release(input_file)
+                        continue
+                    work_dir = self.work_dir(input_file)
+                    work_dir.mkdir(parents=True, exist_ok=True)
+                    future = pool.submit(process, input_file, work_dir)
+                    pending[future] = input_file
+                finish(wait(pending)[0])
+        finally:
+            stop.set()
+            for claim_file in list(self._held):
+                claim_file.unlink(missing_ok=True)
+            self._held.clear()
+        return processed
+
+
+def format_fasta_entry(tag: str, sequence: str, line_width: int = 60) -> str:
+    """Format a fasta entry, wrapping the sequence like BioPython does."""
+    lines = "".join(
+        f"{sequence[i : i + line_width]}\n" for i in range(0, len(sequence), line_width)
+    )
+    return f">{tag}\n{lines}"
+
+
+class FastaWriter:
+    """Append-only fasta writer for long running generation jobs."""
+
+    def __init__(
+        self,
+        fasta_file: PathLike,
+        custom_seq_name: str = "SyntheticSeq",
+        sync_every: int = 10,
+    ) -> None:
+        """Append records named `{custom_seq_name}_{i}` to a fasta file.
+
+        Records already in `fasta_file` are reloaded so that a restarted
+        job continues the numbering where the previous one stopped. The
+        length of the file at each sync is recorded in `{fasta_file}.synced`,
+        on restart anything written after the last sync is dropped. The
+        record is ignored if it belongs to another file of the same name.
+
+        Parameters
+        ----------
+        fasta_file : PathLike
+            Fasta file to append to, created if it does not exist.
+        custom_seq_name : str, optional
+            Name prefix of each record, by default "SyntheticSeq"
+        sync_every : int, optional
+            Flush and fsync the file after this many records, by default 10
+        """
+        self.fasta_file = Path(fasta_file)
+        self.custom_seq_name = custom_seq_name
+        self.sync_every = sync_every
+        self.synced_file = self.fasta_file.with_name(f"{self.fasta_file.name}.synced")
+        self.sequences: List[str] = []
+
+        if self.fasta_file.exists():
+            self._truncate_partial_entry()
+            self.sequences = list(iter_fasta_only_seq(self.fasta_file))
+
+        self._file = open(self.fasta_file, "a")
+        self._num_unsynced = 0
+
+    _HEAD_BYTES = 4096
+
+    def _identity(self, f: IO[bytes], num_bytes: int) -> Dict[str, Any]:
+        # Tells the synced file apart from one that later replaced it
+        f.seek(0)
+        head = f.read(min(num_bytes, self._HEAD_BYTES))
+        return {
+            "inode": os.fstat(f.fileno()).st_ino,
+            "head_md5": hashlib.md5(head).hexdigest(),
+        }
+
+    def _truncate_partial_entry(self) -> None:
+        # A crash in the middle of a write can leave a partial entry, even one
+        # that ends at a line boundary, drop everything after the last sync
+        # so that it is not mistaken for a generated sequence
+        try:
+            record = json.loads(self.synced_file.read_text())
+        except FileNotFoundError:
+            record = None
+        with open(self.fasta_file, "rb+") as f:
+            size = f.seek(0, os.SEEK_END)
+            synced = None
+            if record is not None and record["num_bytes"] <= size:
+                identity = self._identity(f, record["num_bytes"])
+                if all(record.get(key) == value for key, value in identity.items()):
+                    synced = record["num_bytes"]
+            if synced is not None:
+                f.truncate(synced)
+                return
+            # Files written without a sync record: an entry without its final
+            # newline is the only partial entry that can be told apart
+            if size == 0:
+                return
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                offsets = build_fasta_index(self.fasta_file)
+                f.truncate(offsets[-2] if len(offsets) > 1 else 0)
+
+    def __len__(self) -> int:
+        return len(self.sequences)
+
+    def write(self, sequence: str) -> None:
+        tag = f"{self.custom_seq_name}_{len(self.sequences)} {self.custom_seq_name}"
+        # A single write so the buffer never splits an entry between flushes
+        self._file.write(format_fasta_entry(tag, sequence))
+        self.sequences.append(sequence)
+        self._num_unsynced += 1
+        if self._num_unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        # Recorded after the fsync, so the file holds at least these bytes
+        num_bytes = self._file.tell()
+        with open(self.fasta_file, "rb") as f:
+            record = {"num_bytes": num_bytes, **self._identity(f, num_bytes)}
+        tmp_file = self.synced_file.with_name(f"{self.synced_file.name}.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(record, f)
+        os.replace(tmp_file, self.synced_file)
+        self._num_unsynced = 0
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+    def __enter__(self) -> "FastaWriter":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
 class FoundStopCodonCriteria(StoppingCriteria):  # type: ignore[misc]
     def __init__(self, tokenizer: PreTrainedTokenizerFast) -> None:
         self.tokenizer = tokenizer
@@ -158,28 +1096,52 @@ def tokens_to_sequences(
     return seq_strings
 
 
+@functools.lru_cache(maxsize=None)
+def _translate_codon(codon: str) -> str:
+    # Expand IUPAC ambiguity codes, the codon translates if every
+    # expansion agrees (GCN -> A, TAR -> *, RAY -> B)
+    if codon in CODON_TABLE:
+        return CODON_TABLE[codon]
+    if any(base not in _IUPAC_BASES for base in codon):
+        return "X"
+    amino_acids = frozenset(
+        CODON_TABLE[a + b + c]
+        for a in _IUPAC_BASES[codon[0]]
+        for b in _IUPAC_BASES[codon[1]]
+        for c in _IUPAC_BASES[codon[2]]
+    )
+    if len(amino_acids) == 1:
+        return next(iter(amino_acids))
+    return _AMBIGUOUS_AMINO_ACIDS.get(amino_acids, "X")
+
+
+def translate(sequence: str) -> str:
+    """Translate a DNA sequence to protein with the standard genetic code.
+
+    Stop codons become '*' and a trailing partial codon is ignored. Codons
+    with IUPAC ambiguity codes are resolved like BioPython does, e.g. GCN
+    becomes 'A' and codons whose amino acid is ambiguous become 'X'.
+    """
+    sequence = sequence.upper()
+    return "".join(
+        _translate_codon(sequence[i : i + 3])
+        for i in range(0, len(sequence) - len(sequence) % 3, 3)
+    )
+
+
 def seqs_to_fasta(
     seqs: List[str],
     file_name: Path,
     translate_to_protein: bool = False,
     custom_seq_name: str = "SyntheticSeq",
 ) -> None:
-    sequences = [Seq(seq) for seq in seqs]
-
     if translate_to_protein:
-        sequences = [s.translate() for s in sequences]
-
-    records = [
-        SeqRecord(
-            seq,
-            id=f"{custom_seq_name}_{i}",
-            name=custom_seq_name,
-            description=custom_seq_name,
-        )
-        for i, seq in enumerate(sequences)
-    ]
+        seqs = [translate(seq) for seq in seqs]
 
-    SeqIO.write(records, file_name, "fasta")
+    with open(file_name, "w") as f:
+        for i, seq in enumerate(seqs):
+            tag = f"{custom_seq_name}_{i} {custom_seq_name}"
+            f.write(format_fasta_entry(tag, seq))
 
 
 def non_redundant_generation(
@@ -191,90 +1153,120 @@ def non_redundant_generation(
     temperature: float = 1.0,
     num_seqs: int = 5,
     known_sequence_files: Optional[List[str]] = None,
+    known_sequence_index: Optional[KnownSequenceIndex] = None,
     start_sequence: Optional[str] = "ATG",
     to_stop_codon: bool = True,
     length_cutoff: bool = False,
     write_to_file: Optional[Path] = None,
-    custom_seq_name: Optional[str] = "SyntheticSeq",
+    custom_seq_name: str = "SyntheticSeq",
     maximum_iterations: Optional[int] = None,
 ) -> Dict[str, List[str]]:
     """Utility which will generate unique sequences which are not duplicates of each other nor found within the
     training dataset (optional). Returns a dictionary of unique sequences, all generated sequences, and time required.
+    Known sequences are given either as fasta files or as a prebuilt :obj:`KnownSequenceIndex`.
     """
     # initialization of variables
-    known_sequences: Set[str] = set()
+    known_sequences: Container[str] = set()
     all_generated_seqs: List[str] = list()
     unique_seqs: Set[str] = set()
 
-    if known_sequence_files is not None:
-        known_sequences = set(map(str, get_known_sequences(known_sequence_files)))
+    if known_sequence_index is not None:
+        known_sequences = known_sequence_index
+    elif known_sequence_files is not None:
+        known_sequences = set(get_known_sequences(known_sequence_files))
 
-    if len(known_sequences) > 1 and length_cutoff:
-        lengths = [len(s) for s in known_sequences]
-        length_cutoff = min(lengths)
+    if len(known_sequences) > 1 and length_cutoff:  # type: ignore[arg-type]
+        if isinstance(known_sequences, KnownSequenceIndex):
+            length_cutoff = known_sequences.min_length
+        else:
+            length_cutoff = min(len(s) for s in known_sequences)  # type: ignore[attr-defined]
     else:
         length_cutoff = 0
 
     print(f"Using length cutoff of {length_cutoff} - {length_cutoff // 3} tokens.")
 
-    # begin generation loop
-    iterations = 0
-    while len(unique_seqs) < num_seqs:
-        if maximum_iterations is not None:
-            if iterations >= maximum_iterations:
-                break
-        print(
-            f"Current number of unique sequences meeting criteria: {len(unique_seqs)}"
-        )
-        print(f"Current number of sequences generated: {len(all_generated_seqs)}")
-        tokens = generate_dna(
-            model,
-            tokenizer,
-            max_length=max_length,
-            top_k=top_k,
-            top_p=top_p,
-            num_seqs=1,
-            start_sequence=start_sequence,
-            temperature=temperature,
-        )
-        seq = tokens_to_sequences(
-            tokens, tokenizer=tokenizer, to_stop_codon=to_stop_codon
-        )[0]
-        print(seq)
-        all_generated_seqs.append(seq)
-        found_existing = seq in known_sequences
-        if not found_existing and len(seq) > length_cutoff:
-            unique_seqs.add(seq)
-            # TODO: append instead of overwrite?
-            if write_to_file:
-                seqs_to_fasta(
-                    unique_seqs, write_to_file, custom_seq_name=custom_seq_name
-                )
-                print("Wrote {} seqs to {}...".format(len(unique_seqs), write_to_file))
-        print("Found Existing: {}".format(found_existing))
-        print("Sequence Length: {}".format(len(seq)))
-        iterations += 1
-
-    # create dictionary of results
+    # Sequences are appended as they are found, and a restarted
+    # job resumes from the sequences already written
+    with ExitStack() as stack:
+        writer = None
+        resumed_seqs: List[str] = []
+        if write_to_file:
+            writer = stack.enter_context(
+                FastaWriter(write_to_file, custom_seq_name=custom_seq_name)
+            )
+            resumed_seqs = list(writer.sequences)
+            unique_seqs.update(resumed_seqs)
+            if resumed_seqs:
+                print(f"Resuming from {len(writer)} seqs in {write_to_file}...")
+
+        # begin generation loop
+        iterations = 0
+        while len(unique_seqs) < num_seqs:
+            if maximum_iterations is not None:
+                if iterations >= maximum_iterations:
+                    break
+            print(
+                f"Current number of unique sequences meeting criteria: {len(unique_seqs)}"
+            )
+            print(f"Current number of sequences generated: {len(all_generated_seqs)}")
+            tokens = generate_dna(
+                model,
+                tokenizer,
+                max_length=max_length,
+                top_k=top_k,
+                top_p=top_p,
+                num_seqs=1,
+                start_sequence=start_sequence,
+                temperature=temperature,
+            )
+            seq = tokens_to_sequences(
+                tokens, tokenizer=tokenizer, to_stop_codon=to_stop_codon
+            )[0]
+            print(seq)
+            all_generated_seqs.append(seq)
+            found_existing = seq in known_sequences
+            if (
+                not found_existing
+                and len(seq) > length_cutoff
+                and seq not in unique_seqs
+            ):
+                unique_seqs.add(seq)
+                if writer is not None:
+                    writer.write(seq)
+                    print("Wrote {} seqs to {}...".format(len(writer), write_to_file))
+            print("Found Existing: {}".format(found_existing))
+            print("Sequence Length: {}".format(len(seq)))
+            iterations += 1
+
+    # create dictionary of results, the resumed sequences were generated
+    # by an earlier run and are not part of all_generated_seqs
     results = {
         "unique_seqs": list(unique_seqs),
         "all_generated_seqs": all_generated_seqs,
+        "resumed_seqs": resumed_seqs,
     }
     return results
 
 
-def get_known_sequences(files: List[str]) -> List[Seq]:
-    """Return list of Seq objects from given list of files"""
+def unique_proportion(results: Dict[str, List[str]]) -> Optional[float]:
+    """Proportion of the sequences generated by this run that were kept,
+    None if nothing was generated (e.g. a resumed run that was complete)."""
+    num_new = len(results["unique_seqs"]) - len(results.get("resumed_seqs", []))
+    if not results["all_generated_seqs"]:
+        return None
+    return num_new / len(results["all_generated_seqs"])
+
+
+def get_known_sequences(files: List[str]) -> List[str]:
+    """Return list of sequences from given list of files"""
     known_sequences = []
     for f in files:
-        records = list(SeqIO.parse(f, "fasta"))
-        seqs = [s.seq for s in records]
-        known_sequences.extend(seqs)
+        known_sequences.extend(iter_fasta_only_seq(f))
     return known_sequences
 
 
 def redundancy_check(
-    generated: str, known_sequences: List[Seq], verbose: bool = False
+    generated: str, known_sequences: List[str], verbose: bool = False
 ) -> bool:
     """Check if a sequence appears in a list of known sequence"""
     for gen_seq in tqdm(generated, disable=verbose):
@@ -452,6 +1444,7 @@ class SequenceGenerationCallback(Callback):
         output_dir: Path,
         custom_seq_name: str = "SyntheticSeq",
         known_sequence_files: Optional[List[str]] = None,
+        known_sequence_index: Optional[Path] = None,
     ) -> None:
         super().__init__()
 
@@ -461,6 +1454,11 @@ class SequenceGenerationCallback(Callback):
         self.custom_seq_name = custom_seq_name
         self.known_sequence_files = known_sequence_files
 
+        # Load the known sequences once instead of at every test epoch
+        self.known_sequences: Optional[KnownSequenceIndex] = None
+        if known_sequence_index is not None:
+            self.known_sequences = KnownSequenceIndex.load(known_sequence_index)
+
         # Collect generated sequences at each epoch end
         self.final_sequences: Dict[str, List[str]] = {}
 
@@ -468,13 +1466,18 @@ class SequenceGenerationCallback(Callback):
         self, trainer: "pl.Trainer", pl_module: "pl.LightningModule"
     ) -> None:
 
+        if self.known_sequences is None and self.known_sequence_files is not None:
+            self.known_sequences = KnownSequenceIndex.build(
+                self.known_sequence_files, verify=True
+            )
+
         # Generate sequences using the model
         results = non_redundant_generation(
             pl_module.model,
             pl_module.tokenizer,
             num_seqs=self.num_test_seqs_per_gpu,
             max_length=self.block_size,
-            known_sequence_files=self.known_sequence_files,
+            known_sequence_index=self.known_sequences,
         )
         unique_seqs, all_seqs = results["unique_seqs"], results["all_generated_seqs"]
         print(f"Proportion of unique seqs: {len(unique_seqs) / len(all_seqs)}")
@@ -0,0 +1,18 @@
+import pytest
+from tokenizers import Tokenizer
+from transformers import PreTrainedTokenizerFast
+
+from genslm import GenSLM
+
+
+@pytest.fixture(scope="session")
+def tokenizer(request: pytest.FixtureRequest) -> PreTrainedTokenizerFast:
+    """Tokenizer of the 25M model, or of the file passed by indirect parametrization."""
+    tokenizer_file = getattr(
+        request, "param", GenSLM.MODELS["genslm_25M_patric"]["tokenizer"]
+    )
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=Tokenizer.from_file(str(tokenizer_file))
+    )
+    tokenizer.add_special_tokens({"pad_token": "[PAD]"})
+    return tokenizer
@@ -1,11 +1,33 @@
+import functools
+import gzip
 import itertools
+import json
+import pickle
+from pathlib import Path
 
+import h5py
 import numpy as np
-from tokenizers import Tokenizer
+import pytest
+import torch
 from torch.utils.data import DataLoader
-from transformers import PreTrainedTokenizerFast
+from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
 
-from genslm import GenSLM, SequenceDataset
+from genslm import SequenceDataset
+from genslm.dataset import (
+    CachingH5Dataset,
+    H5Dataset,
+    H5Writer,
+    ShardedH5Dataset,
+    check_packed_support,
+    pack_nucleotides,
+    pack_records,
+    packed_attention_mask,
+    packed_inputs,
+    pad_collate_fn,
+    parse_compression,
+    unpack_nucleotides,
+)
+from genslm.utils import seqs_to_fasta
 
 
 def generate_random_sequence(min_length: int = 10, max_length: int = 2020) -> str:
@@ -22,16 +44,7 @@ def generate_random_sequence(min_length: int = 10, max_length: int = 2020) -> st
     return "".join(sequence)
 
 
-def test_dataset_length():
-
-    # Setup tokenizer
-    tokenizer = PreTrainedTokenizerFast(
-        tokenizer_object=Tokenizer.from_file(
-            GenSLM.MODELS["genslm_25M_patric"]["tokenizer"]
-        )
-    )
-    tokenizer.add_special_tokens({"pad_token": "[PAD]"})
-
+def test_dataset_length(tokenizer: PreTrainedTokenizerFast) -> None:
     # Generate a number of sequences
     num_seqs = 100
     sequences = [generate_random_sequence() for _ in range(num_seqs)]
@@ -47,3 +60,416 @@ def test_dataset_length():
         batch_seq_len = batch["attention_mask"].sum().item()
         # If exactly equal, no unknown tokens were added
         assert batch_seq_len == len(seq) // 3
+
+
+def test_pack_nucleotides():
+    sequences = [generate_random_sequence(max_length=100) for _ in range(10)]
+    # Ambiguity codes, lower case and empty sequences must survive the round trip
+    sequences += ["ATGNNNTAA", "acgtRYK", "", "A"]
+    packed = pack_nucleotides(sequences)
+    assert packed["sequence_packed"].nbytes <= sum(len(s) // 4 + 1 for s in sequences)
+    assert unpack_nucleotides(**packed) == sequences
+
+
+def test_lazy_dataset(tokenizer: PreTrainedTokenizerFast) -> None:
+    sequences = [generate_random_sequence(max_length=100) for _ in range(10)]
+    dataset = SequenceDataset(sequences, 64, tokenizer, verbose=False, batch_size=3)
+    lazy_dataset = SequenceDataset(sequences, 64, tokenizer, verbose=False, lazy=True)
+
+    # Eager tokens are stored compactly but samples are the same
+    assert dataset.input_ids.dtype == np.uint8
+    assert len(dataset) == len(lazy_dataset) == len(sequences)
+    for i in range(len(sequences)):
+        sample, lazy_sample = dataset[i], lazy_dataset[i]
+        assert sample["input_ids"].shape == (64,)
+        assert sample["attention_mask"].shape == (1, 64)
+        for key in sample:
+            assert sample[key].dtype == lazy_sample[key].dtype
+            assert sample[key].equal(lazy_sample[key])
+
+
+def test_pack_records() -> None:
+    lengths = [5, 3, 8, 2, 6, 1, 0]
+    input_ids = np.zeros((len(lengths), 8), dtype=np.int64)
+    attention_mask = np.zeros((len(lengths), 8), dtype=np.int8)
+    for i, length in enumerate(lengths):
+        input_ids[i, :length] = np.arange(length) + 10 * (i + 1)
+        attention_mask[i, :length] = 1
+
+    packed = pack_records(input_ids, attention_mask, pad_token_id=0)
+    assert packed["input_ids"].shape == (4, 8)
+    assert packed["attention_mask"].dtype == np.int8
+    assert packed["attention_mask"].sum() == sum(lengths)
+
+    # Every non-empty record appears whole in exactly one row
+    rows = [
+        packed["input_ids"][row][packed["segment_ids"][row] == segment].tolist()
+        for row in range(len(packed["input_ids"]))
+        for segment in range(1, packed["segment_ids"][row].max() + 1)
+    ]
+    records = [input_ids[i, :length].tolist() for i, length in enumerate(lengths)]
+    records.remove([])
+    assert sorted(rows) == sorted(records)
+
+    # Positions restart at each record and no token is predicted across records
+    segment_ids = np.array([1, 1, 1, 2, 2, 0])
+    inputs = packed_inputs(np.arange(6) + 10, segment_ids)
+    assert inputs["position_ids"].tolist() == [0, 1, 2, 0, 1, 0]
+    assert inputs["labels"].tolist() == [-100, 11, 12, -100, 14, -100]
+
+    mask = packed_attention_mask(torch.from_numpy(segment_ids)[None], torch.float32)
+    assert mask.shape == (1, 1, 6, 6)
+    assert (mask[0, 0] == 0).tolist()[4] == [False, False, False, True, True, False]
+
+
+def test_check_packed_support(monkeypatch: pytest.MonkeyPatch) -> None:
+    config = GPT2Config(
+        n_layer=1, n_head=2, n_embd=8, vocab_size=16, n_positions=8, eos_token_id=0
+    )
+    model = GPT2LMHeadModel(config).eval()
+    check_packed_support(model)
+
+    # The records of a packed row give the same outputs as on their own
+    input_ids = torch.tensor([[1, 2, 3, 4, 5, 0]])
+    segment_ids = np.array([[1, 1, 1, 2, 2, 0]])
+    with torch.no_grad():
+        packed = model(
+            input_ids,
+            attention_mask=packed_attention_mask(
+                torch.from_numpy(segment_ids), model.dtype
+            ),
+            position_ids=packed_inputs(input_ids.numpy(), segment_ids)["position_ids"],
+        ).logits[0]
+        first = model(input_ids[:, :3]).logits[0]
+        second = model(input_ids[:, 3:5]).logits[0]
+    assert torch.allclose(packed[:3], first, atol=1e-5)
+    assert torch.allclose(packed[3:5], second, atol=1e-5)
+
+    class NoPositionIds(torch.nn.Module):
+        def forward(self, input_ids, attention_mask=None):  # type: ignore
+            return input_ids
+
+    stub = NoPositionIds()
+    stub.config = config
+    with pytest.raises(ValueError, match="position_ids"):
+        check_packed_support(stub)
+    # The transformers fork pinned in setup.cfg
+    monkeypatch.setattr("genslm.dataset.transformers.__version__", "4.21.0.dev0")
+    with pytest.raises(ValueError, match="needs transformers>=4.53"):
+        check_packed_support(model)
+    model.config.model_type = "reformer"
+    with pytest.raises(ValueError, match="4D attention masks"):
+        check_packed_support(model)
+
+
+def test_h5_writer_resume(tmp_path: Path) -> None:
+    h5_file = tmp_path / "test.h5"
+    with pytest.raises(RuntimeError):
+        with H5Writer(h5_file) as writer:
+            writer.write({"input_ids": np.zeros((4, 8)), "id": ["a"] * 4})
+            # Simulate a crash in the middle of writing a block
+            writer.h5_file["input_ids"].resize(6, axis=0)
+            raise RuntimeError
+
+    assert not H5Writer.is_complete(h5_file)
+    with H5Writer(h5_file) as writer:
+        assert writer.num_records == 4
+        writer.write({"input_ids": np.ones((2, 8)), "id": ["b"] * 2})
+
+    assert H5Writer.is_complete(h5_file)
+    with h5py.File(h5_file, "r") as f:
+        assert f["input_ids"][...].sum() == 16
+        assert f["id"].asstr()[...].tolist() == ["a"] * 4 + ["b"] * 2
+
+
+def test_h5_compression(tmp_path: Path) -> None:
+    compression = parse_compression(["lzf", "input_ids=gzip:1", "id=none"])
+    assert compression == {"default": "lzf", "input_ids": "gzip:1", "id": "none"}
+    with pytest.raises(ValueError):
+        parse_compression(["input_ids=bzip2"])
+
+    input_ids = np.arange(40 * 8).reshape(40, 8) % 7
+    data = {
+        "input_ids": input_ids,
+        "attention_mask": np.ones_like(input_ids),
+        "id": [str(i) for i in range(40)],
+        "sequence": ["ATG"] * 40,
+    }
+    h5_file = tmp_path / "test.h5"
+    H5Dataset.write_h5(h5_file, data, compression=compression, chunk_rows=4)
+    with h5py.File(h5_file, "r") as f:
+        assert f["input_ids"].compression == "gzip"
+        assert f["input_ids"].compression_opts == 1
+        assert f["attention_mask"].compression == "lzf"
+        assert f["id"].compression is None
+        # Every sample is read from a chunk of its own 4 rows
+        assert f["input_ids"].chunks == (4, 8)
+        assert (f["input_ids"][...] == input_ids).all()
+
+    # The layout can be changed afterwards without changing the contents
+    H5Dataset.rewrite_h5(h5_file, tmp_path / "none.h5", {"default": "none"})
+    with h5py.File(h5_file, "r") as f, h5py.File(tmp_path / "none.h5", "r") as g:
+        assert g.attrs["num_records"] == 40
+        for key in f:
+            assert g[key].compression is None
+            assert (f[key][...] == g[key][...]).all()
+
+
+def test_concatenate_virtual_h5(tmp_path: Path) -> None:
+    files = []
+    for i, num_rows in enumerate([3, 0, 5, 2]):
+        files.append(tmp_path / f"{i}.h5")
+        with h5py.File(files[-1], "w") as f:
+            f["input_ids"] = np.full((num_rows, 4), i)
+            f["flat"] = np.arange(2 * num_rows)
+            f.create_dataset("id", data=[str(i)] * num_rows, dtype=h5py.string_dtype())
+
+    H5Dataset.concatenate_virtual_h5(files, tmp_path / "virtual.h5")
+    with h5py.File(tmp_path / "virtual.h5", "r") as f:
+        assert f["input_ids"][:, 0].tolist() == [0] * 3 + [2] * 5 + [3] * 2
+        assert len(f["flat"]) == 20
+        assert f["id"].asstr()[-2:].tolist() == ["3", "3"]
+
+    # Corrupt and mismatched files are reported, or left out
+    (tmp_path / "corrupt.h5").write_bytes(b"not an h5 file")
+    with h5py.File(tmp_path / "wide.h5", "w") as f:
+        f["input_ids"] = np.zeros((1, 8))
+        f["flat"] = np.arange(2)
+        f["id"] = ["wide"]
+    bad_files = [tmp_path / "corrupt.h5", tmp_path / "wide.h5"]
+    with pytest.raises(ValueError, match="2 of 6 files are invalid"):
+        H5Dataset.concatenate_virtual_h5(files + bad_files, tmp_path / "virtual.h5")
+    with pytest.warns(UserWarning):
+        invalid = H5Dataset.concatenate_virtual_h5(
+            files + bad_files, tmp_path / "virtual.h5", skip_invalid=True
+        )
+    assert list(invalid) == bad_files
+    with h5py.File(tmp_path / "virtual.h5", "r") as f:
+        assert f["input_ids"].shape == (10, 4)
+
+
+def test_concatenate_h5(tmp_path: Path) -> None:
+    files = []
+    for i, num_rows in enumerate([3, 0, 5, 2, 4]):
+        files.append(tmp_path / f"{i}.h5")
+        with h5py.File(files[-1], "w") as f:
+            f["input_ids"] = np.full((num_rows, 4), i)
+            f.create_dataset("id", data=[str(i)] * num_rows, dtype=h5py.string_dtype())
+    (tmp_path / "corrupt.h5").write_bytes(b"not an h5 file")
+    files.insert(2, tmp_path / "corrupt.h5")
+
+    with pytest.raises(ValueError, match="1 of 6 files are invalid"):
+        H5Dataset.concatenate_h5(files, tmp_path / "full.h5")
+    # A buffer smaller than a file writes every file separately
+    with pytest.warns(UserWarning):
+        invalid = H5Dataset.concatenate_h5(
+            files, tmp_path / "full.h5", buffer_bytes=64, skip_invalid=True
+        )
+    assert list(invalid) == [tmp_path / "corrupt.h5"]
+    with h5py.File(tmp_path / "full.h5", "r") as f:
+        assert f["input_ids"][:, 0].tolist() == [0] * 3 + [2] * 5 + [3] * 2 + [4] * 4
+        assert (
+            f["id"].asstr()[...].tolist()
+            == ["0"] * 3 + ["2"] * 5 + ["3"] * 2 + ["4"] * 4
+        )
+        assert f.attrs["num_inputs"] == len(files)
+
+    # Only left out files after the last write
+    files.append(tmp_path / "zz_corrupt.h5")
+    files[-1].write_bytes(b"not an h5 file")
+    with pytest.warns(UserWarning):
+        invalid = H5Dataset.concatenate_h5(
+            files, tmp_path / "full.h5", buffer_bytes=64, skip_invalid=True
+        )
+    assert list(invalid) == [tmp_path / "corrupt.h5", tmp_path / "zz_corrupt.h5"]
+    with h5py.File(tmp_path / "full.h5", "r") as f:
+        assert f["input_ids"].shape == (14, 4)
+        assert f.attrs["num_inputs"] == len(files)
+
+
+def test_concatenate_h5_raw_chunks(
+    tmp_path: Path, capsys: pytest.CaptureFixture
+) -> None:
+    files = []
+    for i, num_rows in enumerate([4, 2, 6]):
+        files.append(tmp_path / f"{i}.h5")
+        with H5Writer(files[-1], chunk_rows=2) as writer:
+            writer.write({"input_ids": np.full((num_rows, 8), i, dtype=np.int8)})
+
+    H5Dataset.concatenate_h5(files, tmp_path / "copied.h5", chunk_rows=2)
+    assert "Chunks copied without recompressing: 6" in capsys.readouterr().out
+    # A different level is recompressed
+    H5Dataset.concatenate_h5(
+        files,
+        tmp_path / "recompressed.h5",
+        chunk_rows=2,
+        compression={"default": "gzip:1"},
+    )
+    assert "Chunks copied without recompressing: 0" in capsys.readouterr().out
+    with h5py.File(tmp_path / "copied.h5") as f, h5py.File(
+        tmp_path / "recompressed.h5"
+    ) as g:
+        expected = [0] * 4 + [1] * 2 + [2] * 6
+        assert f["input_ids"][:, 0].tolist() == expected
+        assert g["input_ids"][:, 0].tolist() == expected
+
+
+def test_reshard_h5(tmp_path: Path) -> None:
+    rng = np.random.default_rng(0)
+    files, rows = [], []
+    for i, num_rows in enumerate([5, 0, 9, 3]):
+        lengths = rng.integers(1, 8, num_rows).astype(np.int32)
+        tokens = rng.integers(0, 100, lengths.sum()).astype(np.int8)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        rows += [tokens[offsets[j] : offsets[j + 1]] for j in range(num_rows)]
+        files.append(tmp_path / f"{i}.h5")
+        with H5Writer(files[-1]) as writer:
+            writer.write(
+                {"tokens": tokens, "lengths": lengths, "id": [str(i)] * num_rows},
+                num_records=num_rows,
+            )
+
+    manifest_file = tmp_path / "sharded" / "train.json"
+    H5Dataset.reshard_h5(files, manifest_file, shard_records=4, buffer_bytes=64)
+    manifest = json.loads(manifest_file.read_text())
+    assert manifest["offsets"] == [0, 3, 6, 10, 13, 17]
+    assert len(manifest["shards"]) == 5
+
+    dataset = ShardedH5Dataset(manifest_file, max_open_files=2)
+    assert len(dataset) == 17 and dataset.ragged
+    for idx in [0, 16, 5, 3, 12, 8, 11]:
+        assert dataset[idx]["input_ids"].tolist() == rows[idx].tolist()
+        assert len(dataset._shards) <= 2
+    # Open files are left out of copies for new workers
+    assert not pickle.loads(pickle.dumps(dataset))._shards
+
+    # The rows of the flat tokens are only known from their lengths
+    with pytest.raises(ValueError, match="select lengths"):
+        H5Dataset.reshard_h5(files, manifest_file, num_shards=2, fields=["tokens"])
+    H5Dataset.reshard_h5(files, manifest_file, num_shards=2, fields=["id"])
+    assert json.loads(manifest_file.read_text())["offsets"] == [0, 8, 17]
+
+
+def test_h5_to_fasta(tmp_path: Path) -> None:
+    sequences = [generate_random_sequence(max_length=50) + "N" for _ in range(11)]
+    descriptions = [f"seq{i}" for i in range(11)]
+    with h5py.File(tmp_path / "0.h5", "w") as f:
+        f["description"] = descriptions[:7]
+        f["sequence"] = sequences[:7]
+    with h5py.File(tmp_path / "1.h5", "w") as f:
+        f["description"] = descriptions[7:]
+        for key, value in pack_nucleotides(sequences[7:]).items():
+            f[key] = value
+    files = [tmp_path / "0.h5", tmp_path / "1.h5"]
+
+    def expected(num_slice: int) -> str:
+        inds = list(range(0, 7, num_slice)) + list(range(7, 11, num_slice))
+        return "".join(f">{descriptions[i]}\n{sequences[i]}\n" for i in inds)
+
+    # Chunks smaller than the files, the last record of each file is kept
+    num_records = H5Dataset.h5_to_fasta(
+        files, tmp_path / "out.fasta", num_workers=2, num_slice=2, chunk_rows=3
+    )
+    assert num_records == 6
+    assert (tmp_path / "out.fasta").read_text() == expected(2)
+    H5Dataset.h5_to_fasta(files, tmp_path / "out.fasta.gz", chunk_rows=2)
+    assert gzip.decompress((tmp_path / "out.fasta.gz").read_bytes()).decode() == (
+        expected(1)
+    )
+
+
+def test_parallel_preprocess(
+    tmp_path: Path, tokenizer: PreTrainedTokenizerFast
+) -> None:
+    sequences = [generate_random_sequence(max_length=200) for _ in range(300)]
+    fasta_file = tmp_path / "test.fasta"
+    seqs_to_fasta(sequences, fasta_file)
+
+    # Blocks of 100 records are not aligned with the chunks of the file
+    kwargs = dict(tokenizer=tokenizer, block_size=128, subsample=2, chunk_size=100)
+    H5Dataset.preprocess(fasta_file, tmp_path / "serial.h5", **kwargs)
+    H5Dataset.parallel_preprocess(
+        fasta_file, tmp_path / "parallel.h5", num_workers=2, **kwargs
+    )
+
+    with h5py.File(tmp_path / "serial.h5") as f, h5py.File(
+        tmp_path / "parallel.h5"
+    ) as g:
+        assert f.keys() == g.keys()
+        for key in f:
+            assert np.array_equal(f[key][...], g[key][...])
+        assert f["sequence"].asstr()[...].tolist() == sequences[::2]
+        assert f["attention_mask"][...].sum(axis=1).max() == 128
+
+    # The keep-mask of another version of the file is rejected
+    np.save(tmp_path / "mask.npy", np.ones(299, dtype=bool))
+    for preprocess in [H5Dataset.preprocess, H5Dataset.parallel_preprocess]:
+        with pytest.raises(ValueError, match="299 entries for 300 records"):
+            preprocess(
+                fasta_file,
+                tmp_path / "masked.h5",
+                keep_mask=tmp_path / "mask.npy",
+                **kwargs,
+            )
+
+
+def test_split_preprocess(tmp_path: Path, tokenizer: PreTrainedTokenizerFast) -> None:
+    sequences = [generate_random_sequence(max_length=100) for _ in range(200)]
+    # Duplicates must not end up in both train and test
+    sequences += sequences[:50]
+    fasta_file = tmp_path / "test.fasta"
+    seqs_to_fasta(sequences, fasta_file)
+
+    split = {"train": 0.6, "val": 0.2, "test": 0.2}
+    kwargs = dict(tokenizer=tokenizer, block_size=64, train_val_test_split=split)
+    H5Dataset.parallel_preprocess(
+        fasta_file, tmp_path / "a.h5", chunk_size=32, **kwargs
+    )
+    H5Dataset.parallel_preprocess(
+        fasta_file, tmp_path / "b.h5", chunk_size=100, **kwargs
+    )
+
+    splits = {}
+    for name in split:
+        with h5py.File(tmp_path / f"a_{name}.h5") as f, h5py.File(
+            tmp_path / f"b_{name}.h5"
+        ) as g:
+            splits[name] = f["sequence"].asstr()[...].tolist()
+            # The assignment does not depend on how the input is chunked
+            assert splits[name] == g["sequence"].asstr()[...].tolist()
+
+    assert sorted(sum(splits.values(), [])) == sorted(sequences)
+    assert not set(splits["train"]) & set(splits["test"])
+    assert H5Dataset.train_val_test_split(sequences, 0.6, 0.2) == splits
+
+
+@pytest.mark.parametrize("pack", [False, True])
+def test_ragged_h5(
+    tmp_path: Path, pack: bool, tokenizer: PreTrainedTokenizerFast
+) -> None:
+    sequences = [generate_random_sequence(max_length=100) for _ in range(50)]
+    fasta_file = tmp_path / "test.fasta"
+    seqs_to_fasta(sequences, fasta_file)
+
+    kwargs = dict(tokenizer=tokenizer, block_size=128, pack_records=pack)
+    H5Dataset.preprocess(fasta_file, tmp_path / "v1.h5", **kwargs)
+    H5Dataset.preprocess(fasta_file, tmp_path / "v2.h5", ragged=True, **kwargs)
+    H5Dataset.convert_to_ragged(tmp_path / "v1.h5", tmp_path / "converted.h5")
+
+    with h5py.File(tmp_path / "v2.h5") as f, h5py.File(tmp_path / "converted.h5") as g:
+        assert "input_ids" not in f and f.keys() == g.keys()
+        for key in f:
+            assert np.array_equal(f[key][...], g[key][...])
+
+    # Padding at collate time gives the same batches as the padded files
+    collate_fn = functools.partial(
+        pad_collate_fn, pad_token_id=tokenizer.pad_token_id, max_length=128
+    )
+    padded = DataLoader(CachingH5Dataset(tmp_path / "v1.h5", 0), batch_size=8)
+    ragged = DataLoader(
+        CachingH5Dataset(tmp_path / "v2.h5", 0), batch_size=8, collate_fn=collate_fn
+    )
+    for batch, ragged_batch in zip(padded, ragged):
+        assert batch.keys() == ragged_batch.keys()
+        for key in batch:
+            assert batch[key].equal(ragged_batch[key])
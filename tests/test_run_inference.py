@@ -0,0 +1,237 @@
+import functools
+import hashlib
+import os
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+from typing import List
+
+import h5py
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader
+from transformers import PreTrainedTokenizerFast
+from transformers.modeling_outputs import CausalLMOutput
+
+from genslm.cmdline.run_inference import (
+    InferenceSequenceDataset,
+    LightningGenSLM,
+    OutputsCallback,
+    iter_sequence_outputs,
+    pad_to_longest_collate_fn,
+    read_average_embeddings,
+    read_full_embeddings,
+)
+from genslm.tokenizer import KmerTokenizer
+from genslm.utils import SequenceStore
+
+
+def write_fasta_files(fasta_dir: Path, num_files: int) -> List[str]:
+    """Write `num_files` fasta files and return their sequences in natsort order."""
+    rng = np.random.default_rng(0)
+    fasta_dir.mkdir()
+    sequences = []
+    for i in range(num_files):
+        seqs = ["".join(rng.choice(list("ACGT"), 3 * (i + j + 1))) for j in range(3)]
+        text = "".join(f">seq_{i}_{j}\n{seq}\n" for j, seq in enumerate(seqs))
+        (fasta_dir / f"part_{i}.fasta").write_text(text)
+        sequences.extend(seqs)
+    return sequences
+
+
+def test_read_sequences(tmp_path: Path) -> None:
+    # part_10 sorts after part_9
+    sequences = write_fasta_files(tmp_path / "fasta", 11)
+    assert InferenceSequenceDataset.read_sequences(tmp_path / "fasta", 3) == sequences
+
+
+def test_shared_sequence_cache(
+    tmp_path: Path, tokenizer: PreTrainedTokenizerFast
+) -> None:
+    sequences = write_fasta_files(tmp_path / "fasta", 3)
+    store_dir = tmp_path / "sequence_cache"
+
+    def make_dataset(local_rank: int, timeout: float = 60) -> InferenceSequenceDataset:
+        return InferenceSequenceDataset(
+            tmp_path / "fasta",
+            16,
+            tokenizer,
+            sequence_cache=store_dir,
+            local_rank=local_rank,
+            cache_timeout=timeout,
+        )
+
+    # Other ranks wait for the first rank of the node, but not forever
+    with pytest.raises(TimeoutError):
+        make_dataset(1, timeout=0)
+    datasets = {}
+    thread = threading.Thread(target=lambda: datasets.update({1: make_dataset(1)}))
+    thread.start()
+    thread.join(timeout=2)
+    assert thread.is_alive() and not store_dir.exists()
+    datasets[0] = make_dataset(0)
+    thread.join()
+    for dataset in datasets.values():
+        assert isinstance(dataset.raw_sequences, SequenceStore)
+        assert list(dataset.iter_sequences()) == sequences
+
+    # A later run reuses the store until the fasta files change
+    store_mtime = (store_dir / "data.npy").stat().st_mtime_ns
+    assert list(make_dataset(0).iter_sequences()) == sequences
+    assert (store_dir / "data.npy").stat().st_mtime_ns == store_mtime
+
+    fasta_file = tmp_path / "fasta" / "part_2.fasta"
+    fasta_file.write_text(">new\nATGAAA\n")
+    os.utime(fasta_file, ns=(0, 0))
+    assert list(make_dataset(0).iter_sequences()) == sequences[:6] + ["ATGAAA"]
+
+    # The first rank of another node that finishes later keeps the store
+    source = SequenceStore.read_source(store_dir)
+    SequenceStore.write(["ATG"], store_dir, source=source, overwrite=True)
+    assert len(SequenceStore(store_dir)) == 7
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["fasta", "sequence_cache"]
+
+
+def test_read_stitched_embeddings(tmp_path: Path) -> None:
+    rng = np.random.default_rng(0)
+    hidden_dim, window_len = 4, 8
+    # A sequence of 14 tokens in two overlapping windows, then a short one
+    positions = np.array(
+        [np.arange(0, 8), np.arange(6, 14), np.r_[np.arange(5), [-1] * 3]]
+    )
+    batch = {
+        "positions": torch.from_numpy(positions),
+        "num_windows": torch.tensor([2, 1]),
+        "seq_lens": torch.tensor([14, 5]),
+    }
+    outputs = rng.random((3, window_len, hidden_dim)).astype(np.float32)
+    sequence_outputs = list(iter_sequence_outputs(outputs, batch))
+    assert [len(output) for output in sequence_outputs] == [14, 5]
+
+    # Written like OutputsCallback writes them
+    with h5py.File(tmp_path / "embeddings.h5", "w") as f:
+        group = f.create_group("embeddings")
+        for idx, output in enumerate(sequence_outputs):
+            group.create_dataset(str(idx), data=output)
+        f["na-hashes"] = ["a", "b"]
+
+    full = read_full_embeddings(
+        tmp_path / "embeddings.h5", hidden_dim, window_len, num_workers=2
+    )["embeddings"]
+    assert full.shape == (2, 14, hidden_dim)
+    for embedding, output in zip(full, sequence_outputs):
+        assert np.array_equal(embedding[: len(output)], output)
+        assert not embedding[len(output) :].any()
+
+    average = read_average_embeddings(
+        tmp_path / "embeddings.h5", hidden_dim, window_len, num_workers=2
+    )["embeddings"]
+    expected = [output.mean(axis=0) for output in sequence_outputs]
+    assert np.allclose(average, expected)
+
+
+def test_sort_by_length(tmp_path: Path, tokenizer: PreTrainedTokenizerFast) -> None:
+    rng = np.random.default_rng(0)
+    sequences = ["".join(rng.choice(list("ACGT"), 3 * n)) for n in [2, 9, 4, 30, 1]]
+    (tmp_path / "test.fasta").write_text(
+        "".join(f">seq_{i}\n{seq}\n" for i, seq in enumerate(sequences))
+    )
+    expected = KmerTokenizer(tokenizer)(sequences, 3, 16)
+    dataset = InferenceSequenceDataset(
+        tmp_path / "test.fasta", 16, tokenizer, sort_by_length=True
+    )
+    dataloader = DataLoader(
+        dataset,
+        batch_size=2,
+        collate_fn=functools.partial(pad_to_longest_collate_fn, pad_to_multiple_of=4),
+    )
+
+    # Batches run from longest to shortest, each padded to its longest
+    callback = OutputsCallback(save_dir=tmp_path / "outputs", layers=[0])
+    seq_lens = []
+    for batch in dataloader:
+        lengths = batch["seq_lens"].reshape(-1)
+        seq_lens.extend(lengths.tolist())
+        input_ids, attention_mask = batch["input_ids"], batch["attention_mask"][:, 0]
+        assert input_ids.shape[-1] == -(-int(lengths.max()) // 4) * 4
+        assert attention_mask.shape == input_ids.shape
+        assert attention_mask.sum(-1).tolist() == lengths.tolist()
+        assert (input_ids[attention_mask == 0] == tokenizer.pad_token_id).all()
+
+        # The input ids stand in for the embeddings of each token
+        outputs = SimpleNamespace(hidden_states=[input_ids[..., None].float()])
+        callback.on_predict_batch_end(None, None, outputs, batch, 0, 0)
+    callback.on_predict_end(None, None)
+    assert seq_lens == sorted(seq_lens, reverse=True)
+
+    # The outputs are read back in the order of the fasta file
+    (h5_file,) = (tmp_path / "outputs").glob("*.h5")
+    outputs = read_full_embeddings(h5_file, 1, 16, num_workers=1, return_md5=True)
+    embeddings = outputs["embeddings"][..., 0]
+    assert np.array_equal(
+        embeddings * expected["attention_mask"],
+        expected["input_ids"] * expected["attention_mask"],
+    )
+    hashes = [hashlib.md5(seq.encode("utf-8")).hexdigest() for seq in sequences]
+    assert [h.decode("ascii") for h in outputs["na-hashes"]] == hashes
+
+
+def test_shared_token_cache(tmp_path: Path, tokenizer: PreTrainedTokenizerFast) -> None:
+    sequences = write_fasta_files(tmp_path / "fasta", 2)
+
+    def make_dataset(local_rank: int, timeout: float = 60) -> InferenceSequenceDataset:
+        return InferenceSequenceDataset(
+            tmp_path / "fasta",
+            16,
+            tokenizer,
+            token_cache=tmp_path / "token_cache",
+            local_rank=local_rank,
+            cache_timeout=timeout,
+        )
+
+    # Only the first rank of the node tokenizes, the others wait for it
+    with pytest.raises(TimeoutError):
+        make_dataset(1, timeout=0)
+    first = make_dataset(0)
+    (cache_dir,) = (tmp_path / "token_cache").iterdir()
+    segments = sorted(cache_dir.glob("segment-*"))
+    other = make_dataset(1, timeout=0)
+    assert sorted(cache_dir.glob("segment-*")) == segments
+    assert len(first) == len(other) == len(sequences)
+    for idx in range(len(sequences)):
+        assert first[idx]["na_hash"] == other[idx]["na_hash"]
+        assert torch.equal(first[idx]["input_ids"], other[idx]["input_ids"])
+
+
+def test_predict_micro_batches() -> None:
+    class Model(torch.nn.Module):
+        def __init__(self) -> None:
+            super().__init__()
+            self.embedding = torch.nn.Embedding(16, 4)
+            self.batch_sizes: List[int] = []
+
+        def forward(
+            self, input_ids: torch.Tensor, attention_mask: torch.Tensor
+        ) -> CausalLMOutput:
+            self.batch_sizes.append(len(input_ids))
+            hidden = self.embedding(input_ids) * attention_mask[..., None]
+            return CausalLMOutput(
+                loss=hidden.mean(),
+                logits=hidden.sum(-1),
+                hidden_states=(hidden, 2 * hidden),
+            )
+
+    batch = {
+        "input_ids": torch.randint(16, (7, 8)),
+        "attention_mask": torch.ones(7, 8, dtype=torch.long),
+    }
+    model = Model()
+    expected = LightningGenSLM(model).predict_step(batch, 0)
+    outputs = LightningGenSLM(model, micro_batch_size=3).predict_step(batch, 0)
+    # The windows of a batch never go through the model more than 3 at a time
+    assert model.batch_sizes == [7, 3, 3, 1]
+    assert outputs.attentions is None and outputs.loss is None
+    assert torch.equal(outputs.logits, expected.logits)
+    for hidden, expected_hidden in zip(outputs.hidden_states, expected.hidden_states):
+        assert torch.equal(hidden, expected_hidden)
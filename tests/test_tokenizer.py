@@ -0,0 +1,161 @@
+import errno
+import pickle
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import pytest
+from transformers import PreTrainedTokenizerFast
+
+from genslm import GenSLM
+from genslm.cmdline.run_inference import stitch_windows
+from genslm.tokenizer import KmerTokenizer, TokenCache
+
+TOKENIZER_FILES = sorted(
+    (Path(GenSLM.MODELS["genslm_25M_patric"]["tokenizer"]).parent).glob("*.json")
+)
+
+
+@pytest.mark.parametrize(
+    "tokenizer", TOKENIZER_FILES, ids=lambda p: p.stem, indirect=True
+)
+def test_kmer_tokenizer_matches_huggingface(tokenizer: PreTrainedTokenizerFast) -> None:
+    kmer_tokenizer = KmerTokenizer(tokenizer)
+    assert kmer_tokenizer.vectorized
+
+    # Lower case, ambiguous bases, partial k-mers, gaps, whitespace and
+    # non-ASCII characters (the last three go through the fallback)
+    rng = np.random.default_rng(0)
+    alphabets = ["ACGT", "ACGTacgtNRY", "ACDEFGHIKLMNPQRSTVWY*", "ACGT.-[] \té"]
+    sequences = [""] + [
+        "".join(rng.choice(list(alphabet), rng.integers(1, 100)))
+        for alphabet in alphabets
+        for _ in range(25)
+    ]
+
+    for kmer_size in [1, 3]:
+        for max_length in [8, 64]:
+            encoding = kmer_tokenizer(sequences, kmer_size, max_length)
+            for i, seq in enumerate(sequences):
+                text = " ".join(
+                    seq[j : j + kmer_size] for j in range(0, len(seq), kmer_size)
+                )
+                expected = tokenizer(
+                    text.upper(),
+                    max_length=max_length,
+                    padding="max_length",
+                    truncation=True,
+                    return_tensors="np",
+                )
+                for key in ["input_ids", "attention_mask"]:
+                    assert np.array_equal(encoding[key][i], expected[key][0])
+
+
+def test_token_cache(tmp_path: Path, tokenizer: PreTrainedTokenizerFast) -> None:
+    kmer_tokenizer = KmerTokenizer(tokenizer)
+    sequences = ["ATGAAATAA", "ATGCCCTGA", "ATGAAATAA", "ATGGGGTAGC", ""]
+    expected = kmer_tokenizer(sequences, 3, 8)
+
+    cache = TokenCache(tmp_path, kmer_tokenizer, kmer_size=3, block_size=8)
+    hashes, locations = cache.update(sequences)
+    assert len(cache) == 4 and (locations >= 0).all()
+    assert hashes[0] == hashes[2] == TokenCache.hash_sequence(sequences[0])
+
+    # A new instance (e.g. another run or model) only tokenizes new sequences
+    cache = TokenCache(tmp_path, KmerTokenizer(tokenizer), kmer_size=3, block_size=8)
+    cache.max_segments = 1
+    _, locations = cache.update(sequences + ["ATGTTT"])
+    assert len(cache) == 5 and len(cache.segments) == 1
+
+    cache = pickle.loads(pickle.dumps(cache))
+    for i in range(len(sequences)):
+        encoding = cache.get(*locations[i])
+        for key in ["input_ids", "attention_mask"]:
+            assert np.array_equal(encoding[key][0], expected[key][i])
+
+
+def test_token_cache_concurrent_merge(
+    tmp_path: Path, tokenizer: PreTrainedTokenizerFast
+) -> None:
+    kmer_tokenizer = KmerTokenizer(tokenizer)
+    sequences = ["ATGAAATAA", "ATGCCCTGA", "ATGGGGTAGC"]
+    expected = kmer_tokenizer(sequences, 3, 8)
+
+    cache = TokenCache(tmp_path, kmer_tokenizer, kmer_size=3, block_size=8)
+    for seq in sequences:
+        hashes, locations = cache.update([seq])
+    hashes, locations = cache.update(sequences)
+    assert len(cache.segments) == 3
+    # Pickled for a data loader worker
+    state = pickle.dumps(cache)
+
+    # Another process merges, the old segments are retired but kept
+    other = TokenCache(tmp_path, kmer_tokenizer, kmer_size=3, block_size=8)
+    other.merge()
+    assert len(other.segments) == 1
+    assert len(list(cache.path.glob("segment-*"))) == 4
+    worker = pickle.loads(state)
+    assert all(segment is not None for segment in worker.segments)
+
+    # A later merge collects them, the worker falls back to the manifest
+    other.retire_seconds = 0
+    other.merge()
+    other.merge()
+    assert len(list(cache.path.glob("segment-*"))) == 2
+    worker = pickle.loads(state)
+    assert all(segment is None for segment in worker.segments)
+    for i in range(len(sequences)):
+        encoding = worker.get(*locations[i], na_hash=hashes[i])
+        for key in ["input_ids", "attention_mask"]:
+            assert np.array_equal(encoding[key][0], expected[key][i])
+    with pytest.raises(FileNotFoundError):
+        worker.get(*locations[0])
+
+
+def test_token_cache_without_flock(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, tokenizer: PreTrainedTokenizerFast
+) -> None:
+    def flock(*args: Any) -> None:
+        raise OSError(errno.ENOSYS, "Function not implemented")
+
+    # e.g. Lustre mounted without -o flock
+    monkeypatch.setattr("genslm.tokenizer.fcntl.flock", flock)
+    kmer_tokenizer = KmerTokenizer(tokenizer)
+    cache = TokenCache(tmp_path, kmer_tokenizer, kmer_size=3, block_size=8)
+    cache.update(["ATGAAATAA"])
+    cache.update(["ATGCCCTGA"])
+    cache.merge()
+    assert len(cache) == 2 and len(cache.segments) == 1
+    assert not (cache.path / ".lock.d").exists()
+
+    # A lock left behind by a process that died is broken once stale
+    (cache.path / ".lock.d").mkdir()
+    cache.stale_lock_seconds = 0
+    cache.update(["ATGGGGTAG"])
+    assert len(cache) == 3
+
+
+def test_windows(tokenizer: PreTrainedTokenizerFast) -> None:
+    kmer_tokenizer = KmerTokenizer(tokenizer)
+    sequence = "".join(np.random.default_rng(0).choice(list("ACGT"), 120))
+    full = kmer_tokenizer([sequence], 3, 40)["input_ids"][0]
+
+    windows = kmer_tokenizer.windows(sequence, 3, max_length=16, stride=10)
+    positions = windows["positions"]
+    assert positions[:, 0].tolist() == [0, 10, 20, 24]
+    assert np.array_equal(windows["input_ids"], full[positions])
+    assert windows["attention_mask"].all()
+
+    # Stitching the per-window outputs recovers the output of each token
+    outputs = windows["input_ids"][..., None].astype(np.float32)
+    assert np.array_equal(stitch_windows(outputs, positions)[:, 0], full)
+
+    # Sequences that fit are tokenized as usual
+    windows = kmer_tokenizer.windows(sequence[:30], 3, max_length=16, stride=10)
+    expected = kmer_tokenizer([sequence[:30]], 3, 16)
+    for key in ["input_ids", "attention_mask"]:
+        assert np.array_equal(windows[key], expected[key])
+    assert windows["positions"][0].tolist() == list(range(10)) + [-1] * 6
+
+    with pytest.raises(ValueError):
+        kmer_tokenizer.windows(sequence, 3, max_length=16, stride=17)
@@ -0,0 +1,256 @@
+import gzip
+import multiprocessing
+import os
+import time
+from pathlib import Path
+from typing import Any, List
+
+import numpy as np
+import pytest
+
+import genslm.utils
+from genslm.utils import (
+    FastaDeduplicator,
+    FastaWriter,
+    FileTaskQueue,
+    KnownSequenceIndex,
+    build_fasta_index,
+    iter_fasta,
+    read_fasta,
+    read_fasta_entry,
+    read_fasta_only_seq,
+    translate,
+    unique_proportion,
+)
+
+FASTA_TEXT = (
+    ">seq_0 first record\nATGAAA\nTAA\n>seq_1\nATGCCC\nTGA\n>seq_2 third\nATG\n"
+)
+
+
+def test_read_fasta(tmp_path: Path) -> None:
+    fasta_file = tmp_path / "test.fasta"
+    fasta_file.write_text(FASTA_TEXT)
+
+    records = read_fasta(fasta_file)
+    assert [r.sequence for r in records] == ["ATGAAATAA", "ATGCCCTGA", "ATG"]
+    assert [r.id for r in records] == ["seq_0", "seq_1", "seq_2"]
+    assert records[0].description == "seq_0 first record"
+    assert read_fasta_only_seq(fasta_file) == [r.sequence for r in records]
+
+    # Compressed input is detected transparently
+    gz_file = tmp_path / "test.fasta.gz"
+    gz_file.write_bytes(gzip.compress(FASTA_TEXT.encode()))
+    assert read_fasta(gz_file) == records
+
+    # Resuming mid-record skips ahead to the next header
+    offset = FASTA_TEXT.index(">seq_1") - 3
+    assert [r.id for r in iter_fasta(fasta_file, offset=offset)] == ["seq_1", "seq_2"]
+
+
+def test_fasta_index(tmp_path: Path) -> None:
+    fasta_file = tmp_path / "test.fasta"
+    fasta_file.write_text(FASTA_TEXT)
+
+    # Small chunks exercise headers that straddle chunk boundaries
+    offsets = build_fasta_index(fasta_file, chunk_size=5)
+    assert len(offsets) == 4 and offsets[-1] == len(FASTA_TEXT)
+
+    with open(fasta_file, "rb") as f:
+        entries = [read_fasta_entry(f, *offsets[i : i + 2]) for i in range(3)]
+    assert entries == [(r.tag, r.sequence) for r in read_fasta(fasta_file)]
+
+
+def test_fasta_writer_resume(tmp_path: Path) -> None:
+    fasta_file = tmp_path / "generated.fasta"
+    with FastaWriter(fasta_file, "SyntheticSeq") as writer:
+        writer.write("ATGAAATAA")
+        writer.write("ATGCCCTGA")
+
+    # Simulate a crash in the middle of writing the third entry
+    with open(fasta_file, "a") as f:
+        f.write(">SyntheticSeq_2 SyntheticSeq\nATG")
+
+    with FastaWriter(fasta_file, "SyntheticSeq") as writer:
+        assert writer.sequences == ["ATGAAATAA", "ATGCCCTGA"]
+        writer.write("ATGGGGTAG")
+
+    records = read_fasta(fasta_file)
+    assert [r.id for r in records] == [f"SyntheticSeq_{i}" for i in range(3)]
+    assert records[-1].sequence == "ATGGGGTAG"
+
+    # A crash after flushing the first line of a wrapped sequence
+    with open(fasta_file, "a") as f:
+        f.write(">SyntheticSeq_3 SyntheticSeq\n" + "A" * 60 + "\n")
+    with FastaWriter(fasta_file, "SyntheticSeq") as writer:
+        assert len(writer) == 3
+
+    # The sync record of a file that was since replaced is ignored
+    replaced = ">other\n" + "C" * 500 + "\n" + ">other_2\nGGG\n"
+    fasta_file.unlink()
+    fasta_file.write_text(replaced)
+    with FastaWriter(fasta_file, "SyntheticSeq") as writer:
+        assert len(writer) == 2
+    assert fasta_file.read_text() == replaced
+
+
+def test_non_redundant_generation_resume(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    fasta_file = tmp_path / "generated.fasta"
+    generated = iter(["ATGAAA", "ATGAAA", "ATGCCC", "ATGTTT", "ATGGGG"])
+
+    def generate_dna(*args: Any, **kwargs: Any) -> List[str]:
+        seq = next(generated)
+        if seq == "ATGGGG":
+            raise RuntimeError("Out of memory")
+        return [seq]
+
+    monkeypatch.setattr(genslm.utils, "generate_dna", generate_dna)
+    monkeypatch.setattr(genslm.utils, "tokens_to_sequences", lambda seqs, **_: seqs)
+    results = genslm.utils.non_redundant_generation(
+        None, None, num_seqs=2, write_to_file=fasta_file
+    )
+    assert results["all_generated_seqs"] == ["ATGAAA", "ATGAAA", "ATGCCC"]
+    assert unique_proportion(results) == 2 / 3
+
+    # A failing run still keeps what it wrote (fewer than sync_every records)
+    with pytest.raises(RuntimeError):
+        genslm.utils.non_redundant_generation(
+            None, None, num_seqs=4, write_to_file=fasta_file
+        )
+    # Resuming a complete run generates nothing
+    results = genslm.utils.non_redundant_generation(
+        None, None, num_seqs=3, write_to_file=fasta_file
+    )
+    assert results["resumed_seqs"] == ["ATGAAA", "ATGCCC", "ATGTTT"]
+    assert sorted(results["unique_seqs"]) == results["resumed_seqs"]
+    assert unique_proportion(results) is None
+
+
+def test_fasta_dedup(tmp_path: Path) -> None:
+    (tmp_path / "a.fasta").write_text(FASTA_TEXT)
+    # Duplicates are found across files and regardless of case
+    (tmp_path / "b.fasta").write_text(">dup_0\natgaaataa\n>new\nATGTTT\n>dup_1\nATG\n")
+    files = [tmp_path / "a.fasta", tmp_path / "b.fasta"]
+
+    deduplicator = FastaDeduplicator(files, tmp_path / "dedup")
+    deduplicator.hash_files(node_rank=0, num_nodes=2)
+    deduplicator.hash_files(node_rank=1, num_nodes=2)
+    for shard in range(3):
+        deduplicator.dedup_shard(shard, num_shards=3)
+
+    stats = deduplicator.write_masks()
+    assert stats["records"] == 6 and stats["kept_records"] == 4
+    assert stats["bases"] - stats["kept_bases"] == 12
+    assert np.load(deduplicator.mask_file(files[0])).all()
+    assert np.load(deduplicator.mask_file(files[1])).tolist() == [False, True, False]
+
+    deduplicator.filter_fasta(files[1], tmp_path / "filtered.fasta")
+    assert [r.id for r in read_fasta(tmp_path / "filtered.fasta")] == ["new"]
+
+    # Changed files are hashed again, their old masks no longer apply
+    with open(files[1], "a") as f:
+        f.write(">other\nATGCCC\n")
+    with pytest.raises(ValueError, match="3 entries for 4 records"):
+        deduplicator.filter_fasta(files[1], tmp_path / "filtered.fasta")
+    deduplicator.hash_files()
+    for shard in range(3):
+        deduplicator.dedup_shard(shard, num_shards=3)
+    assert deduplicator.write_masks()["kept_records"] == 5
+
+
+def copy_task(input_file: Path, work_dir: Path) -> None:
+    (work_dir / f"{input_file.stem}.out").write_text(input_file.read_text())
+    with open(input_file.parent.parent / "runs.log", "a") as f:
+        f.write(f"{input_file.name}\n")
+    time.sleep(0.05)
+
+
+def run_queue_node(input_files: list, output_dir: Path) -> None:
+    FileTaskQueue(input_files, output_dir).run(copy_task)
+
+
+def test_file_task_queue(tmp_path: Path) -> None:
+    (tmp_path / "inputs").mkdir()
+    files = [tmp_path / "inputs" / f"{i}.txt" for i in range(8)]
+    for i, input_file in enumerate(files):
+        input_file.write_text("A" * (100 * i + 1))
+    output_dir = tmp_path / "outputs"
+
+    # Processes stand in for the nodes sharing the queue directory
+    nodes = [
+        multiprocessing.Process(target=run_queue_node, args=(files, output_dir))
+        for _ in range(3)
+    ]
+    for node in nodes:
+        node.start()
+    for node in nodes:
+        node.join()
+        assert node.exitcode == 0
+
+    # Every file was processed exactly once
+    runs = (tmp_path / "runs.log").read_text().split()
+    assert sorted(runs) == sorted(f.name for f in files)
+    for input_file in files:
+        output_file = output_dir / f"{input_file.stem}.out"
+        assert output_file.read_text() == input_file.read_text()
+    queue = FileTaskQueue(files, output_dir)
+    assert set(queue.manifest()) == {f.name for f in files}
+    assert queue.input_files[0] == files[-1]
+
+    # Reruns only process new or changed inputs, even with a claim left
+    # behind by a crashed node
+    files[0].write_text("changed")
+    files.append(tmp_path / "inputs" / "8.txt")
+    files[-1].write_text("new")
+    claim_file = output_dir / ".queue" / "claims" / "8.txt.claim"
+    claim_file.touch()
+    os.utime(claim_file, (time.time() - 3600,) * 2)
+    assert FileTaskQueue(files, output_dir).run(copy_task) == [files[0], files[-1]]
+    assert (output_dir / "0.out").read_text() == "changed"
+
+
+def test_known_sequence_index(tmp_path: Path) -> None:
+    (tmp_path / "a.fasta").write_text(FASTA_TEXT)
+    (tmp_path / "b.fasta").write_text(">x\nGGGTTT\n>y\nATGAAATAA\n")
+    files = [tmp_path / "a.fasta", tmp_path / "b.fasta"]
+    queries = ["ATGAAATAA", "GGGTTT", "ATGCCCTGA", "ATG", "CCCCCC"]
+
+    for verify in [False, True]:
+        index = KnownSequenceIndex.build(files, verify=verify, num_workers=2)
+        assert len(index) == 4 and index.min_length == 3
+        index.save(tmp_path / "index")
+        loaded = KnownSequenceIndex.load(tmp_path / "index")
+        assert loaded.contains(queries).tolist() == [True, True, True, True, False]
+        assert (loaded.sequences is not None) == verify
+
+    # Saving another index into the same directory replaces all of its files
+    KnownSequenceIndex.build(files[1:], verify=True).save(tmp_path / "index")
+    loaded = KnownSequenceIndex.load(tmp_path / "index")
+    assert loaded.contains(queries).tolist() == [True, True, False, False, False]
+    assert len(list((tmp_path / "index").iterdir())) == 3
+
+
+def test_known_sequence_index_collision(monkeypatch: pytest.MonkeyPatch) -> None:
+    # Every sequence has the same hash
+    monkeypatch.setattr(
+        genslm.utils,
+        "hash_sequences",
+        lambda seqs: np.full(len(list(seqs)), 7, dtype="<u8"),
+    )
+    hashes = np.array([7, 7], dtype="<u8")
+    verified = KnownSequenceIndex(hashes, 3, ["AAA", "CCC"])
+    assert verified.contains(["AAA", "CCC", "GGG"]).tolist() == [True, True, False]
+    # Without the sequences, a hash match is taken as known
+    assert KnownSequenceIndex(hashes, 3).contains(["GGG"]).tolist() == [True]
+
+
+def test_translate() -> None:
+    assert translate("ATGAAATAAgc") == "MK*"
+    assert translate("GCNCTNTARRAYSARMTTNNN") == "AL*BZJX"
+
+    Seq = pytest.importorskip("Bio.Seq").Seq
+    rng = np.random.default_rng(0)
+    sequence = "".join(rng.choice(list("ACGTURYSWKMBDHVN"), 3 * 2000))
+    assert translate(sequence) == str(Seq(sequence).translate())